@@ -0,0 +1,82 @@
+import signal
+from typing import Callable
+from contextlib import suppress
+from asyncio import CancelledError, create_task, get_running_loop, run, sleep
+
+from telebot import asyncio_helper
+
+from sql.database import create_async_database_engine
+from services.http_client import AsyncHTTPClient
+from bot_support_modules.dispatcher import UserOrderedAsyncTeleBot
+from bot_support_modules.multiprocess_runtime import LONG_POLLING_TIMEOUT, POLLING_ERROR_RETRY_DELAY
+from get_logger import get_logger
+from settings import BOT_STOP_TIMEOUT, TELEGRAM_API_URL
+
+
+LONG_POLLING_REQUEST_TIMEOUT = LONG_POLLING_TIMEOUT + 10  # seconds, the whole getUpdates request
+
+
+async def _poll_updates(bot: UserOrderedAsyncTeleBot) -> None:
+
+    logger = get_logger('main')
+
+    while True:
+
+        try:
+            updates = await bot.get_updates(
+                offset=bot.offset, timeout=LONG_POLLING_TIMEOUT, request_timeout=LONG_POLLING_REQUEST_TIMEOUT
+            )
+
+        except Exception as e:
+
+            logger.error(f'An exception occurred while receiving updates: {e}')
+
+            await sleep(POLLING_ERROR_RETRY_DELAY)
+
+            continue
+
+        await bot.process_new_updates(updates)  # waits while the in-flight updates limit is reached
+
+
+async def _run_async_polling(create_bot: Callable[[], UserOrderedAsyncTeleBot]) -> None:
+
+    logger = get_logger('main')
+    async_engine = create_async_database_engine()
+    bot = create_bot()
+
+    await bot.delete_webhook()  # polling does not work while the webhook is set
+
+    polling_task = create_task(_poll_updates(bot))
+
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        with suppress(NotImplementedError):  # not supported on Windows, Ctrl+C stops the interpreter there
+            get_running_loop().add_signal_handler(stop_signal, polling_task.cancel)
+
+    logger.info('Async polling started')
+
+    try:
+        await polling_task
+
+    except CancelledError:
+        logger.info('Async polling stopped')
+
+    finally:
+
+        await bot.wait_for_updates(BOT_STOP_TIMEOUT)
+
+        await AsyncHTTPClient.close_all()
+        await bot.close_session()
+        await async_engine.dispose()
+
+
+def run_async_polling(create_bot: Callable[[], UserOrderedAsyncTeleBot]) -> None:
+    """
+    Receive updates and process them concurrently in one event loop by the bot created by create_bot. On SIGINT or
+    SIGTERM the polling stops, the started updates are processed (up to BOT_STOP_TIMEOUT seconds) and the sessions of
+    the services, Telegram and the database are closed.
+    """
+
+    asyncio_helper.API_URL = f'{TELEGRAM_API_URL}/bot{{0}}/{{1}}'
+    asyncio_helper.FILE_URL = f'{TELEGRAM_API_URL}/file/bot{{0}}/{{1}}'
+
+    run(_run_async_polling(create_bot))
@@ -0,0 +1,183 @@
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from services.gpt import gpt
+from get_logger import get_logger
+from sql.crud import UserMessageCrud, UserSummaryCrud
+from sql.models import UserMessage
+from sql.message_journal import message_journal
+from settings import (
+    GPT_HISTORY_MESSAGES_AMOUNT,
+    GPT_HISTORY_SUMMARY_ENABLED,
+    GPT_HISTORY_SUMMARY_TOKENS_BUDGET,
+    GPT_HISTORY_SUMMARY_MAX_MESSAGES,
+    GPT_HISTORY_SUMMARY_DELETE_MESSAGES,
+)
+
+
+class ConversationSummarizer:
+    """
+    Caps the GPT prompt size by a rolling summary. When the estimated tokens amount of the not summarized messages
+    exceeds tokens_budget, the older ones are condensed into the stored summary (the previous summary is continued, not
+    regenerated) and only the newest messages within a half of the budget are kept verbatim.
+    """
+
+    def __init__(self, is_enabled: bool, tokens_budget: int, max_messages_amount: int, delete_messages: bool) -> None:
+
+        self.is_enabled = is_enabled
+        self.tokens_budget = tokens_budget
+        self.max_messages_amount = max_messages_amount
+        self.delete_messages = delete_messages
+
+        self.logger = get_logger('main')
+
+    @staticmethod
+    def _get_tokens_amount(messages: list[UserMessage]) -> int:
+        return sum(gpt.estimate_prompt_tokens_amount(message.text) for message in messages)
+
+    def _split(self, messages: list[UserMessage]) -> tuple[list[UserMessage], list[UserMessage]]:
+        """
+        Return the messages to summarize and the newest messages to keep verbatim.
+        """
+
+        kept_messages_amount = 0
+        kept_tokens_amount = 0
+
+        for message in reversed(messages):
+
+            kept_tokens_amount += gpt.estimate_prompt_tokens_amount(message.text)
+
+            if kept_tokens_amount > self.tokens_budget // 2 or kept_messages_amount >= GPT_HISTORY_MESSAGES_AMOUNT:
+                break
+
+            kept_messages_amount += 1
+
+        split_index = len(messages) - kept_messages_amount
+
+        # the pending journal messages have no ids yet, so they can not be marked as summarized
+        while split_index and messages[split_index - 1].id is None:
+            split_index -= 1
+
+        return messages[:split_index], messages[split_index:]
+
+    def _load(self, session: Session, user_id: int) -> tuple[list[UserMessage], str | None]:
+        """
+        Return the not summarized history messages and the summary, end the read transaction.
+        """
+
+        if not self.is_enabled:
+
+            messages = message_journal.get_history(session, user_id, GPT_HISTORY_MESSAGES_AMOUNT)
+
+            session.commit()
+
+            return messages, None
+
+        summary, last_message_id = self._load_summary(session, user_id)
+
+        messages = message_journal.get_history(session, user_id, self.max_messages_amount, last_message_id)
+
+        session.commit()
+
+        return messages, summary
+
+    async def _load_async(self, session: AsyncSession, user_id: int) -> tuple[list[UserMessage], str | None]:
+
+        if not self.is_enabled:
+
+            messages = await message_journal.get_history_async(session, user_id, GPT_HISTORY_MESSAGES_AMOUNT)
+
+            await session.commit()
+
+            return messages, None
+
+        summary, last_message_id = await session.run_sync(self._load_summary, user_id)
+
+        messages = await message_journal.get_history_async(
+            session, user_id, self.max_messages_amount, last_message_id
+        )
+
+        await session.commit()
+
+        return messages, summary
+
+    @staticmethod
+    def _load_summary(session: Session, user_id: int) -> tuple[str | None, int]:
+        """
+        Return the summary text and the id of the last summarized message (None and 0 if there is no summary).
+        """
+
+        user_summary = UserSummaryCrud(session).get(user_id=user_id)
+
+        if user_summary is None:
+            return None, 0
+
+        return user_summary.text, user_summary.last_message_id
+
+    def _save(self, session: Session, user_id: int, new_summary: str, summarized_messages: list[UserMessage]) -> None:
+
+        last_message_id = summarized_messages[-1].id
+
+        UserSummaryCrud(session).save(user_id, new_summary, last_message_id)
+
+        if self.delete_messages:
+            UserMessageCrud(session).delete_history(user_id, last_message_id)
+
+        self.logger.info(f'{len(summarized_messages)} messages of the user {user_id} are summarized')
+
+    def get_context(self, session: Session, user_id: int) -> tuple[list[UserMessage], str | None]:
+        """
+        Return the history messages and the summary of the older conversation (None if there is no summary) to pass
+        into GPT. The read transaction is ended before returning and before GPT is requested, so the session does not
+        hold a pooled connection while the caller waits for GPT.
+        """
+
+        messages, summary = self._load(session, user_id)
+
+        if not self.is_enabled or self._get_tokens_amount(messages) <= self.tokens_budget:
+            return messages, summary
+
+        summarized_messages, kept_messages = self._split(messages)
+
+        if not summarized_messages:
+            return kept_messages, summary
+
+        new_summary = gpt.summarize(summary, summarized_messages)
+
+        if new_summary is None:  # the older messages are not sent this time, they are summarized on the next request
+            return kept_messages, summary
+
+        self._save(session, user_id, new_summary, summarized_messages)
+
+        return kept_messages, new_summary
+
+    async def get_context_async(self, session: AsyncSession, user_id: int) -> tuple[list[UserMessage], str | None]:
+        """
+        Like get_context, for the async mode.
+        """
+
+        messages, summary = await self._load_async(session, user_id)
+
+        if not self.is_enabled or self._get_tokens_amount(messages) <= self.tokens_budget:
+            return messages, summary
+
+        summarized_messages, kept_messages = self._split(messages)
+
+        if not summarized_messages:
+            return kept_messages, summary
+
+        new_summary = await gpt.summarize_async(summary, summarized_messages)
+
+        if new_summary is None:
+            return kept_messages, summary
+
+        await session.run_sync(self._save, user_id, new_summary, summarized_messages)
+
+        return kept_messages, new_summary
+
+conversation_summarizer = ConversationSummarizer(
+    GPT_HISTORY_SUMMARY_ENABLED,
+    GPT_HISTORY_SUMMARY_TOKENS_BUDGET,
+    GPT_HISTORY_SUMMARY_MAX_MESSAGES,
+    GPT_HISTORY_SUMMARY_DELETE_MESSAGES,
+)
@@ -0,0 +1,200 @@
+from time import monotonic
+from queue import Queue
+from threading import Thread
+from typing import Callable
+from asyncio import Semaphore, Task, create_task, current_task, wait
+
+from telebot import TeleBot, types
+from telebot.async_telebot import AsyncTeleBot
+
+from metrics import metrics
+from get_logger import get_logger
+
+
+def wait_for_queue(queue: Queue, timeout: float | None = None) -> bool:
+    """
+    Wait until all the queue items are processed (like Queue.join), return False if they are not processed in time.
+    """
+
+    with queue.all_tasks_done:
+        return queue.all_tasks_done.wait_for(lambda: not queue.unfinished_tasks, timeout)
+
+
+def get_update_user_id(update: types.Update) -> int | None:
+
+    for update_object in vars(update).values():
+
+        user = getattr(update_object, 'from_user', None)
+
+        if user is not None:
+            return user.id
+
+
+class UserShardedTeleBot(TeleBot):
+    """
+    TeleBot which puts every update into the queue of one of the shards by the user id, so updates of one user are
+    processed one by one in order, while different users are processed in parallel by the shards workers. Handlers are
+    executed in the shards workers, so the bot is always non-threaded. The handlers duration is measured by the metrics.
+    """
+
+    def __init__(self, *args, shards_amount: int, shard_queue_max_size: int, **kwargs) -> None:
+
+        super().__init__(*args, threaded=False, **kwargs)
+
+        self.logger = get_logger('main')
+        self.shards_queues: list[Queue[types.Update]] = [Queue(shard_queue_max_size) for _ in range(shards_amount)]
+
+        for shard_number, shard_queue in enumerate(self.shards_queues):
+            Thread(target=self._process_shard, args=(shard_queue,), name=f'shard_{shard_number}', daemon=True).start()
+
+    def _process_shard(self, shard_queue: Queue) -> None:
+        while True:
+
+            update = shard_queue.get()
+
+            try:
+                super().process_new_updates([update])
+
+            except Exception as e:
+                self.logger.exception(f'An exception occurred while processing update {update.update_id}: {e}')
+
+            finally:
+                shard_queue.task_done()
+
+    def add_message_handler(self, handler_dict: dict) -> None:
+
+        handler_dict['function'] = metrics.timed(
+            'bot_handler_duration_seconds', handler=handler_dict['function'].__name__
+        )(handler_dict['function'])
+
+        super().add_message_handler(handler_dict)
+
+    def register_next_step_handler(self, message: types.Message, callback: Callable, *args, **kwargs) -> None:
+        super().register_next_step_handler(
+            message, metrics.timed('bot_handler_duration_seconds', handler=callback.__name__)(callback), *args, **kwargs
+        )
+
+    def get_shard_number(self, update: types.Update) -> int:
+
+        user_id = get_update_user_id(update)
+
+        return (update.update_id if user_id is None else user_id) % len(self.shards_queues)
+
+    def process_new_updates(self, updates: list[types.Update]) -> None:
+        """
+        Put the updates into the shards queues, block while the target queue is full (backpressure).
+        """
+
+        for update in updates:
+
+            # confirm the update here, the polling requests the next updates before the shards process these ones
+            self.last_update_id = max(self.last_update_id, update.update_id)
+
+            self.shards_queues[self.get_shard_number(update)].put(update)
+
+    def wait_for_shards(self, timeout: float | None = None) -> bool:
+        """
+        Wait until the shards process all the queued updates, return False (and log it) if they are not processed in
+        the timeout.
+        """
+
+        deadline = None if timeout is None else monotonic() + timeout
+
+        for shard_queue in self.shards_queues:
+            if not wait_for_queue(shard_queue, None if deadline is None else max(deadline - monotonic(), 0)):
+
+                self.logger.error(f'The queued updates are not processed in {timeout} seconds, they are lost')
+
+                return False
+
+        return True
+
+
+class UserOrderedAsyncTeleBot(AsyncTeleBot):
+    """
+    AsyncTeleBot (the async mode) which processes every update in its own task, the task of the user update waits for
+    the task of the previous update of the same user, so updates of one user are processed one by one in order, while
+    different users are processed concurrently. At most max_in_flight_updates updates are processed at once. The
+    handlers duration is measured by the metrics.
+    """
+
+    def __init__(self, *args, max_in_flight_updates: int, **kwargs) -> None:
+
+        super().__init__(*args, **kwargs)
+
+        self.logger = get_logger('main')
+
+        self._in_flight_updates = Semaphore(max_in_flight_updates)
+        self._tasks: set[Task] = set()
+        self._users_last_tasks: dict[int, Task] = {}  # the task of the last received update of every user
+
+    def add_message_handler(self, handler_dict: dict) -> None:
+
+        handler_dict['function'] = metrics.timed(
+            'bot_handler_duration_seconds', handler=handler_dict['function'].__name__
+        )(handler_dict['function'])
+
+        super().add_message_handler(handler_dict)
+
+    async def _process_update(self, update: types.Update, user_id: int | None, previous_task: Task | None) -> None:
+
+        try:
+            if previous_task is not None:
+                await wait([previous_task])  # its exception is already logged
+
+            await super().process_new_updates([update])
+
+        except Exception as e:
+            self.logger.exception(f'An exception occurred while processing update {update.update_id}: {e}')
+
+        finally:
+
+            self._in_flight_updates.release()
+
+            if self._users_last_tasks.get(user_id) is current_task():  # no next update of the user is waiting
+                del self._users_last_tasks[user_id]
+
+    async def process_new_updates(self, updates: list[types.Update]) -> None:
+        """
+        Start the updates processing tasks, wait while max_in_flight_updates updates are processed (backpressure).
+        """
+
+        for update in updates:
+
+            await self._in_flight_updates.acquire()
+
+            user_id = get_update_user_id(update)
+
+            task = create_task(self._process_update(update, user_id, self._users_last_tasks.get(user_id)))
+
+            if user_id is not None:
+                self._users_last_tasks[user_id] = task
+
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+            # confirm the update here, the polling requests the next updates before these ones are processed
+            self.offset = max(self.offset or 0, update.update_id + 1)
+
+    async def wait_for_updates(self, timeout: float | None = None) -> bool:
+        """
+        Wait until the started updates are processed, return False (and log it) if they are not processed in the
+        timeout, the not processed ones are cancelled.
+        """
+
+        if not self._tasks:
+            return True
+
+        _, not_processed_tasks = await wait(set(self._tasks), timeout=timeout)
+
+        if not not_processed_tasks:
+            return True
+
+        self.logger.error(f'The started updates are not processed in {timeout} seconds, they are lost')
+
+        for task in not_processed_tasks:
+            task.cancel()
+
+        await wait(not_processed_tasks)
+
+        return False
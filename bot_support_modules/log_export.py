@@ -0,0 +1,114 @@
+import re
+from io import BytesIO
+from os import SEEK_END
+from gzip import GzipFile
+from pathlib import Path
+from typing import Iterator
+
+
+RECORD_START_PATTERN = re.compile(r'^(\[(DEBUG|INFO|WARNING|ERROR|CRITICAL)] |\{"level": )')  # text or json lines
+READ_BLOCK_SIZE = 64 * 1024
+
+
+def get_log_segments(log_file_path: Path) -> list[Path]:
+    """
+    Return the existing log file and its rotated backups (log.1, log.2, ...) from the newest to the oldest.
+    """
+
+    segments = [log_file_path]
+
+    while (backup_path := log_file_path.with_name(f'{log_file_path.name}.{len(segments)}')).exists():
+        segments.append(backup_path)
+
+    return [segment for segment in segments if segment.exists()]
+
+
+def _read_lines_reversed(file_path: Path) -> Iterator[str]:
+    """
+    Yield the file lines from the last one, the file is read by blocks from the end.
+    """
+
+    with open(file_path, 'rb') as f:
+
+        position = f.seek(0, SEEK_END)
+        rest = b''
+
+        while position > 0:
+
+            read_size = min(READ_BLOCK_SIZE, position)
+            position -= read_size
+
+            f.seek(position)
+
+            block = f.read(read_size) + rest
+            first_line_end = block.find(b'\n')
+
+            if first_line_end == -1:
+
+                rest = block
+
+                continue
+
+            rest = block[:first_line_end]  # may be a part of the line started in the previous block
+
+            yield from reversed(block[first_line_end + 1:].decode('utf-8', errors='replace').split('\n'))
+
+        yield rest.decode('utf-8', errors='replace')
+
+
+def _read_records_reversed(file_path: Path) -> Iterator[str]:
+    """
+    Yield the log records (a record may have several lines) from the last one.
+    """
+
+    continuation_lines = []
+
+    for line in _read_lines_reversed(file_path):
+
+        if line.startswith(('[', '{')) and RECORD_START_PATTERN.match(line):
+
+            if continuation_lines:
+
+                yield '\n'.join([line, *reversed(continuation_lines)]).rstrip('\n')
+
+                continuation_lines = []
+
+            else:
+                yield line
+
+        else:
+            continuation_lines.append(line)
+
+
+def export_logs(log_file_path: Path, records_amount: int, substring: str | None = None) -> bytes | None:
+    """
+    Return the gzip compressed last records_amount records (containing the substring if it is given) of the log file
+    and its rotated backups in the chronological order or None if there are no such records. Only the needed end of
+    the files is read.
+    """
+
+    records = []
+
+    for segment in get_log_segments(log_file_path):
+
+        for record in _read_records_reversed(segment):
+            if substring is None or substring in record:
+
+                records.append(record)
+
+                if len(records) >= records_amount:
+                    break
+
+        if len(records) >= records_amount:
+            break
+
+    if not records:
+        return
+
+    buffer = BytesIO()
+
+    with GzipFile(fileobj=buffer, mode='wb') as gzip_file:
+        for record in reversed(records):
+            gzip_file.write(f'{record}\n'.encode())
+
+    return buffer.getvalue()
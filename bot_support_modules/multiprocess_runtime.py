@@ -0,0 +1,218 @@
+import signal
+from zlib import crc32
+from time import sleep
+from queue import Full
+from typing import Callable
+from multiprocessing import get_context
+from multiprocessing.queues import Queue
+from multiprocessing.process import BaseProcess
+
+from telebot import apihelper, types
+
+from metrics import metrics
+from sql.database import SessionLocal
+from sql.admission import user_admission
+from sql.message_journal import message_journal
+from bot_support_modules.webhook import start_metrics_server
+from bot_support_modules.dispatcher import UserShardedTeleBot
+from get_logger import get_logger, send_records_to_process_queue, listen_process_queue
+from settings import BOT_TOKEN, BOT_SHARD_QUEUE_MAX_SIZE, BOT_STOP_TIMEOUT, TELEGRAM_API_URL, WEBHOOK_PORT
+
+
+LONG_POLLING_TIMEOUT = 20  # seconds
+POLLING_ERROR_RETRY_DELAY = 3  # seconds
+WORKER_PUT_TIMEOUT = 1  # seconds, then the worker is checked (restarted if it is dead)
+WORKER_EXIT_TIMEOUT = 5  # seconds for the worker to save the message journal after its updates are processed
+
+STOP_SIGNAL = None
+
+
+def get_update_worker_number(update: dict, workers_amount: int) -> int:
+    """
+    Return the number of the worker of the (not parsed) update by the hash of its user id (the update id if there is
+    no user), so all updates of one user are processed by one worker. crc32 is used instead of the plain modulo to
+    keep the users of one worker evenly distributed between its shards (they use the user id modulo).
+    """
+
+    user_id = update['update_id']
+
+    for update_object in update.values():
+        if isinstance(update_object, dict) and 'from' in update_object:
+
+            user_id = update_object['from']['id']
+
+            break
+
+    return crc32(str(user_id).encode()) % workers_amount
+
+
+def _run_worker(
+        create_bot: Callable[[], UserShardedTeleBot], worker_number: int, updates_queue: Queue, logs_queue: Queue
+) -> None:
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the supervisor stops the workers by the stop signal
+
+    send_records_to_process_queue(logs_queue)
+
+    logger = get_logger('main')
+
+    if metrics.is_enabled:
+        start_metrics_server(WEBHOOK_PORT + worker_number)
+
+    with SessionLocal() as session:
+        user_admission.warm_up(session)
+
+    bot = create_bot()
+
+    logger.info(f'Worker {worker_number} started')
+
+    try:
+        while (update := updates_queue.get()) is not STOP_SIGNAL:
+            bot.process_new_updates([types.Update.de_json(update)])
+
+        bot.wait_for_shards(BOT_STOP_TIMEOUT)
+
+    finally:
+
+        message_journal.flush()  # the atexit handlers are not called in the child processes
+
+        logger.info(f'Worker {worker_number} stopped')
+
+
+class _Supervisor:
+    """
+    Starts the worker processes and restarts the dead ones. The workers are spawned (not forked), so they do not
+    inherit the threads, locks and database connections of this process.
+    """
+
+    def __init__(self, create_bot: Callable[[], UserShardedTeleBot], workers_amount: int) -> None:
+
+        self.create_bot = create_bot
+        self.logger = get_logger('main')
+        self.context = get_context('spawn')
+
+        self.logs_queue = self.context.Queue()
+        self.updates_queues: list[Queue] = [
+            self.context.Queue(BOT_SHARD_QUEUE_MAX_SIZE) for _ in range(workers_amount)
+        ]
+        self.workers: list[BaseProcess] = [self._create_worker(number) for number in range(workers_amount)]
+
+    def _create_worker(self, worker_number: int) -> BaseProcess:
+        return self.context.Process(
+            target=_run_worker,
+            args=(self.create_bot, worker_number, self.updates_queues[worker_number], self.logs_queue),
+            name=f'bot_worker_{worker_number}',
+        )
+
+    def start_workers(self) -> None:
+        for worker in self.workers:
+            worker.start()
+
+    def restart_dead_workers(self) -> None:
+        for worker_number, worker in enumerate(self.workers):
+            if not worker.is_alive():
+
+                self.logger.error(
+                    f'Worker {worker_number} has exited with code {worker.exitcode}, restarting it '
+                    f'(the updates in its queue are lost)'
+                )
+
+                # the dead worker could hold the queue lock, so the new worker gets a new queue
+                self.updates_queues[worker_number].cancel_join_thread()  # do not wait for the not received updates
+                self.updates_queues[worker_number].close()
+                self.updates_queues[worker_number] = self.context.Queue(BOT_SHARD_QUEUE_MAX_SIZE)
+
+                self.workers[worker_number] = self._create_worker(worker_number)
+
+                self.workers[worker_number].start()
+
+    def put_update(self, update: dict) -> None:
+        """
+        Put the update into its worker queue, block while the queue is full (backpressure).
+        """
+
+        worker_number = get_update_worker_number(update, len(self.updates_queues))
+
+        while True:
+
+            try:
+                self.updates_queues[worker_number].put(update, timeout=WORKER_PUT_TIMEOUT)
+
+                return
+
+            except Full:
+                self.restart_dead_workers()
+
+    def stop_workers(self) -> None:
+
+        for worker, updates_queue in zip(self.workers, self.updates_queues):
+            if worker.is_alive():
+                updates_queue.put(STOP_SIGNAL)
+
+        for worker_number, worker in enumerate(self.workers):
+
+            worker.join(BOT_STOP_TIMEOUT + WORKER_EXIT_TIMEOUT)
+
+            if worker.is_alive():
+
+                self.logger.error(
+                    f'Worker {worker_number} is not stopped in {BOT_STOP_TIMEOUT + WORKER_EXIT_TIMEOUT} seconds, '
+                    f'terminating it'
+                )
+
+                worker.terminate()
+
+
+def run_multiprocess_polling(create_bot: Callable[[], UserShardedTeleBot], workers_amount: int) -> None:
+    """
+    Receive updates in this process and process them in workers_amount worker processes, every worker creates its own
+    bot by create_bot (must be a module level function). The updates are not parsed here, only routed by the user id,
+    the records logged by the workers are written by this process.
+    """
+
+    apihelper.API_URL = f'{TELEGRAM_API_URL}/bot{{0}}/{{1}}'
+
+    logger = get_logger('main')
+    supervisor = _Supervisor(create_bot, workers_amount)
+    logs_listener = listen_process_queue(supervisor.logs_queue)
+
+    supervisor.start_workers()
+
+    apihelper.delete_webhook(BOT_TOKEN)  # polling does not work while the webhook is set
+
+    offset = None
+
+    logger.info(f'Multiprocess polling started with {workers_amount} workers')
+
+    try:
+        while True:
+
+            try:
+                updates = apihelper.get_updates(
+                    BOT_TOKEN, offset=offset, timeout=LONG_POLLING_TIMEOUT, long_polling_timeout=LONG_POLLING_TIMEOUT
+                )
+
+            except Exception as e:
+
+                logger.error(f'An exception occurred while receiving updates: {e}')
+
+                sleep(POLLING_ERROR_RETRY_DELAY)
+
+                continue
+
+            for update in updates:
+
+                supervisor.put_update(update)
+
+                offset = update['update_id'] + 1
+
+            supervisor.restart_dead_workers()
+
+    except KeyboardInterrupt:
+        logger.info('Multiprocess polling stopped')
+
+    finally:
+
+        supervisor.stop_workers()
+
+        logs_listener.stop()
@@ -0,0 +1,79 @@
+from typing import Callable, Any
+from inspect import iscoroutinefunction
+from functools import wraps
+from dataclasses import dataclass
+
+from telebot.types import Message
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from sql.crud import UserCrud
+from sql.database import SessionLocal, AsyncSessionLocal
+from sql.models import User
+from get_logger import request_id_var
+
+
+@dataclass
+class RequestContext:
+    """
+    One database session and the message user, loaded once per update and shared by all validators and handlers. The
+    session of the async mode handlers is an AsyncSession.
+    """
+
+    session: Session | AsyncSession
+    user: User
+
+
+def request_context_provider() -> Callable:
+    """
+    Return a decorator that opens a database session, loads the message user and passes RequestContext into the
+    wrapped function right after the message. The message is set as the request id of the records logged meanwhile.
+    The read transaction is ended after the user is loaded, so the session does not hold a pooled connection while the
+    handler requests the services. The coroutine functions (the async mode handlers) get an async session.
+    """
+
+    def provider(func: Callable) -> Callable:
+
+        if iscoroutinefunction(func):
+
+            @wraps(func)
+            async def _async_provider(message: Message, *args, **kwargs) -> Any:
+
+                request_id_token = request_id_var.set(f'{message.chat.id}:{message.message_id}')
+
+                try:
+                    async with AsyncSessionLocal() as session:
+
+                        user = await session.run_sync(
+                            lambda sync_session: UserCrud(sync_session).get_or_create(telegram_id=message.from_user.id)
+                        )
+
+                        await session.commit()
+
+                        return await func(message, RequestContext(session, user), *args, **kwargs)
+
+                finally:
+                    request_id_var.reset(request_id_token)
+
+            return _async_provider
+
+        @wraps(func)
+        def _provider(message: Message, *args, **kwargs) -> Any:
+
+            request_id_token = request_id_var.set(f'{message.chat.id}:{message.message_id}')
+
+            try:
+                with SessionLocal() as session:
+
+                    user = UserCrud(session).get_or_create(telegram_id=message.from_user.id)
+
+                    session.commit()  # the user attributes stay loaded (expire_on_commit is False)
+
+                    return func(message, RequestContext(session, user), *args, **kwargs)
+
+            finally:
+                request_id_var.reset(request_id_token)
+
+        return _provider
+
+    return provider
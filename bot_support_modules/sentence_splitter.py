@@ -0,0 +1,46 @@
+import re
+
+
+SENTENCE_END_PATTERN = re.compile(r'(?<=[.!?…])\s+')
+
+
+class SentenceSplitter:
+    """
+    Split a streamed (growing) text into segments of whole sentences. Each segment is at least min_segment_length
+    characters long, except the last one.
+    """
+
+    def __init__(self, min_segment_length: int) -> None:
+
+        self.min_segment_length = min_segment_length
+        self._position = 0  # length of the already split text part
+
+    def feed(self, text: str) -> list[str]:
+        """
+        Take the whole text received so far and return new complete segments.
+        """
+
+        segments = []
+        segment_start = self._position
+
+        for sentence_end in SENTENCE_END_PATTERN.finditer(text, self._position):
+            if sentence_end.start() - segment_start >= self.min_segment_length:
+
+                segments.append(text[segment_start:sentence_end.start()])
+
+                segment_start = sentence_end.end()
+
+        self._position = segment_start
+
+        return segments
+
+    def flush(self, text: str) -> list[str]:
+        """
+        Take the whole final text and return the rest of it as the last segment.
+        """
+
+        segment = text[self._position:].strip()
+
+        self._position = len(text)
+
+        return [segment] if segment else []
@@ -0,0 +1,240 @@
+from typing import Any
+from threading import Lock
+from collections import OrderedDict
+
+from telebot import asyncio_storage
+from telebot.handler_backends import State
+from telebot.storage import StateStorageBase, StateContext
+from sqlalchemy.orm import Session
+
+from sql.crud import BotStateCrud
+from sql.database import SessionLocal, AsyncSessionLocal
+
+
+class _StatesCache:
+    """
+    The write-through in-memory LRU cache of the states records of the database states storages.
+    """
+
+    def __init__(self, cache_max_items: int) -> None:
+
+        self.cache_max_items = cache_max_items
+
+        # (chat_id, user_id): {'state': ..., 'data': {...}} or None if there is no record
+        self._cache: OrderedDict[tuple[int, int], dict | None] = OrderedDict()
+        self._lock = Lock()
+
+    def _remember(self, key: tuple[int, int], record: dict | None) -> None:
+        with self._lock:
+
+            self._cache[key] = record
+
+            self._cache.move_to_end(key)
+
+            while len(self._cache) > self.cache_max_items:
+                self._cache.popitem(last=False)
+
+    def _get_cached(self, key: tuple[int, int]) -> tuple[bool, dict | None]:
+        """
+        Return True and the cached record or False and None if the record is not cached.
+        """
+
+        with self._lock:
+            if key in self._cache:
+
+                self._cache.move_to_end(key)
+
+                return True, self._cache[key]
+
+        return False, None
+
+    @staticmethod
+    def _load_record(session: Session, chat_id: int, user_id: int) -> dict | None:
+
+        bot_state = BotStateCrud(session).get(chat_id=chat_id, user_id=user_id)
+
+        return None if bot_state is None else {'state': bot_state.state, 'data': bot_state.data}
+
+    @staticmethod
+    def _save_record(session: Session, chat_id: int, user_id: int, record: dict | None) -> None:
+        if record is None:
+            BotStateCrud(session).delete(chat_id, user_id)
+
+        else:
+            BotStateCrud(session).save(chat_id, user_id, record['state'], record['data'])
+
+
+class DatabaseStateStorage(_StatesCache, StateStorageBase):
+    """
+    Telebot states storage in the database with a write-through in-memory LRU cache, so the state checks on every
+    message do not query the database. States survive restarts and are shared between processes, the cache stays
+    consistent while every user is served by one process at a time.
+    """
+
+    def _load(self, chat_id: int, user_id: int) -> dict | None:
+
+        is_cached, record = self._get_cached((chat_id, user_id))
+
+        if is_cached:
+            return record
+
+        with SessionLocal() as session:
+            record = self._load_record(session, chat_id, user_id)
+
+        self._remember((chat_id, user_id), record)
+
+        return record
+
+    def _save(self, chat_id: int, user_id: int, record: dict | None) -> None:
+
+        with SessionLocal() as session:
+            self._save_record(session, chat_id, user_id, record)
+
+        self._remember((chat_id, user_id), record)
+
+    def set_state(self, chat_id: int, user_id: int, state: State | str) -> bool:
+
+        if hasattr(state, 'name'):
+            state = state.name
+
+        record = self._load(chat_id, user_id)
+
+        self._save(chat_id, user_id, {'state': state, 'data': record['data'] if record else {}})
+
+        return True
+
+    def delete_state(self, chat_id: int, user_id: int) -> bool:
+
+        if self._load(chat_id, user_id) is None:
+            return False
+
+        self._save(chat_id, user_id, None)
+
+        return True
+
+    def get_state(self, chat_id: int, user_id: int) -> str | None:
+
+        record = self._load(chat_id, user_id)
+
+        return record['state'] if record else None
+
+    def get_data(self, chat_id: int, user_id: int) -> dict | None:
+
+        record = self._load(chat_id, user_id)
+
+        return record['data'] if record else None
+
+    def reset_data(self, chat_id: int, user_id: int) -> bool:
+
+        record = self._load(chat_id, user_id)
+
+        if record is None:
+            return False
+
+        self._save(chat_id, user_id, {'state': record['state'], 'data': {}})
+
+        return True
+
+    def set_data(self, chat_id: int, user_id: int, key: str, value: Any) -> bool:
+
+        record = self._load(chat_id, user_id)
+
+        if record is None:
+            raise RuntimeError(f'chat_id {chat_id} and user_id {user_id} does not exist')
+
+        self._save(chat_id, user_id, {'state': record['state'], 'data': {**record['data'], key: value}})
+
+        return True
+
+    def get_interactive_data(self, chat_id: int, user_id: int) -> StateContext:
+        return StateContext(self, chat_id, user_id)
+
+    def save(self, chat_id: int, user_id: int, data: dict) -> None:
+        self._save(chat_id, user_id, {'state': self._load(chat_id, user_id)['state'], 'data': data})
+
+
+class AsyncDatabaseStateStorage(_StatesCache, asyncio_storage.StateStorageBase):
+    """
+    The DatabaseStateStorage of the async mode (AsyncTeleBot), the records are loaded and saved by the async sessions.
+    """
+
+    async def _load(self, chat_id: int, user_id: int) -> dict | None:
+
+        is_cached, record = self._get_cached((chat_id, user_id))
+
+        if is_cached:
+            return record
+
+        async with AsyncSessionLocal() as session:
+            record = await session.run_sync(self._load_record, chat_id, user_id)
+
+        self._remember((chat_id, user_id), record)
+
+        return record
+
+    async def _save(self, chat_id: int, user_id: int, record: dict | None) -> None:
+
+        async with AsyncSessionLocal() as session:
+            await session.run_sync(self._save_record, chat_id, user_id, record)
+
+        self._remember((chat_id, user_id), record)
+
+    async def set_state(self, chat_id: int, user_id: int, state: State | str) -> bool:
+
+        if hasattr(state, 'name'):
+            state = state.name
+
+        record = await self._load(chat_id, user_id)
+
+        await self._save(chat_id, user_id, {'state': state, 'data': record['data'] if record else {}})
+
+        return True
+
+    async def delete_state(self, chat_id: int, user_id: int) -> bool:
+
+        if await self._load(chat_id, user_id) is None:
+            return False
+
+        await self._save(chat_id, user_id, None)
+
+        return True
+
+    async def get_state(self, chat_id: int, user_id: int) -> str | None:
+
+        record = await self._load(chat_id, user_id)
+
+        return record['state'] if record else None
+
+    async def get_data(self, chat_id: int, user_id: int) -> dict | None:
+
+        record = await self._load(chat_id, user_id)
+
+        return record['data'] if record else None
+
+    async def reset_data(self, chat_id: int, user_id: int) -> bool:
+
+        record = await self._load(chat_id, user_id)
+
+        if record is None:
+            return False
+
+        await self._save(chat_id, user_id, {'state': record['state'], 'data': {}})
+
+        return True
+
+    async def set_data(self, chat_id: int, user_id: int, key: str, value: Any) -> bool:
+
+        record = await self._load(chat_id, user_id)
+
+        if record is None:
+            raise RuntimeError(f'chat_id {chat_id} and user_id {user_id} does not exist')
+
+        await self._save(chat_id, user_id, {'state': record['state'], 'data': {**record['data'], key: value}})
+
+        return True
+
+    def get_interactive_data(self, chat_id: int, user_id: int) -> asyncio_storage.StateContext:
+        return asyncio_storage.StateContext(self, chat_id, user_id)
+
+    async def save(self, chat_id: int, user_id: int, data: dict) -> None:
+        await self._save(chat_id, user_id, {'state': (await self._load(chat_id, user_id))['state'], 'data': data})
@@ -5,3 +5,6 @@ class DebugStates(StatesGroup):
 
     active = State()
     inactive = State()
+    # the async mode waits for the /stt and /tts test messages by these states (AsyncTeleBot has no next step handlers)
+    waiting_stt_voice = State()
+    waiting_tts_text = State()
@@ -0,0 +1,55 @@
+from typing import Iterator, AsyncIterator
+from contextlib import contextmanager, asynccontextmanager
+
+from telebot import apihelper, asyncio_helper
+from telebot.apihelper import ApiHTTPException
+
+from services.http_client import HTTPClient, AsyncHTTPClient
+from settings import BOT_TOKEN
+
+
+class TelegramFilesDownloader:
+    """
+    Downloads telegram files by chunks without reading them into memory.
+    """
+
+    DEFAULT_FILE_URL = 'https://api.telegram.org/file/bot{0}/{1}'
+
+    def __init__(self) -> None:
+        self.http_client = HTTPClient('Telegram files')
+        self.async_http_client = AsyncHTTPClient(self.http_client)
+
+    @contextmanager
+    def open(self, file_path: str, chunk_size: int) -> Iterator[Iterator[bytes]]:
+        """
+        Return a context manager with an iterator of the file chunks, the download is done while it is iterated.
+        Raise ApiHTTPException (like TeleBot.download_file) if the file can not be downloaded.
+        """
+
+        file_url = (apihelper.FILE_URL or self.DEFAULT_FILE_URL).format(BOT_TOKEN, file_path)
+
+        with self.http_client.get(file_url, operation='download', stream=True) as response:
+
+            if response.status_code != 200:
+                raise ApiHTTPException('Download file', response)
+
+            yield response.iter_content(chunk_size)
+
+    @asynccontextmanager
+    async def open_async(self, file_path: str, chunk_size: int) -> AsyncIterator[AsyncIterator[bytes]]:
+        """
+        Like open, for the async mode. Raise asyncio_helper.ApiHTTPException (like AsyncTeleBot.download_file) if the
+        file can not be downloaded.
+        """
+
+        file_url = (asyncio_helper.FILE_URL or self.DEFAULT_FILE_URL).format(BOT_TOKEN, file_path)
+
+        async with await self.async_http_client.get(file_url, operation='download', stream=True) as response:
+
+            if response.status != 200:
+                raise asyncio_helper.ApiHTTPException('Download file', response)
+
+            yield response.content.iter_chunked(chunk_size)
+
+
+telegram_files_downloader = TelegramFilesDownloader()
@@ -1,35 +1,52 @@
 from typing import Callable, Any
+from inspect import iscoroutinefunction, isawaitable
 from functools import wraps
 
 from telebot import TeleBot
 from telebot.types import Message
+from telebot.async_telebot import AsyncTeleBot
 
 from services.stt import stt
 from services.tts import tts
 from services.gpt import gpt
 from sql.crud import UserCrud
-from sql.database import SessionLocal
+from sql.database import SessionLocal, AsyncSessionLocal
+from sql.admission import user_admission
+from sql.quotas import QuotaResource, quota_engine
+from bot_support_modules.request_context import RequestContext
 from settings import (
     REQUEST_MAX_SECOND_BLOCKS,
     REQUEST_MAX_CHARACTER_BLOCKS,
     REQUEST_MAX_TOKENS,
-    SECOND_BLOCKS_LIMIT_BY_USER,
-    CHARACTER_BLOCKS_LIMIT_BY_USER,
-    TOKENS_LIMIT_BY_USER,
     MAX_USERS_AMOUNT_LIMIT,
 )
 
 
 def validator_factory(
-        validation_function: Callable[[Message], bool], bot: TeleBot, validation_error_message: str
+        validation_function: Callable[[Message], bool], bot: TeleBot | AsyncTeleBot, validation_error_message: str
 ) -> Callable:
     """
     Return a decorator that wraps the given function with a validation function. If the validation function returns
-    False, send the validation error message to the user and DO NOT call wrapped function.
+    False, send the validation error message to the user and DO NOT call wrapped function. The coroutine functions
+    (the async mode handlers) are wrapped by a coroutine function, their validation function can be a coroutine one.
     """
 
     def validator(func: Callable) -> Callable:
 
+        if iscoroutinefunction(func):
+
+            @wraps(func)
+            async def _async_validator(message: Message, *args, **kwargs) -> Any:
+
+                is_valid = validation_function(message)
+
+                if is_valid if not isawaitable(is_valid) else await is_valid:
+                    return await func(message, *args, **kwargs)
+
+                await bot.reply_to(message, validation_error_message)
+
+            return _async_validator
+
         @wraps(func)
         def _validator(message: Message, *args, **kwargs) -> Any:
 
@@ -48,7 +65,7 @@ def validator_factory(
 
 
 def validator_factory_extended(
-        validation_function: Callable[[Message, Any], bool], bot: TeleBot, validation_error_message: str
+        validation_function: Callable[[Message, Any], bool], bot: TeleBot | AsyncTeleBot, validation_error_message: str
 ) -> Callable:
     """
     Return a decorator that wraps the given function with a validation function. If the validation function returns
@@ -58,6 +75,20 @@ def validator_factory_extended(
 
     def validator(func: Callable) -> Callable:
 
+        if iscoroutinefunction(func):
+
+            @wraps(func)
+            async def _async_validator(message: Message, *args, **kwargs) -> Any:
+
+                is_valid = validation_function(message, *args, **kwargs)
+
+                if is_valid if not isawaitable(is_valid) else await is_valid:
+                    return await func(message, *args, **kwargs)
+
+                await bot.reply_to(message, validation_error_message)
+
+            return _async_validator
+
         @wraps(func)
         def _validator(message: Message, *args, **kwargs) -> Any:
 
@@ -77,16 +108,36 @@ def validator_factory_extended(
 
 def max_users_amount_limit_validator(bot: TeleBot) -> Callable:
     """
-    If the number of users in the database is greater than MAX_USERS_AMOUNT_LIMIT, return
-    the error message and DO NOT call the target function.
+    If the user is not registered yet and the number of users in the database has already reached
+    MAX_USERS_AMOUNT_LIMIT, return the error message and DO NOT call the target function. Registered users are checked
+    by the in-process admission cache without database requests.
     """
 
-    def _validator(_) -> bool:
+    def _validator(message: Message) -> bool:
+
+        if user_admission.is_admitted(message.from_user.id):
+            return True
+
         with SessionLocal() as session:
-            return len(UserCrud(session).get_many()) <= MAX_USERS_AMOUNT_LIMIT
+            return UserCrud(session).get_or_create_within_limit(
+                MAX_USERS_AMOUNT_LIMIT, telegram_id=message.from_user.id
+            ) is not None
+
+    async def _async_validator(message: Message) -> bool:
+
+        if user_admission.is_admitted(message.from_user.id):
+            return True
+
+        # the coroutines wait for the admission here, so the admission thread lock is never contended in the event loop
+        async with user_admission.async_lock, AsyncSessionLocal() as session:
+            return await session.run_sync(lambda sync_session: UserCrud(sync_session).get_or_create_within_limit(
+                MAX_USERS_AMOUNT_LIMIT, telegram_id=message.from_user.id
+            )) is not None
 
     return validator_factory(
-        _validator, bot, 'К сожалению, в боте есть лимит на максимальное число пользователей, он превышен('
+        _async_validator if isinstance(bot, AsyncTeleBot) else _validator,
+        bot,
+        'К сожалению, в боте есть лимит на максимальное число пользователей, он превышен(',
     )
 
 
@@ -125,76 +176,142 @@ def request_tokens_limit_validator(bot: TeleBot) -> Callable:
     """
 
     def _validator(___: Message, prompt: str, *_, **__) -> Any:
-        return gpt.get_prompt_tokens_amount(prompt) <= REQUEST_MAX_TOKENS
+        return gpt.is_prompt_within_tokens_limit(prompt, REQUEST_MAX_TOKENS)
+
+    async def _async_validator(___: Message, prompt: str, *_, **__) -> Any:
+        return await gpt.is_prompt_within_tokens_limit_async(prompt, REQUEST_MAX_TOKENS)
 
     return validator_factory_extended(
-        _validator, bot, 'Вы превысили лимит токенов на сообщение, пожалуйста, сократите запрос'
+        _async_validator if isinstance(bot, AsyncTeleBot) else _validator,
+        bot,
+        'Вы превысили лимит токенов на сообщение, пожалуйста, сократите запрос',
     )
 
 
-def user_character_blocks_limit_validator(bot: TeleBot) -> Callable:
+def quota_reservation_factory(
+        resource: QuotaResource,
+        get_amount: Callable[[Message, Any], int],
+        bot: TeleBot | AsyncTeleBot,
+        validation_error_message: str,
+) -> Callable:
     """
-    If the number of characters (in blocks) in the message + user spent character blocks is greater than
-    CHARACTER_BLOCKS_LIMIT_BY_USER, return the error message and DO NOT call the target function.
+    Return a decorator that reserves the amount of the resource (get_amount gets all args and kwargs) for the user and
+    passes the reservation into the wrapped function as the quota_reservation kwarg. If the amount does not fit into
+    the user limit, send the validation error message to the user and DO NOT call wrapped function. The wrapped
+    function must settle or release the reservation, it is released automatically only if the function raises. The
+    coroutine functions get an AsyncQuotaReservation.
     """
 
-    def _validator(message: Message, prompt: str, *_, **__) -> bool:
-        with SessionLocal() as session:
+    def validator(func: Callable) -> Callable:
 
-            user = UserCrud(session).get_or_create(telegram_id=message.from_user.id)
-            message_character_blocks = tts.get_character_blocks(len(prompt))
+        if iscoroutinefunction(func):
 
-            return user.character_blocks_spent + message_character_blocks <= CHARACTER_BLOCKS_LIMIT_BY_USER
+            @wraps(func)
+            async def _async_validator(message: Message, *args, **kwargs) -> Any:
 
-    return validator_factory_extended(
-        _validator,
+                context = next(arg for arg in args if isinstance(arg, RequestContext))
+
+                quota_reservation = await quota_engine.reserve_async(
+                    context.session, context.user, resource, get_amount(message, *args, **kwargs)
+                )
+
+                if quota_reservation is None:
+
+                    await bot.reply_to(message, validation_error_message)
+
+                    return
+
+                try:
+                    return await func(message, *args, quota_reservation=quota_reservation, **kwargs)
+
+                except BaseException:  # the cancelled handler too
+
+                    await quota_reservation.release()
+
+                    raise
+
+            return _async_validator
+
+        @wraps(func)
+        def _validator(message: Message, *args, **kwargs) -> Any:
+
+            context = next(arg for arg in args if isinstance(arg, RequestContext))
+
+            quota_reservation = quota_engine.reserve(
+                context.session, context.user, resource, get_amount(message, *args, **kwargs)
+            )
+
+            if quota_reservation is None:
+
+                bot.reply_to(message, validation_error_message)
+
+                return
+
+            try:
+                return func(message, *args, quota_reservation=quota_reservation, **kwargs)
+
+            except Exception:
+
+                quota_reservation.release()
+
+                raise
+
+        return _validator
+
+    return validator
+
+
+def character_blocks_quota_validator(bot: TeleBot) -> Callable:
+    """
+    Reserve the message character blocks for the user, if the user spent and reserved character blocks + the message
+    character blocks is greater than CHARACTER_BLOCKS_LIMIT_BY_USER, return the error message and DO NOT call the target
+    function.
+    """
+
+    def _get_amount(_: Message, prompt: str, *__, **___) -> int:
+        return tts.get_request_character_blocks(prompt)
+
+    return quota_reservation_factory(
+        QuotaResource.CHARACTER_BLOCKS,
+        _get_amount,
         bot,
         'К сожалению, в боте есть лимит на максимальное число символов текстовых сообщений на пользователя,'
         ' он превышен(\nВы более не можете пользоваться этим функционалом',
     )
 
 
-def user_second_blocks_limit_validator(bot: TeleBot) -> Callable:
+def second_blocks_quota_validator(bot: TeleBot) -> Callable:
     """
-    If the duration (in blocks) of the message voice + user spent second blocks is greater than
-    SECOND_BLOCKS_LIMIT_BY_USER, return the error message and DO NOT call the target function.
+    Reserve the message voice duration (in blocks) for the user, if the user spent and reserved second blocks + the
+    message second blocks is greater than SECOND_BLOCKS_LIMIT_BY_USER, return the error message and DO NOT call
+    the target function.
     """
 
-    def _validator(message: Message) -> bool:
-        with SessionLocal() as session:
+    def _get_amount(message: Message, *_, **__) -> int:
+        return stt.get_second_blocks(message.voice.duration)
 
-            user = UserCrud(session).get_or_create(telegram_id=message.from_user.id)
-            message_second_blocks = stt.get_second_blocks(message.voice.duration)
-
-            return user.second_blocks_spent + message_second_blocks <= SECOND_BLOCKS_LIMIT_BY_USER
-
-    return validator_factory(
-        _validator,
+    return quota_reservation_factory(
+        QuotaResource.SECOND_BLOCKS,
+        _get_amount,
         bot,
         'К сожалению, в боте есть лимит на максимальное число голосовых сообщений (считается по общей длительности)'
         ' на пользователя, он превышен(\nВы более не можете пользоваться этим функционалом',
     )
 
 
-def user_tokens_limit_validator(bot: TeleBot) -> Callable:
+def tokens_quota_validator(bot: TeleBot) -> Callable:
     """
-    If the number of tokens in the message + user spent tokens is greater than
-    TOKENS_LIMIT_BY_USER, return the error message and DO NOT call the target function.
+    Reserve the message tokens (estimated locally, the real amount is settled after the request) for the user, if
+    the user spent and reserved tokens + the message tokens is greater than TOKENS_LIMIT_BY_USER, return the error
+    message and DO NOT call the target function.
     """
 
-    def _validator(message: Message, prompt, *_, **__) -> bool:
-        with SessionLocal() as session:
-
-            user_tokens_spent = UserCrud(session).get_or_create(telegram_id=message.from_user.id).tokens_spent
-
-            # prevent an extra API request if the limit is already exceeded
-            if user_tokens_spent > TOKENS_LIMIT_BY_USER:
-                return False
+    def _get_amount(_: Message, prompt: str, *__, **___) -> int:
+        return gpt.estimate_prompt_tokens_amount(prompt)
 
-            return user_tokens_spent + gpt.get_prompt_tokens_amount(prompt) <= TOKENS_LIMIT_BY_USER
-
-    return validator_factory_extended(
-        _validator,
+    return quota_reservation_factory(
+        QuotaResource.TOKENS,
+        _get_amount,
         bot,
         'К сожалению, в боте есть лимит на максимальное число токенов на пользователя,'
         ' он превышен(\nВы более не можете пользоваться этим функционалом',
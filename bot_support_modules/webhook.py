@@ -0,0 +1,214 @@
+from json import loads
+from time import monotonic
+from hmac import compare_digest
+from queue import Queue, Full
+from threading import Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from telebot import types
+
+from metrics import metrics
+from get_logger import get_logger
+from bot_support_modules.dispatcher import UserShardedTeleBot, wait_for_queue
+from settings import (
+    BOT_STOP_TIMEOUT,
+    WEBHOOK_URL,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET_TOKEN,
+    WEBHOOK_QUEUE_MAX_SIZE,
+    WEBHOOK_MAX_BODY_SIZE,
+    METRICS_PATH,
+)
+
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serve the metrics in the Prometheus text format if they are enabled.
+    """
+
+    protocol_version = 'HTTP/1.1'  # keep-alive connections with telegram and prometheus
+
+    def _answer(self, status_code: int) -> None:
+
+        self.send_response(status_code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _reject(self, status_code: int) -> None:
+        """
+        Answer without reading the request body and close the connection, else the not read body would be parsed as
+        the next keep-alive request.
+        """
+
+        self.send_response(status_code)
+        self.send_header('Connection', 'close')  # sets close_connection
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self) -> None:
+
+        if not metrics.is_enabled or self.path != METRICS_PATH:
+
+            self._reject(404)
+
+            return
+
+        metrics_data = metrics.render_prometheus().encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(metrics_data)))
+        self.end_headers()
+
+        self.wfile.write(metrics_data)
+
+    def log_message(self, *_) -> None:
+        pass  # do not log every request
+
+
+class WebhookRequestHandler(MetricsRequestHandler):
+    """
+    Accept Telegram updates, put them into the server updates queue and answer right away. If the queue is full,
+    answer 503, so Telegram retries the update later (backpressure).
+    """
+
+    server: 'WebhookServer'
+
+    def do_POST(self) -> None:
+
+        if self.path != WEBHOOK_PATH:
+
+            self._reject(404)
+
+            return
+
+        if not compare_digest(self.headers.get(SECRET_TOKEN_HEADER, ''), WEBHOOK_SECRET_TOKEN):
+
+            self._reject(403)
+
+            return
+
+        content_length = self.headers.get('Content-Length', '')
+
+        if not content_length.isdigit() or not 0 < int(content_length) <= WEBHOOK_MAX_BODY_SIZE:
+
+            self._reject(400)
+
+            return
+
+        try:
+            self.server.updates_queue.put_nowait((monotonic(), self.rfile.read(int(content_length))))
+
+        except Full:
+
+            self._answer(503)
+
+            return
+
+        self._answer(200)
+
+
+class WebhookServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, bot: UserShardedTeleBot) -> None:
+
+        super().__init__((WEBHOOK_HOST, WEBHOOK_PORT), WebhookRequestHandler)
+
+        self.bot = bot
+        self.logger = get_logger('main')
+        # the acceptance time and the update data
+        self.updates_queue: Queue[tuple[float, bytes]] = Queue(maxsize=WEBHOOK_QUEUE_MAX_SIZE)
+
+    def _dispatch_updates(self) -> None:
+        """
+        Parse the updates and pass them to the bot shards in the acceptance order. One thread does it, so the updates
+        of one user are never reordered before their shard (the parallel stage) is chosen.
+        """
+
+        while True:
+
+            acceptance_time, update_data = self.updates_queue.get()
+
+            try:
+
+                self.bot.process_new_updates([types.Update.de_json(loads(update_data))])
+
+                if metrics.is_enabled:
+                    metrics.get_histogram('bot_webhook_queue_duration_seconds').observe(monotonic() - acceptance_time)
+
+            except Exception as e:
+                self.logger.exception(f'An exception occurred while processing webhook update: {e}')
+
+            finally:
+                self.updates_queue.task_done()
+
+    def start_dispatcher(self) -> None:
+        Thread(target=self._dispatch_updates, name='webhook_dispatcher', daemon=True).start()
+
+    def wait_for_updates(self, timeout: float) -> bool:
+        """
+        Wait until the accepted updates are passed to the bot and processed by its shards, return False if they are not
+        processed in the timeout.
+        """
+
+        deadline = monotonic() + timeout
+
+        if not wait_for_queue(self.updates_queue, timeout):
+
+            self.logger.error(f'The accepted webhook updates are not processed in {timeout} seconds, they are lost')
+
+            return False
+
+        return self.bot.wait_for_shards(max(deadline - monotonic(), 0))
+
+
+def start_metrics_server(port: int = WEBHOOK_PORT) -> None:
+    """
+    Serve the metrics on WEBHOOK_HOST:port in a background thread (for the runtime modes without the webhook).
+    """
+
+    server = ThreadingHTTPServer((WEBHOOK_HOST, port), MetricsRequestHandler)
+
+    server.daemon_threads = True
+
+    Thread(target=server.serve_forever, name='metrics_server', daemon=True).start()
+
+    get_logger('main').info('Metrics server started')
+
+
+def run_webhook(bot: UserShardedTeleBot) -> None:
+    """
+    Register the webhook and serve Telegram updates, they are passed to the bot shards (processed by BOT_WORKERS_AMOUNT
+    threads) in the acceptance order. On the stop, the server stops accepting updates (Telegram retries them later)
+    and the accepted ones are processed.
+    """
+
+    if not WEBHOOK_URL or not WEBHOOK_SECRET_TOKEN:
+        raise ValueError('WEBHOOK_URL and WEBHOOK_SECRET_TOKEN must be set to run the bot in the webhook mode')
+
+    server = WebhookServer(bot)
+
+    server.start_dispatcher()
+
+    bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET_TOKEN)
+
+    get_logger('main').info('Webhook server started')
+
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        get_logger('main').info('Webhook server stopped')
+
+    finally:
+
+        server.server_close()
+
+        server.wait_for_updates(BOT_STOP_TIMEOUT)
@@ -4,4 +4,5 @@ PURPLE='\033[0;35m'
 NO_COLOR='\033[0m'
 
 echo "${PURPLE}Launching the bot${NO_COLOR}"
-python main.py
+# the bot replaces the shell, so it receives SIGTERM on docker stop
+exec python main.py
@@ -1,7 +1,67 @@
-from logging import getLogger
+import atexit
+from copy import copy
+from json import dumps
+from queue import SimpleQueue
+from multiprocessing.queues import Queue
+from contextvars import ContextVar
+from logging import getLogger, Filter, Formatter, Logger, LogRecord
 from logging.config import dictConfig
+from logging.handlers import QueueHandler, QueueListener
 
-from settings import WARNING_LOG_FILE_PATH, INFO_LOG_FILE_PATH
+from settings import (
+    WARNING_LOG_FILE_PATH,
+    INFO_LOG_FILE_PATH,
+    LOGS_MAX_FILE_SIZE,
+    LOGS_BACKUP_COUNT,
+    LOGS_QUEUE_ENABLED,
+    LOGS_FORMAT,
+)
+
+
+# the id of the processed message, it is added to all records logged while the message is processed
+request_id_var: ContextVar[str | None] = ContextVar('request_id', default=None)
+
+
+class RequestIdFilter(Filter):
+    def filter(self, record: LogRecord) -> bool:
+
+        record.request_id = request_id_var.get()
+
+        return True
+
+
+class JSONLinesFormatter(Formatter):
+    """
+    Formats a record into one JSON line. The request_id, service_name and latency fields are added if they are set
+    (service_name and latency are passed by "extra").
+    """
+
+    EXTRA_FIELDS = ('request_id', 'service_name', 'latency')
+
+    def format(self, record: LogRecord) -> str:
+
+        record_json = {
+            'level': record.levelname,
+            'time': self.formatTime(record),
+            'path': record.pathname,
+            'function': record.funcName,
+            'message': record.getMessage(),
+        }
+
+        for field_name in self.EXTRA_FIELDS:
+
+            field_value = getattr(record, field_name, None)
+
+            if field_value is not None:
+                record_json[field_name] = field_value
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+
+        if record.exc_text:  # the records from the queue have only the formatted exception
+            record_json['exception'] = record.exc_text
+
+        return dumps(record_json, ensure_ascii=False)
 
 
 dictConfig({
@@ -16,6 +76,14 @@ dictConfig({
             'format': '[{levelname}] [{asctime}] message - "{message}"',
             'style': '{',
         },
+        'json': {
+            '()': JSONLinesFormatter,
+        },
+    },
+    'filters': {
+        'request_id': {
+            '()': RequestIdFilter,
+        },
     },
     'handlers': {
         'console': {
@@ -26,28 +94,107 @@ dictConfig({
         'file_warning': {
             'level': 'WARNING',
             'class': 'logging.handlers.RotatingFileHandler',
-            'formatter': 'main',
+            'formatter': 'json' if LOGS_FORMAT == 'json' else 'main',
             'filename': WARNING_LOG_FILE_PATH,
-            'maxBytes': 1024 * 1024 * 10,  # 10 Mb
+            'maxBytes': LOGS_MAX_FILE_SIZE,
+            'backupCount': LOGS_BACKUP_COUNT,
             'encoding': 'utf-8',
         },
         'file_info': {
             'level': 'INFO',
             'class': 'logging.handlers.RotatingFileHandler',
-            'formatter': 'main',
+            'formatter': 'json' if LOGS_FORMAT == 'json' else 'main',
             'filename': INFO_LOG_FILE_PATH,
-            'maxBytes': 1024 * 1024 * 10,  # 10 Mb
+            'maxBytes': LOGS_MAX_FILE_SIZE,
+            'backupCount': LOGS_BACKUP_COUNT,
             'encoding': 'utf-8',
         },
     },
     'loggers': {
         'main': {
             'handlers': ['console', 'file_warning', 'file_info'],
+            'filters': ['request_id'],  # the logger filters run in the logging thread, so the context var is visible
             'level': 'INFO',
         },
     },
 })
 
 
+class ExceptionKeepingQueueHandler(QueueHandler):
+    """
+    The standard queue handler merges the exception traceback into the record message and drops the exception, so the
+    listener handlers formatters can not format it (the JSON lines "exception" field). This one formats the message
+    arguments and the exception into the record text fields, so the record can be pickled for the process queue too.
+    """
+
+    exception_formatter = Formatter()
+
+    def prepare(self, record: LogRecord) -> LogRecord:
+
+        record = copy(record)
+
+        record.msg = record.getMessage()
+        record.args = None
+
+        if record.exc_info:
+
+            record.exc_text = record.exc_text or self.exception_formatter.formatException(record.exc_info)
+            record.exc_info = None  # the traceback can not be pickled
+
+        return record
+
+
+def _move_handlers_to_queue(logger: Logger) -> None:
+    """
+    Replace the logger handlers with a queue handler, the logging threads only put the records into the queue and
+    the records are formatted and written by the listener thread.
+    """
+
+    logs_queue = SimpleQueue()
+    listener = QueueListener(logs_queue, *logger.handlers, respect_handler_level=True)
+
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+
+    logger.addHandler(ExceptionKeepingQueueHandler(logs_queue))
+
+    listener.start()
+
+    atexit.register(listener.stop)  # write the records left in the queue
+
+
+if LOGS_QUEUE_ENABLED:
+    _move_handlers_to_queue(getLogger('main'))
+
+
+def send_records_to_process_queue(logs_queue: Queue) -> None:
+    """
+    Replace the main logger handlers with a handler putting the records into the multiprocessing queue, so the records
+    of a worker process are written by the parent process (the files are rotated by one process).
+    """
+
+    logger = getLogger('main')
+
+    for handler in logger.handlers[:]:
+
+        logger.removeHandler(handler)
+
+        handler.close()
+
+    logger.addHandler(ExceptionKeepingQueueHandler(logs_queue))
+
+
+def listen_process_queue(logs_queue: Queue) -> QueueListener:
+    """
+    Start writing the records from the multiprocessing queue by the main logger handlers, return the started listener.
+    """
+
+    listener = QueueListener(logs_queue, *getLogger('main').handlers, respect_handler_level=True)
+
+    listener.start()
+
+    return listener
+
+
 def get_logger(name):
     return getLogger(name)
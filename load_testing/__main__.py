@@ -0,0 +1,385 @@
+"""
+Offline load test: the bot (main.py) is run as a subprocess against the local stand-ins of the Telegram Bot API and
+the Yandex Cloud APIs, the workload is driven through the fake getUpdates (or posted to the bot webhook in the webhook
+mode). Linux is required (the peak RSS is read from /proc). Usage example:
+
+    python -m load_testing --workload voice-heavy --latency gpt=0.8:0.3 --error-rate tts=0.01
+    python -m load_testing --workload many-users --workers 4
+    python -m load_testing --workload many-users --runtime-mode webhook
+    python -m load_testing --workload many-users --runtime-mode async
+"""
+
+import os
+import sys
+import signal
+import socket
+import subprocess
+from time import sleep
+from pathlib import Path
+from threading import Thread
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from urllib.request import urlopen
+from statistics import quantiles
+
+from load_testing.fake_services import FakeServicesServer, ServiceBehavior
+from load_testing.workloads import WORKLOADS, Workload, WorkloadRun
+
+
+PROJECT_DIR = Path(__file__).resolve().parent.parent
+SERVICES_NAMES = ('telegram', 'gpt', 'tokenize', 'tts', 'stt')
+DEFAULT_BEHAVIORS = {
+    'telegram': ServiceBehavior(0.02, 0.3),
+    'gpt': ServiceBehavior(0.5, 0.4),
+    'tokenize': ServiceBehavior(0.05, 0.3),
+    'tts': ServiceBehavior(0.3, 0.3),
+    'stt': ServiceBehavior(0.3, 0.3),
+}
+ERROR_MESSAGE = 'Произошла ошибка, пожалуйста, повторите попытку или обратитесь в поддержку'
+UNLIMITED = str(10 ** 9)
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_SECRET_TOKEN = 'load-test'
+WEBHOOK_QUEUE_HISTOGRAM_NAME = 'bot_webhook_queue_duration_seconds'
+
+
+def get_free_ports(amount: int) -> list[int]:
+    """
+    Return the consecutive free ports (the bot processes serve the metrics on the consecutive ports).
+    """
+
+    while True:
+
+        with socket.socket() as free_socket:
+
+            free_socket.bind(('127.0.0.1', 0))
+
+            first_port = free_socket.getsockname()[1]
+
+        try:
+            for port in range(first_port, first_port + amount):
+                with socket.socket() as free_socket:
+                    free_socket.bind(('127.0.0.1', port))
+
+        except OSError:
+            continue
+
+        return list(range(first_port, first_port + amount))
+
+
+def parse_arguments():
+
+    parser = ArgumentParser(prog='python -m load_testing', description='Offline load test of the bot')
+
+    parser.add_argument('--workload', choices=WORKLOADS, default='text-heavy')
+    parser.add_argument('--users', type=int, help='override the workload users amount')
+    parser.add_argument('--messages', type=int, help='override the workload messages per user')
+    parser.add_argument('--voice-share', type=float, help='override the workload voice messages fraction')
+    parser.add_argument('--runtime-mode', choices=('threaded', 'webhook', 'async'), default='threaded')
+    parser.add_argument('--workers', type=int, help='run the bot in the multiprocess mode with the workers amount')
+    parser.add_argument('--db-url', help='the database of the bot, a temporary SQLite database by default')
+    parser.add_argument(
+        '--latency',
+        action='append',
+        default=[],
+        metavar='SERVICE=MEDIAN[:SIGMA]',
+        help=f'log-normal latency (in seconds) of a fake service, services: {", ".join(SERVICES_NAMES)}',
+    )
+    parser.add_argument('--error-rate', action='append', default=[], metavar='SERVICE=RATE')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='a bot setting')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for the workload')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--logs-dir', type=Path, help='keep the bot output and logs in the directory')
+
+    return parser.parse_args()
+
+
+def get_behaviors(latencies: list[str], error_rates: list[str]) -> dict[str, ServiceBehavior]:
+
+    behaviors = {name: ServiceBehavior(**vars(behavior)) for name, behavior in DEFAULT_BEHAVIORS.items()}
+
+    for latency in latencies:
+
+        service_name, latency_value = latency.split('=')
+        median, _, sigma = latency_value.partition(':')
+
+        behaviors[service_name].latency_median = float(median)
+        behaviors[service_name].latency_sigma = float(sigma or 0)
+
+    for error_rate in error_rates:
+
+        service_name, rate = error_rate.split('=')
+
+        behaviors[service_name].error_rate = float(rate)
+
+    return behaviors
+
+
+def get_bot_environment(
+        arguments, server: FakeServicesServer, temporary_dir: Path, logs_dir: Path, metrics_port: int
+) -> dict:
+
+    environment = {
+        **os.environ,
+        'BOT_RUNTIME_MODE': 'multiprocess' if arguments.workers else arguments.runtime_mode,
+        'MULTIPROCESS_RUNTIME_WORKERS_AMOUNT': str(arguments.workers or 1),
+        'TELEGRAM_API_URL': server.url,
+        'TTS_URL': f'{server.url}/tts',
+        'STT_URL': f'{server.url}/stt',
+        'GPT_URL': f'{server.url}/gpt/completion',
+        'GPT_TOKENIZE_URL': f'{server.url}/gpt/tokenize',
+        'DB_URL': arguments.db_url or f'sqlite:///{temporary_dir / "bot.db"}',
+        'BOT_TOKEN': '123456:load-test',
+        'STT_API_KEY': 'key',
+        'STT_FOLDER_ID': 'folder',
+        'TTS_API_KEY': 'key',
+        'TTS_FOLDER_ID': 'folder',
+        'GPT_API_KEY': 'key',
+        'GPT_FOLDER_ID': 'folder',
+        'DEBUG_USER_ID': '1',
+        'WARNING_LOG_FILE_PATH': str(logs_dir / 'warning.log'),
+        'INFO_LOG_FILE_PATH': str(logs_dir / 'info.log'),
+        'METRICS_ENABLED': 'true',
+        'WEBHOOK_HOST': '127.0.0.1',
+        'WEBHOOK_PORT': str(metrics_port),
+        'WEBHOOK_URL': f'https://example.com{WEBHOOK_PATH}',  # the fake setWebhook does not call it
+        'WEBHOOK_PATH': WEBHOOK_PATH,
+        'WEBHOOK_SECRET_TOKEN': WEBHOOK_SECRET_TOKEN,
+        'MAX_USERS_AMOUNT_LIMIT': UNLIMITED,
+        'TOKENS_LIMIT_BY_USER': UNLIMITED,
+        'CHARACTER_BLOCKS_LIMIT_BY_USER': UNLIMITED,
+        'SECOND_BLOCKS_LIMIT_BY_USER': UNLIMITED,
+        'USER_FRIENDLY_REQUEST_ERROR_MESSAGE': ERROR_MESSAGE,
+    }
+
+    for variable in arguments.env:
+
+        name, value = variable.split('=', 1)
+
+        environment[name] = value
+
+    return environment
+
+
+def get_peak_rss(pid: int) -> int:
+    """
+    Return the sum of the peak resident set sizes of the process and its child processes in bytes.
+    """
+
+    peak_rss = 0
+
+    for line in Path(f'/proc/{pid}/status').read_text().splitlines():
+        if line.startswith('VmHWM:'):
+            peak_rss = int(line.split()[1]) * 1024
+
+    for children_file in Path(f'/proc/{pid}/task').glob('*/children'):
+        for child_pid in children_file.read_text().split():
+            peak_rss += get_peak_rss(int(child_pid))
+
+    return peak_rss
+
+
+def get_metrics_counts(metrics_ports: list[int]) -> dict[str, int]:
+    """
+    Return the requests amounts of the bot histograms (summed over the labels and the processes) from its metrics
+    endpoints. The cumulative buckets counts of the webhook queue histogram are returned by the "<name>:<le>" keys.
+    """
+
+    counts = {}
+
+    for metrics_port in metrics_ports:
+        with urlopen(f'http://127.0.0.1:{metrics_port}/metrics', timeout=5) as response:
+            for line in response.read().decode().splitlines():
+
+                if line.startswith('#'):
+                    continue
+
+                series, value = line.rsplit(' ', 1)
+                name = series.split('{', 1)[0]
+
+                if name.endswith('_count'):
+                    counts[name] = counts.get(name, 0) + int(float(value))
+
+                elif name == f'{WEBHOOK_QUEUE_HISTOGRAM_NAME}_bucket':
+
+                    bucket_bound = series.rsplit('le="', 1)[1].removesuffix('"}')
+                    bucket_name = f'{name}:{bucket_bound}'
+
+                    counts[bucket_name] = counts.get(bucket_name, 0) + int(float(value))
+
+    return counts
+
+
+def wait_for_metrics_counts(metrics_ports: list[int], bot_process: subprocess.Popen, output_path: Path) -> dict:
+    """
+    Wait until the bot processes serve the metrics (the worker processes start after the polling), return them.
+    """
+
+    while True:
+
+        if bot_process.poll() is not None:
+            sys.exit(f'The bot has exited:\n{output_path.read_text()}')
+
+        try:
+            return get_metrics_counts(metrics_ports)
+
+        except OSError:
+            sleep(0.1)
+
+
+def format_latencies(latencies: list[float]) -> str:
+
+    if len(latencies) < 2:
+        return 'no data' if not latencies else f'{latencies[0] * 1000:.0f} ms'
+
+    percentiles = quantiles(latencies, n=100, method='inclusive')
+
+    return (
+        f'p50 {percentiles[49] * 1000:.0f} ms, p95 {percentiles[94] * 1000:.0f} ms, '
+        f'p99 {percentiles[98] * 1000:.0f} ms, max {max(latencies) * 1000:.0f} ms'
+    )
+
+
+def format_buckets_quantiles(metrics_counts: dict[str, int], histogram_name: str) -> str:
+    """
+    Return the quantiles estimates of the histogram by its cumulative buckets counts: the upper bounds of the buckets
+    the quantiles fall into.
+    """
+
+    buckets = sorted(
+        (float(name.rsplit(':', 1)[1]), count)
+        for name, count in metrics_counts.items() if name.startswith(f'{histogram_name}_bucket:')
+    )
+
+    if not buckets or not buckets[-1][1]:
+        return 'no data'
+
+    quantiles_texts = []
+
+    for quantile in (0.5, 0.95, 0.99):
+
+        bucket_bound = next(bound for bound, count in buckets if count >= quantile * buckets[-1][1])
+
+        quantiles_texts.append(
+            f'p{int(quantile * 100)} <= {bucket_bound * 1000:g} ms' if bucket_bound != float('inf') else
+            f'p{int(quantile * 100)} > {buckets[-2][0] * 1000:g} ms'
+        )
+
+    return ', '.join(quantiles_texts)
+
+
+def print_report(
+        workload_run: WorkloadRun, server: FakeServicesServer, metrics_counts: dict[str, int], peak_rss: int
+) -> None:
+
+    workload = workload_run.workload
+    duration = (workload_run.finish_time or workload_run.start_time) - workload_run.start_time
+    messages_amount = workload_run.messages_amount
+    updates_amount = messages_amount + workload.users_amount  # with /start
+    db_queries_amount = metrics_counts.get('bot_db_query_duration_seconds_count', 0)
+
+    print(f'Users: {workload.users_amount}, messages: {messages_amount} of '
+          f'{workload.users_amount * workload.messages_per_user} (voice share {workload.voice_share})')
+    print(f'Duration: {duration:.1f} s, {updates_amount / duration:.1f} updates/s' if duration else 'Not finished')
+    print(f'Latency (text): {format_latencies(workload_run.latencies["text"])}')
+    print(f'Latency (voice): {format_latencies(workload_run.latencies["voice"])}')
+    print(f'Error replies: {workload_run.error_replies_amount}, extra replies: {workload_run.extra_replies_amount}')
+    print(
+        f'DB queries: {db_queries_amount} ({db_queries_amount / max(updates_amount, 1):.1f} per update), '
+        f'commits: {metrics_counts.get("bot_db_commit_duration_seconds_count", 0)}'
+    )
+
+    if f'{WEBHOOK_QUEUE_HISTOGRAM_NAME}_count' in metrics_counts:
+        print(f'Webhook queue latency: {format_buckets_quantiles(metrics_counts, WEBHOOK_QUEUE_HISTOGRAM_NAME)}')
+
+    print(f'Peak RSS: {peak_rss / 1024 / 1024:.1f} MB')
+    print('Fake services requests: ' + ', '.join(
+        f'{name} {amount}' for name, amount in sorted(server.requests_counter.items())
+    ))
+
+
+def main() -> None:
+
+    arguments = parse_arguments()
+
+    if arguments.workers and arguments.runtime_mode != 'threaded':
+        sys.exit('--workers runs the bot in the multiprocess mode, it can not be combined with --runtime-mode')
+
+    workload = WORKLOADS[arguments.workload]
+    workload = Workload(
+        arguments.users or workload.users_amount,
+        arguments.messages or workload.messages_per_user,
+        workload.voice_share if arguments.voice_share is None else arguments.voice_share,
+    )
+
+    workload_run = WorkloadRun(workload, ERROR_MESSAGE, arguments.seed)
+    server = FakeServicesServer(
+        get_behaviors(arguments.latency, arguments.error_rate), workload_run.on_reply, seed=arguments.seed
+    )
+
+    Thread(target=server.serve_forever, name='fake_services', daemon=True).start()
+
+    with TemporaryDirectory() as temporary_dir:
+
+        logs_dir = arguments.logs_dir or Path(temporary_dir)
+        metrics_ports = get_free_ports(arguments.workers or 1)
+        bot_output_path = logs_dir / 'bot_output.log'
+
+        logs_dir.mkdir(parents=True, exist_ok=True)
+
+        with open(bot_output_path, 'wb') as bot_output:
+            bot_process = subprocess.Popen(
+                [sys.executable, 'main.py'],
+                cwd=PROJECT_DIR,
+                env=get_bot_environment(arguments, server, Path(temporary_dir), logs_dir, metrics_ports[0]),
+                stdout=bot_output,
+                stderr=subprocess.STDOUT,
+            )
+
+        try:
+
+            # the bot is started
+            while not server.requests_counter['setWebhook' if arguments.runtime_mode == 'webhook' else 'getUpdates']:
+
+                if bot_process.poll() is not None:
+                    sys.exit(f'The bot has exited:\n{bot_output_path.read_text()}')
+
+                sleep(0.1)
+
+            # the startup queries are not counted
+            initial_metrics_counts = wait_for_metrics_counts(metrics_ports, bot_process, bot_output_path)
+
+            if arguments.runtime_mode == 'webhook':  # the webhook server serves the metrics, so it is started
+                Thread(
+                    target=server.deliver_to_webhook,
+                    args=('127.0.0.1', metrics_ports[0], WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN),
+                    name='webhook_delivery',
+                    daemon=True,
+                ).start()
+
+            workload_run.start(server)
+
+            if not workload_run.finished.wait(arguments.timeout):
+                print(f'The workload is not finished in {arguments.timeout} seconds')
+
+            metrics_counts = {
+                name: count - initial_metrics_counts.get(name, 0)
+                for name, count in get_metrics_counts(metrics_ports).items()
+            }
+
+            print_report(workload_run, server, metrics_counts, get_peak_rss(bot_process.pid))
+
+        finally:
+
+            bot_process.send_signal(signal.SIGINT)
+
+            try:
+                bot_process.wait(40)  # the workers finish the queued updates
+
+            except subprocess.TimeoutExpired:
+                bot_process.kill()
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Micro-benchmarks of the separate bot components, run as modules, for example:
+
+    python -m load_testing.benchmarks.tokens_estimate --records tokens.jsonl
+
+The settings are read on the import, so prepare_environment() is called before the project modules are imported. The
+variables set in the environment are kept (for example, the real API keys to record the tokenizer output).
+"""
+
+import os
+from logging import getLogger, WARNING
+from pathlib import Path
+from tempfile import mkdtemp
+from statistics import quantiles
+
+
+def prepare_environment() -> Path:
+    """
+    Set the required settings (a temporary SQLite database and logs), return the temporary directory.
+    """
+
+    temporary_dir = Path(mkdtemp(prefix='bot_benchmark_'))
+
+    for name, value in {
+        'DB_URL': f'sqlite:///{temporary_dir / "bot.db"}',
+        'BOT_TOKEN': '123456:benchmark',
+        'STT_API_KEY': 'key',
+        'STT_FOLDER_ID': 'folder',
+        'TTS_API_KEY': 'key',
+        'TTS_FOLDER_ID': 'folder',
+        'GPT_API_KEY': 'key',
+        'GPT_FOLDER_ID': 'folder',
+        'DEBUG_USER_ID': '1',
+        'LOGS_DIR': str(temporary_dir / 'logs'),
+        'WARNING_LOG_FILE_PATH': str(temporary_dir / 'warning.log'),
+        'INFO_LOG_FILE_PATH': str(temporary_dir / 'info.log'),
+        'TTS_CACHE_DIR': str(temporary_dir / 'tts_cache'),
+    }.items():
+        os.environ.setdefault(name, value)
+
+    return temporary_dir
+
+
+def format_durations(durations: list[float], unit: str = 'ms') -> str:
+    """
+    Return the percentiles of the durations (in seconds) in the unit: "ms" or "us".
+    """
+
+    scale = {'ms': 10 ** 3, 'us': 10 ** 6}[unit]
+    percentiles = quantiles(durations, n=100, method='inclusive') if len(durations) > 1 else durations * 99
+
+    return (
+        f'p50 {percentiles[49] * scale:.2f} {unit}, p95 {percentiles[94] * scale:.2f} {unit}, '
+        f'p99 {percentiles[98] * scale:.2f} {unit}'
+    )
+
+
+def silence_console_logs() -> None:
+    """
+    Keep only the warnings and errors of the bot in the console, so the report is readable.
+    """
+
+    for handler in getLogger('main').handlers:
+        if handler.name == 'console':
+            handler.setLevel(WARNING)
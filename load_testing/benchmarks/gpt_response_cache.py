@@ -0,0 +1,165 @@
+"""
+Replay of a recorded prompt log through GPT.ask with and without the response cache against the stub GPT server. The
+log is JSON lines with "user_id" and "text" (or plain text lines of one user), the history of every user is replayed
+too, so the keys depend on it like in the bot. Without --log a synthetic support conversations log is replayed. Usage
+example:
+
+    python -m load_testing.benchmarks.gpt_response_cache --log prompts.jsonl --gpt-latency 0.5
+"""
+
+from json import loads
+from time import perf_counter
+from random import Random
+from pathlib import Path
+from threading import Thread
+from argparse import ArgumentParser
+
+from load_testing.fake_services import FakeServicesServer, ServiceBehavior
+from load_testing.benchmarks import prepare_environment, format_durations, silence_console_logs
+
+prepare_environment()
+
+from services import gpt as gpt_module  # noqa: E402
+from services.gpt import GPT  # noqa: E402
+from services.gpt_cache import GPTResponseCache  # noqa: E402
+from sql.models import UserMessage  # noqa: E402
+from sql.model_enums import RolesEnum  # noqa: E402
+from settings import (  # noqa: E402
+    GPT_HISTORY_MESSAGES_AMOUNT,
+    GPT_RESPONSE_CACHE_MAX_ITEMS,
+    GPT_RESPONSE_CACHE_TTL,
+    GPT_RESPONSE_CACHE_VARIANTS_AMOUNT,
+    GPT_RESPONSE_CACHE_HISTORY_MESSAGES_AMOUNT,
+    GPT_RESPONSE_CACHE_MAX_PROMPT_LENGTH,
+)
+
+
+OPENING_PROMPTS = ('Привет', 'привет!', 'Привет!!', 'Здравствуй', 'Добрый вечер', 'Мне грустно', 'мне грустно...')
+FOLLOWING_PROMPTS = (
+    'Спасибо', 'спасибо!', 'Мне одиноко', 'Я устал', 'Что мне делать?', 'Расскажи что-нибудь хорошее',
+    'У меня сегодня был тяжёлый день на работе, начальник опять накричал', 'Пока',
+)
+
+
+def parse_arguments():
+
+    parser = ArgumentParser(prog='python -m load_testing.benchmarks.gpt_response_cache')
+
+    parser.add_argument('--log', type=Path, help='the recorded prompts, a synthetic log by default')
+    parser.add_argument('--users', type=int, default=200, help='users of the synthetic log')
+    parser.add_argument('--messages', type=int, default=5, help='messages of every user of the synthetic log')
+    parser.add_argument('--gpt-latency', type=float, default=0.5, help='seconds, the median of the stub GPT')
+    parser.add_argument('--seed', type=int, default=0)
+
+    return parser.parse_args()
+
+
+def get_synthetic_log(users_amount: int, messages_amount: int, random: Random) -> list[tuple[int, str]]:
+    """
+    Return the users prompts interleaved, every conversation starts with a greeting or a complaint.
+    """
+
+    conversations = [
+        [random.choice(OPENING_PROMPTS), *random.choices(FOLLOWING_PROMPTS, k=messages_amount - 1)]
+        for _ in range(users_amount)
+    ]
+
+    return [
+        (user_id, conversation[message_number])
+        for message_number in range(messages_amount) for user_id, conversation in enumerate(conversations)
+    ]
+
+
+def read_log(log_path: Path) -> list[tuple[int, str]]:
+
+    log = []
+
+    for line in log_path.read_text(encoding='utf-8').splitlines():
+
+        if not line.strip():
+            continue
+
+        if line.startswith('{'):
+
+            record = loads(line)
+
+            log.append((record['user_id'], record['text']))
+
+        else:
+            log.append((0, line))
+
+    return log
+
+
+def replay(gpt: GPT, log: list[tuple[int, str]]) -> list[float]:
+
+    histories: dict[int, list[UserMessage]] = {}
+    durations = []
+
+    for user_id, prompt in log:
+
+        history = histories.setdefault(user_id, [])
+
+        start_time = perf_counter()
+
+        answer, tokens_spent = gpt.ask(prompt, history[-GPT_HISTORY_MESSAGES_AMOUNT:])
+
+        durations.append(perf_counter() - start_time)
+
+        if tokens_spent is None:
+            raise RuntimeError('The GPT request has failed, see the logs')
+
+        history += [
+            UserMessage(user_id=user_id, text=prompt, role=RolesEnum.USER),
+            UserMessage(user_id=user_id, text=answer, role=RolesEnum.ASSISTANT),
+        ]
+
+    return durations
+
+
+def main() -> None:
+
+    arguments = parse_arguments()
+
+    silence_console_logs()
+
+    server = FakeServicesServer({'gpt': ServiceBehavior(arguments.gpt_latency, 0.3)}, lambda *_: None)
+
+    Thread(target=server.serve_forever, name='fake_services', daemon=True).start()
+
+    gpt_module.GPT_URL = f'{server.url}/gpt/completion'  # the stub port is known after the settings are loaded
+
+    random = Random(arguments.seed)
+    log = read_log(arguments.log) if arguments.log else get_synthetic_log(arguments.users, arguments.messages, random)
+    gpt = GPT()
+
+    print(f'Prompts: {len(log)}, users: {len({user_id for user_id, _ in log})}')
+
+    for name, response_cache in (
+        ('Without the cache', None),
+        ('With the cache', GPTResponseCache(
+            GPT_RESPONSE_CACHE_MAX_ITEMS,
+            GPT_RESPONSE_CACHE_TTL,
+            GPT_RESPONSE_CACHE_VARIANTS_AMOUNT,
+            GPT_RESPONSE_CACHE_HISTORY_MESSAGES_AMOUNT,
+            GPT_RESPONSE_CACHE_MAX_PROMPT_LENGTH,
+        )),
+    ):
+
+        gpt.response_cache = response_cache
+        server.requests_counter.clear()
+
+        durations = replay(gpt, log)
+
+        print(f'{name}: {format_durations(durations)}, total {sum(durations):.1f} s, '
+              f'completion requests {server.requests_counter["gpt"]}')
+
+        if response_cache is not None:
+            print(f'  Hit rate {response_cache.hit_rate:.0%}, hits {response_cache.hits}, '
+                  f'misses {response_cache.misses} (variants amount {GPT_RESPONSE_CACHE_VARIANTS_AMOUNT})')
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
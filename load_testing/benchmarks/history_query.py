@@ -0,0 +1,110 @@
+"""
+Latency of the GPT history loading for the users with long histories: the indexed LIMIT query of the last messages
+against the whole history loaded by the relationship (the history before the LIMIT query). Usage example:
+
+    python -m load_testing.benchmarks.history_query --users 3 --messages 100000
+"""
+
+from time import perf_counter
+from argparse import ArgumentParser
+
+from load_testing.benchmarks import prepare_environment, format_durations
+
+prepare_environment()
+
+from sqlalchemy import text  # noqa: E402
+
+from sql.crud import UserCrud, UserMessageCrud  # noqa: E402
+from sql.models import User, UserMessage  # noqa: E402
+from sql.model_enums import RolesEnum  # noqa: E402
+from sql.database import Base, engine, SessionLocal  # noqa: E402
+from settings import GPT_HISTORY_MESSAGES_AMOUNT  # noqa: E402
+
+
+INSERT_BATCH_SIZE = 10000
+
+
+def parse_arguments():
+
+    parser = ArgumentParser(prog='python -m load_testing.benchmarks.history_query')
+
+    parser.add_argument('--users', type=int, default=3, help='the messages of the users are interleaved')
+    parser.add_argument('--messages', type=int, default=100000, help='messages of every user')
+    parser.add_argument('--queries', type=int, default=100)
+
+    return parser.parse_args()
+
+
+def create_messages(users_amount: int, messages_amount: int) -> list[int]:
+    """
+    Return the users ids.
+    """
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+
+    with SessionLocal() as session:
+
+        users_ids = [UserCrud(session).create(telegram_id=telegram_id).id for telegram_id in range(users_amount)]
+        rows = (
+            {'user_id': user_id, 'role': RolesEnum.USER, 'text': f'Сообщение {message_number}'}
+            for message_number in range(messages_amount) for user_id in users_ids
+        )
+
+        while batch := [row for _, row in zip(range(INSERT_BATCH_SIZE), rows)]:
+            UserMessageCrud(session).bulk_create(batch)
+
+    return users_ids
+
+
+def load_last_messages(user_id: int) -> list[UserMessage]:
+    with SessionLocal() as session:
+        return UserMessageCrud(session).get_history(user_id, GPT_HISTORY_MESSAGES_AMOUNT)
+
+
+def load_whole_history(user_id: int) -> list[UserMessage]:
+    with SessionLocal() as session:
+        return session.get(User, user_id).messages[:GPT_HISTORY_MESSAGES_AMOUNT]
+
+
+def measure(load_messages, users_ids: list[int], queries_amount: int) -> list[float]:
+
+    durations = []
+
+    for query_number in range(queries_amount):
+
+        start_time = perf_counter()
+
+        load_messages(users_ids[query_number % len(users_ids)])
+
+        durations.append(perf_counter() - start_time)
+
+    return durations
+
+
+def main() -> None:
+
+    arguments = parse_arguments()
+
+    users_ids = create_messages(arguments.users, arguments.messages)
+
+    with SessionLocal() as session:
+
+        last_messages = UserMessageCrud(session).get_history(users_ids[0], GPT_HISTORY_MESSAGES_AMOUNT)
+
+        if engine.dialect.name == 'sqlite':
+
+            query_plan = session.execute(text(
+                'EXPLAIN QUERY PLAN SELECT * FROM user_messages WHERE user_id = :user_id ORDER BY id DESC LIMIT 10'
+            ), {'user_id': users_ids[0]}).all()
+
+            print(f'Query plan: {"; ".join(row[-1] for row in query_plan)}')
+
+    print(f'Users: {arguments.users}, messages of every user: {arguments.messages}, '
+          f'the last loaded message: "{last_messages[-1].text}"')
+    print(f'LIMIT query: {format_durations(measure(load_last_messages, users_ids, arguments.queries))}')
+    print(f'Whole history: {format_durations(measure(load_whole_history, users_ids, max(arguments.queries // 10, 1)))}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Peak memory and latency of the logs export on a big synthetic log (the current file and a rotated backup, a part of
+the records are multi-line errors): the last records, the filtered ones, a substring without matches (the whole log is
+scanned) and the whole current file read (the export before the tail reading). Every case is run in its own process,
+so its peak RSS is not shared with the log generation and the other cases. Usage example:
+
+    python -m load_testing.benchmarks.log_export --size 100 --segments 2
+"""
+
+import sys
+from json import dumps, loads
+from time import perf_counter
+from random import Random
+from pathlib import Path
+from resource import getrusage, RUSAGE_SELF
+from subprocess import run
+from argparse import ArgumentParser, SUPPRESS
+
+from load_testing.benchmarks import prepare_environment
+
+temporary_dir = prepare_environment()
+
+from bot_support_modules.log_export import export_logs  # noqa: E402
+
+
+CASES = {
+    'last 1000 records': (1000, None),
+    'last 100000 records': (100000, None),
+    'last 1000 "[ERROR]" records': (1000, '[ERROR]'),
+    'no match (the whole log is scanned)': (1000, 'no such substring'),
+    'whole current file read': (None, None),
+}
+ERROR_RECORDS_SHARE = 0.02
+
+
+def parse_arguments():
+
+    parser = ArgumentParser(prog='python -m load_testing.benchmarks.log_export')
+
+    parser.add_argument('--size', type=int, default=100, help='megabytes of the whole log')
+    parser.add_argument('--segments', type=int, default=2, help='the current file and the rotated backups amount')
+    parser.add_argument('--seed', type=int, default=0)
+    # the measured case run in a child process, the log is created by the parent
+    parser.add_argument('--case', choices=CASES, help=SUPPRESS)
+    parser.add_argument('--log-path', type=Path, help=SUPPRESS)
+
+    return parser.parse_args()
+
+
+def create_log(log_file_path: Path, size: int, segments_amount: int, random: Random) -> int:
+    """
+    Write the log segments (log, log.1, ...) of the size in total, return the records amount.
+    """
+
+    records_amount = 0
+
+    for segment_number in range(segments_amount):
+
+        segment_path = log_file_path.with_name(f'{log_file_path.name}.{segment_number}') if segment_number else \
+            log_file_path
+        segment_size = 0
+
+        with open(segment_path, 'w', encoding='utf-8') as f:
+            while segment_size < size // segments_amount:
+
+                if random.random() < ERROR_RECORDS_SHARE:
+                    record = (
+                        f'[ERROR] [2024-05-01 12:00:{records_amount % 60:02}] path - "services/gpt.py" function - '
+                        f'"ask" message - "GPT request unknown error: timeout. Context:\n'
+                        f'  user_id: {random.randrange(10000)}\n  prompt: Привет, как дела?"\n'
+                    )
+
+                else:
+                    record = (
+                        f'[INFO] [2024-05-01 12:00:{records_amount % 60:02}] path - "main.py" function - '
+                        f'"process_text_message" message - "Message {records_amount} processed for user '
+                        f'{random.randrange(10000)}"\n'
+                    )
+
+                f.write(record)
+
+                segment_size += len(record.encode())
+                records_amount += 1
+
+    return records_amount
+
+
+def measure_case(case: str, log_file_path: Path) -> dict:
+    """
+    Run the export case, return its duration, the exported size and the peak RSS (in KB) before and after.
+    """
+
+    records_amount, substring = CASES[case]
+
+    initial_peak_rss = getrusage(RUSAGE_SELF).ru_maxrss
+    start_time = perf_counter()
+
+    if records_amount is None:
+        with open(log_file_path, 'rb') as f:
+            file_data = f.read()
+
+    else:
+        file_data = export_logs(log_file_path, records_amount, substring)
+
+    return {
+        'duration': perf_counter() - start_time,
+        'exported_size': len(file_data or b''),
+        'initial_peak_rss': initial_peak_rss,
+        'peak_rss': getrusage(RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def main() -> None:
+
+    arguments = parse_arguments()
+
+    if arguments.case:
+
+        print(dumps(measure_case(arguments.case, arguments.log_path)))
+
+        return
+
+    log_file_path = temporary_dir / 'benchmark.log'
+
+    start_time = perf_counter()
+    records_amount = create_log(log_file_path, arguments.size * 1024 * 1024, arguments.segments, Random(arguments.seed))
+
+    print(f'Log: {arguments.size} MB in {arguments.segments} segments, {records_amount} records, '
+          f'created in {perf_counter() - start_time:.1f} s')
+
+    for case in CASES:
+
+        child = run(
+            [sys.executable, '-m', 'load_testing.benchmarks.log_export', '--case', case, '--log-path', log_file_path],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        result = loads(child.stdout.splitlines()[-1])
+
+        print(f'{case}: {result["duration"] * 1000:.0f} ms, exported {result["exported_size"] / 1024:.1f} KB, '
+              f'peak RSS +{(result["peak_rss"] - result["initial_peak_rss"]) / 1024:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+The cost of a log call on the request path with the handlers called directly (the records are formatted and written
+by the logging thread) and with the queue handler (LOGS_QUEUE_ENABLED, the logging thread only puts the records into
+the queue). The records are logged by several threads at once like by the bot workers. Every mode is run in its own
+process, as the settings are read on the import. Usage example:
+
+    python -m load_testing.benchmarks.logging_queue --records 20000 --threads 8 --format json
+"""
+
+import os
+import sys
+from json import dumps, loads
+from time import perf_counter
+from threading import Thread
+from subprocess import run
+from argparse import ArgumentParser, SUPPRESS
+
+from load_testing.benchmarks import prepare_environment, format_durations, silence_console_logs
+
+prepare_environment()
+
+from get_logger import get_logger  # noqa: E402
+
+
+MODES = {'direct handlers': 'false', 'queue': 'true'}  # the LOGS_QUEUE_ENABLED values
+WARNING_RECORDS_SHARE = 10  # every n-th record is a warning, it is written into both log files
+
+
+def parse_arguments():
+
+    parser = ArgumentParser(prog='python -m load_testing.benchmarks.logging_queue')
+
+    parser.add_argument('--records', type=int, default=20000, help='records logged by every thread')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--format', choices=('text', 'json'), default='text', help='LOGS_FORMAT')
+    # the measured mode run in a child process with LOGS_QUEUE_ENABLED set by the parent
+    parser.add_argument('--measure', action='store_true', help=SUPPRESS)
+
+    return parser.parse_args()
+
+
+def measure(records_amount: int, threads_amount: int) -> list[float]:
+    """
+    Log the records by the threads at once, return the durations of the log calls.
+    """
+
+    logger = get_logger('main')
+    threads_durations = [[] for _ in range(threads_amount)]
+
+    def log_records(durations: list[float]) -> None:
+        for record_number in range(records_amount):
+
+            start_time = perf_counter()
+
+            if record_number % WARNING_RECORDS_SHARE:
+                logger.info('GPT request success', extra={'service_name': 'GPT', 'latency': 0.5})
+
+            else:
+                logger.warning(f'Record {record_number} is a warning')
+
+            durations.append(perf_counter() - start_time)
+
+    threads = [Thread(target=log_records, args=(durations,)) for durations in threads_durations]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return [duration for durations in threads_durations for duration in durations]
+
+
+def main() -> None:
+
+    arguments = parse_arguments()
+
+    if arguments.measure:
+
+        silence_console_logs()
+
+        print(dumps(measure(arguments.records, arguments.threads)))
+
+        return
+
+    print(f'Records: {arguments.records} by every of {arguments.threads} threads, format {arguments.format}')
+
+    for mode, is_queue_enabled in MODES.items():
+
+        child = run(
+            [
+                sys.executable, '-m', 'load_testing.benchmarks.logging_queue', '--measure',
+                '--records', str(arguments.records), '--threads', str(arguments.threads),
+            ],
+            env={**os.environ, 'LOGS_QUEUE_ENABLED': is_queue_enabled, 'LOGS_FORMAT': arguments.format},
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        durations = loads(child.stdout.splitlines()[-1])
+
+        print(f'{mode.capitalize()}: {format_durations(durations, "us")}, '
+              f'total in the logging threads {sum(durations):.2f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Throughput of the conversation messages saving by several threads at once (like by the bot workers): every turn (the
+prompt and the answer) saved by the per-message create calls with their own commits (the saving before the journal)
+and by the write-behind journal (the multi-row INSERT of MESSAGE_JOURNAL_MAX_BATCH_SIZE messages, the time of the last
+flush is included). The database round-trips (the statements and the commits) are counted by the engine events. Run
+it with DB_URL of PostgreSQL to measure the network round-trips. Usage example:
+
+    python -m load_testing.benchmarks.message_journal --threads 8 --turns 500
+"""
+
+from time import perf_counter
+from threading import Thread, Barrier, Lock
+from argparse import ArgumentParser
+
+from load_testing.benchmarks import prepare_environment, format_durations
+
+prepare_environment()
+
+from sqlalchemy import event  # noqa: E402
+
+from sql.crud import UserCrud, UserMessageCrud  # noqa: E402
+from sql.models import UserMessage  # noqa: E402
+from sql.model_enums import RolesEnum  # noqa: E402
+from sql.database import Base, engine, SessionLocal  # noqa: E402
+from sql.message_journal import MessageJournal  # noqa: E402
+from settings import MESSAGE_JOURNAL_MAX_BATCH_SIZE, MESSAGE_JOURNAL_FLUSH_INTERVAL  # noqa: E402
+
+
+PROMPT = 'Привет, как дела?'
+ANSWER = 'Привет! У меня всё хорошо, спасибо. Чем могу помочь?'
+
+
+def parse_arguments():
+
+    parser = ArgumentParser(prog='python -m load_testing.benchmarks.message_journal')
+
+    parser.add_argument('--threads', type=int, default=8, help='every thread saves the turns of its own user')
+    parser.add_argument('--turns', type=int, default=500, help='turns saved by every thread')
+
+    return parser.parse_args()
+
+
+def create_users(users_amount: int) -> list[int]:
+    """
+    Return the users ids.
+    """
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+
+    with SessionLocal() as session:
+        return [UserCrud(session).create(telegram_id=telegram_id).id for telegram_id in range(users_amount)]
+
+
+def save_by_create(user_id: int) -> None:
+    with SessionLocal() as session:
+
+        user_message_crud = UserMessageCrud(session)
+
+        user_message_crud.create(user_id=user_id, text=PROMPT, role=RolesEnum.USER)
+        user_message_crud.create(user_id=user_id, text=ANSWER, role=RolesEnum.ASSISTANT)
+
+
+def measure(save_turn, users_ids: list[int], turns_amount: int) -> tuple[float, list[float]]:
+    """
+    Save the turns of the users by a thread each, return the whole duration and the turns durations.
+    """
+
+    threads_durations = [[] for _ in users_ids]
+    barrier = Barrier(len(users_ids) + 1)
+
+    def save_turns(thread_number: int) -> None:
+
+        barrier.wait()
+
+        for _ in range(turns_amount):
+
+            start_time = perf_counter()
+
+            save_turn(users_ids[thread_number])
+
+            threads_durations[thread_number].append(perf_counter() - start_time)
+
+    threads = [Thread(target=save_turns, args=(thread_number,)) for thread_number in range(len(users_ids))]
+
+    for thread in threads:
+        thread.start()
+
+    barrier.wait()
+    start_time = perf_counter()
+
+    for thread in threads:
+        thread.join()
+
+    return perf_counter() - start_time, [duration for durations in threads_durations for duration in durations]
+
+
+def main() -> None:
+
+    arguments = parse_arguments()
+
+    statements_amount = commits_amount = 0
+    counters_lock = Lock()  # the events are fired by the saving threads
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _count_statement(*_) -> None:
+
+        nonlocal statements_amount
+
+        with counters_lock:
+            statements_amount += 1
+
+    @event.listens_for(engine, 'commit')
+    def _count_commit(*_) -> None:
+
+        nonlocal commits_amount
+
+        with counters_lock:
+            commits_amount += 1
+
+    journal = MessageJournal(MESSAGE_JOURNAL_MAX_BATCH_SIZE, MESSAGE_JOURNAL_FLUSH_INTERVAL)
+
+    def save_by_journal(user_id: int) -> None:
+        journal.add(
+            UserMessage(user_id=user_id, text=PROMPT, role=RolesEnum.USER),
+            UserMessage(user_id=user_id, text=ANSWER, role=RolesEnum.ASSISTANT),
+        )
+
+    print(f'Database: {engine.dialect.name}, threads: {arguments.threads}, turns by every thread: {arguments.turns}, '
+          f'journal batch: {MESSAGE_JOURNAL_MAX_BATCH_SIZE} messages')
+
+    for case, save_turn in (('Per-message create', save_by_create), ('Journal', save_by_journal)):
+
+        users_ids = create_users(arguments.threads)
+        statements_amount = commits_amount = 0
+
+        duration, durations = measure(save_turn, users_ids, arguments.turns)
+
+        flush_start_time = perf_counter()
+
+        journal.flush()
+
+        duration += perf_counter() - flush_start_time
+        turns_amount = len(durations)
+
+        print(f'{case}: {turns_amount / duration:.0f} turns/s, {commits_amount / duration:.0f} commits/s, '
+              f'{format_durations(durations)}, round-trips by turn: {statements_amount / turns_amount:.2f} '
+              f'statements and {commits_amount / turns_amount:.2f} commits')
+
+        with SessionLocal() as session:
+            if len(UserMessageCrud(session).get_many()) != 2 * turns_amount:
+                raise RuntimeError('Not all the messages are saved')
+
+
+if __name__ == '__main__':
+    main()
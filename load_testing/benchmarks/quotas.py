@@ -0,0 +1,118 @@
+"""
+Throughput of the quota reservations: the reserve + settle cycles per second made by several threads at once (like by
+the bot workers) for their own users and for one shared user (the conditional updates of one row are serialized by
+the database). Run it with DB_URL of PostgreSQL to measure the row locks instead of the SQLite database lock. Usage
+example:
+
+    python -m load_testing.benchmarks.quotas --threads 8 --cycles 500
+"""
+
+from time import perf_counter
+from threading import Thread, Barrier
+from argparse import ArgumentParser
+
+from load_testing.benchmarks import prepare_environment, format_durations
+
+prepare_environment()
+
+from sql.crud import UserCrud  # noqa: E402
+from sql.models import User  # noqa: E402
+from sql.quotas import QuotaResource, quota_engine  # noqa: E402
+from sql.database import Base, engine, SessionLocal  # noqa: E402
+from settings import TOKENS_LIMIT_BY_USER  # noqa: E402
+
+
+RESERVED_AMOUNT = 1
+
+
+def parse_arguments():
+
+    parser = ArgumentParser(prog='python -m load_testing.benchmarks.quotas')
+
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--cycles', type=int, default=500, help='reserve + settle cycles of every thread')
+
+    return parser.parse_args()
+
+
+def create_users(users_amount: int) -> list[User]:
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+
+    with SessionLocal() as session:
+        return [UserCrud(session).create(telegram_id=telegram_id) for telegram_id in range(users_amount)]
+
+
+def measure(threads_users: list[User], cycles_amount: int) -> tuple[float, list[float], int]:
+    """
+    Make the cycles for the users by a thread each, return the whole duration, the cycles durations and the rejected
+    reservations amount.
+    """
+
+    threads_durations = [[] for _ in threads_users]
+    rejections_amounts = [0 for _ in threads_users]
+    barrier = Barrier(len(threads_users) + 1)
+
+    def make_cycles(thread_number: int) -> None:
+
+        user = threads_users[thread_number]
+
+        with SessionLocal() as session:
+
+            barrier.wait()
+
+            for _ in range(cycles_amount):
+
+                start_time = perf_counter()
+                reservation = quota_engine.reserve(session, user, QuotaResource.TOKENS, RESERVED_AMOUNT)
+
+                if reservation is None:
+                    rejections_amounts[thread_number] += 1
+
+                else:
+                    reservation.settle()
+
+                threads_durations[thread_number].append(perf_counter() - start_time)
+
+    threads = [Thread(target=make_cycles, args=(thread_number,)) for thread_number in range(len(threads_users))]
+
+    for thread in threads:
+        thread.start()
+
+    barrier.wait()
+    start_time = perf_counter()
+
+    for thread in threads:
+        thread.join()
+
+    return (
+        perf_counter() - start_time,
+        [duration for durations in threads_durations for duration in durations],
+        sum(rejections_amounts),
+    )
+
+
+def main() -> None:
+
+    arguments = parse_arguments()
+
+    if arguments.threads * arguments.cycles * RESERVED_AMOUNT > TOKENS_LIMIT_BY_USER:
+        print(f'TOKENS_LIMIT_BY_USER {TOKENS_LIMIT_BY_USER} is less than the reserved amount, '
+              f'a part of the shared user reservations is rejected')
+
+    print(f'Database: {engine.dialect.name}, threads: {arguments.threads}, cycles by every thread: {arguments.cycles}')
+
+    for case, users_amount in (('Distinct users', arguments.threads), ('Shared user', 1)):
+
+        users = create_users(users_amount)
+        duration, durations, rejections_amount = measure(
+            [users[thread_number % users_amount] for thread_number in range(arguments.threads)], arguments.cycles
+        )
+
+        print(f'{case}: {len(durations) / duration:.0f} cycles/s, {format_durations(durations)}, '
+              f'rejected {rejections_amount}')
+
+
+if __name__ == '__main__':
+    main()
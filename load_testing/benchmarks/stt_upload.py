@@ -0,0 +1,139 @@
+"""
+Peak memory and latency of the speech recognition of many concurrent voice messages against the stub Telegram and STT
+servers: the buffered upload (the voice file is downloaded into memory, then uploaded) and the streaming one (the
+downloaded chunks are uploaded at once, STT_STREAMING_UPLOAD_ENABLED). Every mode is run in its own process, so its
+peak RSS is not shared with the stub servers and the other mode. Usage example:
+
+    python -m load_testing.benchmarks.stt_upload --voices 500 --concurrency 100 --voice-size 1048576
+"""
+
+import sys
+from json import dumps, loads
+from time import perf_counter
+from random import Random
+from threading import Thread
+from resource import getrusage, RUSAGE_SELF
+from subprocess import run
+from argparse import ArgumentParser, SUPPRESS
+from concurrent.futures import ThreadPoolExecutor
+
+from load_testing.fake_services import FakeServicesServer, ServiceBehavior
+from load_testing.benchmarks import prepare_environment, format_durations, silence_console_logs
+
+prepare_environment()
+
+from telebot import TeleBot, apihelper  # noqa: E402
+
+from services import stt as stt_module  # noqa: E402
+from services.stt import stt  # noqa: E402
+from bot_support_modules.telegram_files import telegram_files_downloader  # noqa: E402
+from settings import BOT_TOKEN, STT_STREAMING_UPLOAD_CHUNK_SIZE  # noqa: E402
+
+
+MODES = ('buffered', 'streaming')
+VOICE_FILE_PATH = 'voice/file.oga'
+
+
+def parse_arguments():
+
+    parser = ArgumentParser(prog='python -m load_testing.benchmarks.stt_upload')
+
+    parser.add_argument('--voices', type=int, default=500, help='voice messages recognized')
+    parser.add_argument('--concurrency', type=int, default=100, help='voice messages recognized at once')
+    parser.add_argument('--voice-size', type=int, default=1024 * 1024, help='bytes of every voice file')
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds, the median of the stub services')
+    parser.add_argument('--seed', type=int, default=0)
+    # the measured mode run in a child process, the stub servers url is passed by the parent
+    parser.add_argument('--mode', choices=MODES, help=SUPPRESS)
+    parser.add_argument('--server-url', help=SUPPRESS)
+
+    return parser.parse_args()
+
+
+def recognize_buffered(bot: TeleBot) -> bool:
+    return stt.ask(bot.download_file(VOICE_FILE_PATH))[0]
+
+
+def recognize_streaming(_: TeleBot) -> bool:
+    with telegram_files_downloader.open(VOICE_FILE_PATH, STT_STREAMING_UPLOAD_CHUNK_SIZE) as voice_chunks:
+        return stt.ask(voice_chunks)[0]
+
+
+def measure_mode(mode: str, server_url: str, voices_amount: int, concurrency: int) -> dict:
+    """
+    Recognize the voices in the mode, return the durations and the peak RSS (in KB) before and after.
+    """
+
+    apihelper.FILE_URL = f'{server_url}/file/bot{{0}}/{{1}}'
+    stt_module.STT_URL = f'{server_url}/stt'  # the stub port is known after the settings are loaded
+
+    bot = TeleBot(BOT_TOKEN, threaded=False)
+    recognize = recognize_buffered if mode == 'buffered' else recognize_streaming
+
+    def measure_voice(_) -> float:
+
+        start_time = perf_counter()
+
+        if not recognize(bot):
+            raise RuntimeError('The recognition has failed, see the logs')
+
+        return perf_counter() - start_time
+
+    initial_peak_rss = getrusage(RUSAGE_SELF).ru_maxrss
+    start_time = perf_counter()
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        durations = list(executor.map(measure_voice, range(voices_amount)))
+
+    return {
+        'durations': durations,
+        'total_duration': perf_counter() - start_time,
+        'initial_peak_rss': initial_peak_rss,
+        'peak_rss': getrusage(RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def main() -> None:
+
+    arguments = parse_arguments()
+
+    silence_console_logs()
+
+    if arguments.mode:
+
+        print(dumps(measure_mode(arguments.mode, arguments.server_url, arguments.voices, arguments.concurrency)))
+
+        return
+
+    behavior = ServiceBehavior(arguments.latency, 0.3)
+    server = FakeServicesServer({'telegram': behavior, 'stt': behavior}, lambda *_: None)
+    server.voice_file = Random(arguments.seed).randbytes(arguments.voice_size)
+
+    Thread(target=server.serve_forever, name='fake_services', daemon=True).start()
+
+    print(f'Voices: {arguments.voices}, concurrency: {arguments.concurrency}, '
+          f'voice size {arguments.voice_size / 1024:.0f} KB')
+
+    for mode in MODES:
+
+        child = run(
+            [
+                sys.executable, '-m', 'load_testing.benchmarks.stt_upload', '--mode', mode,
+                '--server-url', server.url, '--voices', str(arguments.voices),
+                '--concurrency', str(arguments.concurrency),
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        result = loads(child.stdout.splitlines()[-1])
+
+        print(f'{mode.capitalize()}: {format_durations(result["durations"])}, '
+              f'total {result["total_duration"]:.1f} s, peak RSS {result["peak_rss"] / 1024:.1f} MB '
+              f'(+{(result["peak_rss"] - result["initial_peak_rss"]) / 1024:.1f} MB while recognizing)')
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
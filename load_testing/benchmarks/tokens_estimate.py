@@ -0,0 +1,119 @@
+"""
+Accuracy and latency of the local tokens estimates against the recorded tokenizer output. The tokenizer output is
+recorded once with the real API (GPT_API_KEY and GPT_FOLDER_ID in the environment), one prompt per line:
+
+    python -m load_testing.benchmarks.tokens_estimate --record prompts.txt --records tokens.jsonl
+    python -m load_testing.benchmarks.tokens_estimate --records tokens.jsonl --limit 300
+
+The upper bound must never undercount, the typical estimate (used for the quota reservations) may.
+"""
+
+import sys
+from json import loads, dumps
+from time import perf_counter
+from pathlib import Path
+from argparse import ArgumentParser
+from statistics import quantiles, median
+
+from load_testing.benchmarks import prepare_environment
+
+prepare_environment()
+
+from services.gpt import gpt  # noqa: E402
+from settings import REQUEST_MAX_TOKENS  # noqa: E402
+
+
+def parse_arguments():
+
+    parser = ArgumentParser(prog='python -m load_testing.benchmarks.tokens_estimate')
+
+    parser.add_argument('--records', type=Path, required=True, help='JSON lines: text, tokens and seconds')
+    parser.add_argument('--record', type=Path, metavar='PROMPTS', help='tokenize the prompts into the records first')
+    parser.add_argument('--limit', type=int, default=REQUEST_MAX_TOKENS, help='the tokens limit to check')
+    parser.add_argument('--repeat', type=int, default=100, help='the estimates are timed over the repeats')
+
+    return parser.parse_args()
+
+
+def record_tokens(prompts_path: Path, records_path: Path) -> None:
+
+    with open(records_path, 'a', encoding='utf-8') as records_file:
+        for prompt in prompts_path.read_text(encoding='utf-8').splitlines():
+
+            if not prompt.strip():
+                continue
+
+            start_time = perf_counter()
+            tokens_amount = gpt.get_prompt_tokens_amount(prompt)
+            duration = perf_counter() - start_time
+
+            if tokens_amount is None:
+                sys.exit('The tokenizer request has failed, see the logs')
+
+            records_file.write(dumps({'text': prompt, 'tokens': tokens_amount, 'seconds': duration}) + '\n')
+
+
+def get_time_per_call(estimate, texts: list[str], repeat: int) -> float:
+
+    start_time = perf_counter()
+
+    for _ in range(repeat):
+        for text in texts:
+            estimate(text)
+
+    return (perf_counter() - start_time) / repeat / len(texts)
+
+
+def format_ratios(ratios: list[float]) -> str:
+
+    percentile_95 = quantiles(ratios, n=20, method='inclusive')[-1] if len(ratios) > 1 else ratios[0]
+
+    return f'min {min(ratios):.2f}, p50 {median(ratios):.2f}, p95 {percentile_95:.2f}, max {max(ratios):.2f}'
+
+
+def print_report(records: list[dict], tokens_limit: int, repeat: int) -> None:
+
+    texts = [record['text'] for record in records]
+    estimates = {
+        'upper bound': gpt.get_prompt_tokens_upper_bound,
+        'typical estimate': gpt.estimate_prompt_tokens_amount,
+    }
+
+    print(f'Records: {len(records)}, tokens limit: {tokens_limit}')
+
+    for name, estimate in estimates.items():
+
+        ratios = [estimate(record['text']) / max(record['tokens'], 1) for record in records]
+        undercounts_amount = sum(estimate(record['text']) < record['tokens'] for record in records)
+
+        print(f'{name.capitalize()}: estimate / tokens {format_ratios(ratios)}, undercounts {undercounts_amount}, '
+              f'{get_time_per_call(estimate, texts, repeat) * 10 ** 6:.2f} us per call')
+
+    decided_locally_amount = sum(gpt.get_prompt_tokens_upper_bound(text) <= tokens_limit for text in texts)
+    within_limit_amount = sum(record['tokens'] <= tokens_limit for record in records)
+    tokenizer_durations = [record['seconds'] for record in records if 'seconds' in record]
+
+    print(f'Within the limit: {within_limit_amount}, passed without the tokenizer: {decided_locally_amount} '
+          f'({decided_locally_amount / len(records):.0%} of the records)')
+
+    if tokenizer_durations:
+        print(f'Tokenizer request: p50 {median(tokenizer_durations) * 1000:.0f} ms')
+
+
+def main() -> None:
+
+    arguments = parse_arguments()
+
+    if arguments.record:
+        record_tokens(arguments.record, arguments.records)
+
+    records = [loads(line) for line in arguments.records.read_text(encoding='utf-8').splitlines() if line]
+
+    if not records:
+        sys.exit('No records')
+
+    print_report(records, arguments.limit, arguments.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Latency of the speech synthesis with and without the TTS cache against the stub TTS server. The texts are requested
+with the Zipf-like popularity (the n-th text is requested 1/n times as often as the first one), like the repeated short
+answers and the /tts debug tests. Usage example:
+
+    python -m load_testing.benchmarks.tts_cache --requests 2000 --texts 200 --tts-latency 0.2
+"""
+
+from time import perf_counter
+from random import Random
+from threading import Thread
+from argparse import ArgumentParser
+
+from load_testing.fake_services import FakeServicesServer, ServiceBehavior
+from load_testing.benchmarks import prepare_environment, format_durations, silence_console_logs
+
+temporary_dir = prepare_environment()
+
+from services import tts as tts_module  # noqa: E402
+from services.tts import TTS  # noqa: E402
+from services.tts_cache import TTSCache  # noqa: E402
+
+
+def parse_arguments():
+
+    parser = ArgumentParser(prog='python -m load_testing.benchmarks.tts_cache')
+
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--texts', type=int, default=200, help='distinct texts amount')
+    parser.add_argument('--tts-latency', type=float, default=0.2, help='seconds, the median of the stub TTS')
+    parser.add_argument('--cache-size', type=int, default=10 * 1024 * 1024, help='bytes of the disk tier')
+    parser.add_argument('--memory-items', type=int, default=50, help='items of the memory tier')
+    parser.add_argument('--seed', type=int, default=0)
+
+    return parser.parse_args()
+
+
+def measure(tts: TTS, texts: list[str]) -> list[float]:
+
+    durations = []
+
+    for text in texts:
+
+        start_time = perf_counter()
+
+        if not isinstance(tts.ask(text), bytes):
+            raise RuntimeError('The synthesis has failed, see the logs')
+
+        durations.append(perf_counter() - start_time)
+
+    return durations
+
+
+def main() -> None:
+
+    arguments = parse_arguments()
+
+    silence_console_logs()
+
+    server = FakeServicesServer({'tts': ServiceBehavior(arguments.tts_latency, 0.3)}, lambda *_: None)
+
+    Thread(target=server.serve_forever, name='fake_services', daemon=True).start()
+
+    random = Random(arguments.seed)
+    distinct_texts = [f'Всё будет хорошо, ответ номер {number}. ' * 5 for number in range(arguments.texts)]
+    weights = [1 / rank for rank in range(1, arguments.texts + 1)]
+    texts = random.choices(distinct_texts, weights, k=arguments.requests)
+
+    tts_module.TTS_URL = f'{server.url}/tts'  # the stub port is known after the settings are loaded
+
+    tts = TTS()
+    cache_dir = temporary_dir / 'benchmark_cache'
+
+    for name, cache in (
+        ('Without the cache', None),
+        ('With the cache', TTSCache(cache_dir, arguments.cache_size, arguments.memory_items)),
+    ):
+
+        tts.cache = cache
+        server.requests_counter.clear()
+
+        durations = measure(tts, texts)
+
+        print(f'{name}: {format_durations(durations)}, total {sum(durations):.1f} s, '
+              f'TTS requests {server.requests_counter["tts"]}')
+
+        if cache is not None:
+
+            disk_size = sum(path.stat().st_size for path in cache_dir.iterdir())
+
+            print(f'  Hit rate {cache.hit_rate:.0%}, hits {cache.hits}, misses {cache.misses}, '
+                  f'disk size {disk_size / 1024 / 1024:.1f} MB of {arguments.cache_size / 1024 / 1024:.1f} MB')
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Latency of the users amount limit validator by the registered users amount: the admitted users are checked by the
+in-process admission cache, the new ones are admitted through the database, the full table load (the validator before
+the admission cache) is measured up to --full-load-max-users. The new users are admitted only within
+MAX_USERS_AMOUNT_LIMIT. Usage example:
+
+    MAX_USERS_AMOUNT_LIMIT=10000000 python -m load_testing.benchmarks.users_admission --users-amounts 10 1000 100000
+"""
+
+from time import perf_counter
+from types import SimpleNamespace
+from argparse import ArgumentParser
+
+from load_testing.benchmarks import prepare_environment, format_durations
+
+prepare_environment()
+
+from sql.crud import UserCrud  # noqa: E402
+from sql.database import Base, engine, SessionLocal  # noqa: E402
+from sql.admission import user_admission  # noqa: E402
+from bot_support_modules.validators import max_users_amount_limit_validator  # noqa: E402
+from settings import MAX_USERS_AMOUNT_LIMIT  # noqa: E402
+
+
+INSERT_BATCH_SIZE = 10000
+
+
+def parse_arguments():
+
+    parser = ArgumentParser(prog='python -m load_testing.benchmarks.users_admission')
+
+    parser.add_argument('--users-amounts', type=int, nargs='+', default=[10, 1000, 100000, 1000000])
+    parser.add_argument('--checks', type=int, default=10000, help='validator calls for the admitted users')
+    parser.add_argument('--admissions', type=int, default=100, help='new users admitted')
+    parser.add_argument('--full-load-max-users', type=int, default=100000)
+
+    return parser.parse_args()
+
+
+def create_users(users_amount: int) -> None:
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+
+    with SessionLocal() as session:
+        for first_telegram_id in range(0, users_amount, INSERT_BATCH_SIZE):
+            UserCrud(session).bulk_create([
+                {'telegram_id': telegram_id}
+                for telegram_id in range(first_telegram_id, min(first_telegram_id + INSERT_BATCH_SIZE, users_amount))
+            ])
+
+
+def measure(function, arguments: list) -> list[float]:
+
+    durations = []
+
+    for argument in arguments:
+
+        start_time = perf_counter()
+
+        function(argument)
+
+        durations.append(perf_counter() - start_time)
+
+    return durations
+
+
+def count_all_users(_) -> int:
+    with SessionLocal() as session:
+        return len(UserCrud(session).get_many())
+
+
+def main() -> None:
+
+    arguments = parse_arguments()
+
+    rejecting_bot = SimpleNamespace(reply_to=lambda *_: None)
+    limit_validator = max_users_amount_limit_validator(rejecting_bot)(lambda message: message)
+
+    def validate(telegram_id: int) -> None:
+        limit_validator(SimpleNamespace(from_user=SimpleNamespace(id=telegram_id)))
+
+    for users_amount in arguments.users_amounts:
+
+        create_users(users_amount)
+
+        start_time = perf_counter()
+
+        with SessionLocal() as session:
+            user_admission.warm_up(session)
+
+        warm_up_duration = perf_counter() - start_time
+
+        print(f'Users: {users_amount}, warm-up {warm_up_duration * 1000:.1f} ms')
+
+        check_durations = measure(validate, [
+            telegram_id % users_amount for telegram_id in range(arguments.checks)
+        ])
+
+        print(f'  Admitted user check: {format_durations(check_durations, "us")}')
+
+        if users_amount + arguments.admissions <= MAX_USERS_AMOUNT_LIMIT:
+
+            admission_durations = measure(validate, range(users_amount, users_amount + arguments.admissions))
+
+            print(f'  New user admission: {format_durations(admission_durations)}')
+
+        else:
+            print(f'  New user admission: skipped, MAX_USERS_AMOUNT_LIMIT is {MAX_USERS_AMOUNT_LIMIT}')
+
+        if users_amount <= arguments.full_load_max_users:
+            print(f'  Full table load: {format_durations(measure(count_all_users, range(10)))}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+End-to-end latency of the voice messages answers of the bot handler against the stub services: the sequential answer
+(the whole GPT answer, then its synthesis) and the pipelined one (VOICE_PIPELINE_ENABLED, the sentences are synthesized
+while the answer is being generated). The stub GPT streams the answer in parts generated for --gpt-chunk-interval
+seconds each. Usage example:
+
+    python -m load_testing.benchmarks.voice_pipeline --voices 20 --gpt-latency 0.5 --gpt-chunk-interval 0.3
+"""
+
+import os
+from time import perf_counter
+from threading import Thread
+from argparse import ArgumentParser
+
+from load_testing.fake_services import FakeServicesServer, ServiceBehavior
+from load_testing.benchmarks import prepare_environment, format_durations, silence_console_logs
+
+
+USER_ID = 1000
+
+
+def parse_arguments():
+
+    parser = ArgumentParser(prog='python -m load_testing.benchmarks.voice_pipeline')
+
+    parser.add_argument('--voices', type=int, default=20, help='voice messages answered in every mode')
+    parser.add_argument('--sentences', type=int, default=8, help='sentences of every GPT answer')
+    parser.add_argument('--gpt-latency', type=float, default=0.5, help='seconds, the median before the answer')
+    parser.add_argument('--gpt-chunk-interval', type=float, default=0.3, help='seconds of every answer part')
+    parser.add_argument('--tts-latency', type=float, default=0.5, help='seconds, the median of the stub TTS')
+    parser.add_argument('--stt-latency', type=float, default=0.3, help='seconds, the median of the stub STT')
+
+    return parser.parse_args()
+
+
+def main() -> None:
+
+    arguments = parse_arguments()
+
+    first_voice_times = []
+
+    def on_reply(_: int, method_name: str, __: str) -> None:
+        if method_name == 'sendVoice' and first_voice_times[-1] is None:
+            first_voice_times[-1] = perf_counter()
+
+    server = FakeServicesServer(
+        {
+            'telegram': ServiceBehavior(0.02, 0.3),
+            'gpt': ServiceBehavior(arguments.gpt_latency, 0.3),
+            'tokenize': ServiceBehavior(0.02, 0.3),
+            'tts': ServiceBehavior(arguments.tts_latency, 0.3),
+            'stt': ServiceBehavior(arguments.stt_latency, 0.3),
+        },
+        on_reply,
+        gpt_answer_sentences_amount=arguments.sentences,
+        gpt_chunk_interval=arguments.gpt_chunk_interval,
+    )
+
+    Thread(target=server.serve_forever, name='fake_services', daemon=True).start()
+
+    # the stub port is known before the settings are loaded
+    os.environ.update({
+        'TELEGRAM_API_URL': server.url,
+        'TTS_URL': f'{server.url}/tts',
+        'STT_URL': f'{server.url}/stt',
+        'GPT_URL': f'{server.url}/gpt/completion',
+        'GPT_TOKENIZE_URL': f'{server.url}/gpt/tokenize',
+        'TOKENS_LIMIT_BY_USER': str(10 ** 9),
+        'CHARACTER_BLOCKS_LIMIT_BY_USER': str(10 ** 9),
+        'SECOND_BLOCKS_LIMIT_BY_USER': str(10 ** 9),
+    })
+
+    prepare_environment()
+
+    from telebot import TeleBot, types
+
+    import main as bot_main
+    from sql.database import create_all_tables
+
+    silence_console_logs()
+    create_all_tables()
+
+    bot = bot_main.create_bot()
+    updates_amount = 0
+
+    def process_update(message_content: dict) -> None:
+        """
+        Process the update in this thread, like a shard worker does.
+        """
+
+        nonlocal updates_amount
+
+        updates_amount += 1
+
+        TeleBot.process_new_updates(bot, [types.Update.de_json({'update_id': updates_amount, 'message': {
+            'message_id': updates_amount,
+            'date': 0,
+            'chat': {'id': USER_ID, 'type': 'private'},
+            'from': {'id': USER_ID, 'is_bot': False, 'first_name': 'User'},
+            **message_content,
+        }})])
+
+    process_update({'text': '/start'})
+
+    print(f'Voices: {arguments.voices}, GPT answer: {arguments.sentences} sentences in 5 parts by '
+          f'{arguments.gpt_chunk_interval} s after {arguments.gpt_latency} s, TTS latency {arguments.tts_latency} s')
+
+    for name, is_pipeline_enabled in (('Sequential', False), ('Pipelined', True)):
+
+        bot_main.VOICE_PIPELINE_ENABLED = is_pipeline_enabled
+        server.requests_counter.clear()
+
+        first_voice_durations = []
+        durations = []
+
+        for _ in range(arguments.voices):
+
+            first_voice_times.append(None)
+            start_time = perf_counter()
+
+            process_update({'voice': {'file_id': 'voice', 'file_unique_id': 'voice', 'duration': 3}})
+
+            durations.append(perf_counter() - start_time)
+
+            if first_voice_times[-1] is None:
+                raise RuntimeError('The voice answer has failed, see the logs')
+
+            first_voice_durations.append(first_voice_times[-1] - start_time)
+
+        print(f'{name}: first voice {format_durations(first_voice_durations)}, '
+              f'whole answer {format_durations(durations)}, TTS requests {server.requests_counter["tts"]}')
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
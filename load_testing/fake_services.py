@@ -0,0 +1,371 @@
+import sys
+from time import time, sleep
+from random import Random
+from json import dumps, loads
+from email.parser import BytesParser
+from dataclasses import dataclass
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs
+from threading import Condition, Lock
+from typing import Callable
+from http.client import HTTPConnection
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+FAKE_VOICE_FILE_SIZE = 30 * 1024  # bytes
+WEBHOOK_RETRY_DELAY = 0.1  # seconds, the update rejected by the webhook (503) is sent again after it
+GPT_ANSWER_SENTENCE = 'Всё обязательно будет хорошо, ты справишься. '
+GPT_STREAM_CHUNKS_AMOUNT = 5
+
+
+@dataclass
+class ServiceBehavior:
+    """
+    Latency (log-normal, median in seconds) and error rate (a fraction of the 500 responses) of a fake service.
+    """
+
+    latency_median: float = 0
+    latency_sigma: float = 0
+    error_rate: float = 0
+
+    def get_latency(self, random: Random) -> float:
+
+        if not self.latency_median:
+            return 0
+
+        return random.lognormvariate(0, self.latency_sigma) * self.latency_median if self.latency_sigma else \
+            self.latency_median
+
+
+class FakeServicesRequestHandler(BaseHTTPRequestHandler):
+    """
+    Routes the requests by the path: "/bot<token>/<method>" and "/file/bot<token>/<path>" are the Telegram Bot API,
+    "/tts", "/stt", "/gpt/completion" and "/gpt/tokenize" are the Yandex Cloud APIs.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    server: 'FakeServicesServer'
+
+    def log_message(self, *_) -> None:
+        pass
+
+    def _read_body(self) -> bytes:
+
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':  # the streamed STT upload
+
+            body = b''
+
+            while chunk_size := int(self.rfile.readline().strip(), 16):
+
+                body += self.rfile.read(chunk_size)
+
+                self.rfile.readline()
+
+            self.rfile.readline()
+
+            return body
+
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _answer(self, status_code: int, body: bytes, content_type: str = 'application/json') -> None:
+
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        self.wfile.write(body)
+
+    def _answer_json(self, data: dict, status_code: int = 200) -> None:
+        self._answer(status_code, dumps(data, ensure_ascii=False).encode())
+
+    def _handle(self) -> None:
+
+        url = urlsplit(self.path)
+        path_parts = url.path.strip('/').split('/')
+        body = self._read_body()
+
+        if path_parts[0] == 'file':
+            service_name, handler = 'telegram', lambda: self._answer(200, self.server.voice_file, 'audio/ogg')
+
+        elif path_parts[0].startswith('bot'):
+            service_name, handler = 'telegram', lambda: self._handle_telegram(path_parts[-1], url.query, body)
+
+        elif path_parts[0] == 'gpt':
+            service_name = 'tokenize' if path_parts[-1] == 'tokenize' else 'gpt'
+            handler = lambda: self._handle_gpt(path_parts[-1], loads(body))
+
+        elif path_parts[0] in ('tts', 'stt'):
+            service_name = path_parts[0]
+            handler = (lambda: self._answer(200, b'\0' * len(body) * 10, 'audio/ogg')) if service_name == 'tts' else \
+                (lambda: self._answer_json({'result': 'Привет, как дела? Мне немного грустно'}))
+
+        else:
+
+            self._answer(404, b'')
+
+            return
+
+        if path_parts[0] == 'file':
+            method_name = 'downloadFile'
+
+        else:
+            method_name = path_parts[-1] if service_name == 'telegram' else service_name
+
+        self.server.count_request(method_name)
+
+        behavior = self.server.behaviors.get(service_name, ServiceBehavior())
+
+        # getUpdates is a long polling request, its latency is the updates waiting
+        if method_name != 'getUpdates':
+            sleep(behavior.get_latency(self.server.random))
+
+        if behavior.error_rate and self.server.random.random() < behavior.error_rate:
+
+            self.server.count_request(f'{method_name} (error)')
+
+            self._answer_json({'ok': False, 'error_code': 500, 'description': 'Fake error'}, 500)
+
+            return
+
+        handler()
+
+    do_GET = do_POST = _handle
+
+    def _handle_telegram(self, method_name: str, query: str, body: bytes) -> None:
+
+        params = {key: values[0] for key, values in parse_qs(query).items()}
+
+        content_type = self.headers.get('Content-Type', '')
+
+        if not params and body and content_type.startswith('application/x-www-form-urlencoded'):
+            params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+        elif not params and body and content_type.startswith('multipart/form-data'):  # the async bot files
+
+            form = BytesParser().parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+            params = {
+                part.get_param('name', header='Content-Disposition'): part.get_payload(decode=True).decode()
+                for part in form.walk() if not part.is_multipart() and part.get_filename() is None
+            }
+
+        if method_name == 'getUpdates':
+            result = self.server.get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0))
+
+        elif method_name == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bot', 'username': 'bot'}
+
+        elif method_name == 'getFile':
+            result = {
+                'file_id': params.get('file_id', ''),
+                'file_unique_id': params.get('file_id', ''),
+                'file_size': len(self.server.voice_file),
+                'file_path': 'voice/file.oga',
+            }
+
+        elif method_name in ('sendMessage', 'sendVoice', 'sendDocument', 'editMessageText'):
+
+            chat_id = int(params.get('chat_id') or 0)
+            result = self.server.create_bot_message(chat_id, params.get('text', ''))
+
+            if method_name != 'editMessageText':
+                self.server.on_reply(chat_id, method_name, params.get('text', ''))
+
+        else:
+            result = True  # deleteWebhook, setWebhook, sendChatAction, ...
+
+        self._answer_json({'ok': True, 'result': result})
+
+    def _handle_gpt(self, method_name: str, request_json: dict) -> None:
+
+        if method_name == 'tokenize':
+
+            self._answer_json({'tokens': [{'id': '1', 'text': 'x'}] * (len(request_json['text']) // 4 + 1)})
+
+            return
+
+        answer = GPT_ANSWER_SENTENCE * self.server.gpt_answer_sentences_amount
+        usage = {
+            'inputTextTokens': str(sum(len(message['text']) for message in request_json['messages']) // 4),
+            'completionTokens': str(len(answer) // 4),
+            'totalTokens': '0',
+        }
+
+        if not request_json['completionOptions'].get('stream'):
+
+            sleep(self.server.gpt_chunk_interval * GPT_STREAM_CHUNKS_AMOUNT)  # the whole answer is generated
+
+            self._answer_json({'result': {
+                'alternatives': [
+                    {'message': {'role': 'assistant', 'text': answer}, 'status': 'ALTERNATIVE_STATUS_FINAL'},
+                ],
+                'usage': usage,
+            }})
+
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        for chunk_number in range(1, GPT_STREAM_CHUNKS_AMOUNT + 1):
+
+            sleep(self.server.gpt_chunk_interval)
+
+            is_final = chunk_number == GPT_STREAM_CHUNKS_AMOUNT
+            answer_part = answer[:len(answer) * chunk_number // GPT_STREAM_CHUNKS_AMOUNT]
+            line = dumps({'result': {
+                'alternatives': [{
+                    'message': {'role': 'assistant', 'text': answer_part},
+                    'status': 'ALTERNATIVE_STATUS_FINAL' if is_final else 'ALTERNATIVE_STATUS_PARTIAL',
+                }],
+                'usage': usage,
+            }}, ensure_ascii=False).encode() + b'\n'
+
+            self.wfile.write(f'{len(line):x}\r\n'.encode() + line + b'\r\n')
+            self.wfile.flush()
+
+        self.wfile.write(b'0\r\n\r\n')
+
+
+class FakeServicesServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the Telegram Bot API and the Yandex Cloud APIs. The updates are added by add_update and given
+    to the bot by the long polling getUpdates (or posted to its webhook by deliver_to_webhook), the bot replies
+    (sendMessage, sendVoice, sendDocument) are passed into the on_reply callback.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+            self,
+            behaviors: dict[str, ServiceBehavior],
+            on_reply: Callable[[int, str, str], None],
+            gpt_answer_sentences_amount: int = 3,
+            seed: int = 0,
+            gpt_chunk_interval: float = 0,
+    ) -> None:
+
+        super().__init__(('127.0.0.1', 0), FakeServicesRequestHandler)
+
+        self.behaviors = behaviors
+        self.on_reply = on_reply
+        self.gpt_answer_sentences_amount = gpt_answer_sentences_amount
+        self.gpt_chunk_interval = gpt_chunk_interval  # seconds of generation of every streamed answer part
+        self.random = Random(seed)
+        self.voice_file = bytes(self.random.getrandbits(8) for _ in range(FAKE_VOICE_FILE_SIZE))
+
+        self.requests_counter: Counter[str] = Counter()
+
+        self._updates: list[dict] = []
+        self._updates_condition = Condition()
+        self._last_update_id = 0
+        self._last_message_id = 0
+        self._lock = Lock()
+
+    def handle_error(self, request, client_address) -> None:
+        if not isinstance(sys.exc_info()[1], ConnectionError):  # the bot closes its connections on the exit
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def count_request(self, name: str) -> None:
+        with self._lock:
+            self.requests_counter[name] += 1
+
+    def _get_message_id(self) -> int:
+        with self._lock:
+
+            self._last_message_id += 1
+
+            return self._last_message_id
+
+    def create_bot_message(self, chat_id: int, text: str) -> dict:
+        return {
+            'message_id': self._get_message_id(),
+            'date': int(time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'Bot'},
+            'text': text,
+        }
+
+    def add_update(self, user_id: int, text: str | None = None, voice_duration: int | None = None) -> None:
+
+        message = {
+            'message_id': self._get_message_id(),
+            'date': int(time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'},
+        }
+
+        if voice_duration is None:
+            message['text'] = text
+
+        else:
+            message['voice'] = {'file_id': f'voice_{user_id}', 'file_unique_id': 'voice', 'duration': voice_duration}
+
+        with self._updates_condition:
+
+            self._last_update_id += 1
+
+            self._updates.append({'update_id': self._last_update_id, 'message': message})
+
+            self._updates_condition.notify_all()
+
+    def get_updates(self, offset: int, timeout: float) -> list[dict]:
+        """
+        Forget the updates before the offset (they are confirmed) and return the rest, wait for them up to the timeout.
+        """
+
+        with self._updates_condition:
+
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+
+            self._updates_condition.wait_for(lambda: self._updates, timeout)
+
+            return self._updates[:100]
+
+    def deliver_to_webhook(self, host: str, port: int, path: str, secret_token: str) -> None:
+        """
+        Post the updates to the bot webhook one by one in order (blocking, run it in a thread) until the bot closes the
+        connection. The rejected updates (the bot queue is full) are posted again after a delay like Telegram does.
+        """
+
+        connection = HTTPConnection(host, port)
+        offset = 0
+
+        try:
+            while True:
+                for update in self.get_updates(offset, 1):
+
+                    update_data = dumps(update).encode()
+
+                    while True:
+
+                        connection.request('POST', path, update_data, {
+                            'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': secret_token,
+                        })
+
+                        response = connection.getresponse()
+
+                        response.read()
+
+                        if response.status != 503:
+                            break
+
+                        self.count_request('webhook (rejected)')
+
+                        sleep(WEBHOOK_RETRY_DELAY)
+
+                    self.count_request('webhook')
+
+                    offset = update['update_id'] + 1
+
+        except OSError:
+            pass  # the bot is stopped
+
+        finally:
+            connection.close()
@@ -0,0 +1,129 @@
+from time import monotonic
+from random import Random
+from dataclasses import dataclass
+from threading import Event, Lock
+
+from load_testing.fake_services import FakeServicesServer
+
+
+@dataclass
+class Workload:
+    """
+    Every user sends /start and then messages_per_user messages, the next message is sent when the previous one is
+    answered (a closed loop, so the users amount is the concurrency). voice_share is the fraction of voice messages.
+    """
+
+    users_amount: int
+    messages_per_user: int
+    voice_share: float
+    voice_duration: int = 3  # seconds
+
+
+WORKLOADS = {
+    'text-heavy': Workload(users_amount=20, messages_per_user=25, voice_share=0.1),
+    'voice-heavy': Workload(users_amount=20, messages_per_user=10, voice_share=0.9),
+    'many-users': Workload(users_amount=500, messages_per_user=3, voice_share=0.2),
+}
+
+FIRST_USER_ID = 1_000_000
+TEXT_PROMPTS = (
+    'Привет! Как дела?',
+    'Мне сегодня грустно, поддержи меня, пожалуйста',
+    'Расскажи что-нибудь хорошее',
+    'Я устал на работе, что мне делать?',
+    'Спасибо, мне стало лучше',
+)
+
+
+class WorkloadRun:
+    """
+    Sends the workload messages into the fake Telegram and measures the end-to-end latency of every message: from
+    the moment it is available to getUpdates to the first bot reply in the chat (for the streamed GPT answers it is
+    the first partial answer, for the pipelined voice answers - the first voice segment).
+    """
+
+    def __init__(self, workload: Workload, error_message: str, seed: int = 0) -> None:
+
+        self.workload = workload
+        self.error_message = error_message
+        self.random = Random(seed)
+
+        self.server: FakeServicesServer | None = None
+        self.finished = Event()
+
+        self.latencies: dict[str, list[float]] = {'text': [], 'voice': []}
+        self.error_replies_amount = 0
+        self.extra_replies_amount = 0
+        self.start_time: float | None = None
+        self.finish_time: float | None = None
+
+        # user id: (message kind or "start", sending time), the message is waiting for a reply
+        self._pending: dict[int, tuple[str, float]] = {}
+        self._sent_amounts: dict[int, int] = {}
+        self._answered_users_amount = 0
+        self._lock = Lock()
+
+    @property
+    def messages_amount(self) -> int:
+        return sum(len(latencies) for latencies in self.latencies.values())
+
+    def _send(self, user_id: int, kind: str) -> None:
+
+        self._pending[user_id] = (kind, monotonic())
+
+        if kind == 'voice':
+            self.server.add_update(user_id, voice_duration=self.workload.voice_duration)
+
+        else:
+            self.server.add_update(user_id, text='/start' if kind == 'start' else self.random.choice(TEXT_PROMPTS))
+
+    def _send_next(self, user_id: int) -> None:
+
+        sent_amount = self._sent_amounts.get(user_id, 0)
+
+        if sent_amount >= self.workload.messages_per_user:
+
+            self._answered_users_amount += 1
+
+            if self._answered_users_amount == self.workload.users_amount:
+
+                self.finish_time = monotonic()
+
+                self.finished.set()
+
+            return
+
+        self._sent_amounts[user_id] = sent_amount + 1
+
+        self._send(user_id, 'voice' if self.random.random() < self.workload.voice_share else 'text')
+
+    def start(self, server: FakeServicesServer) -> None:
+        with self._lock:
+
+            self.server = server
+            self.start_time = monotonic()
+
+            for user_id in range(FIRST_USER_ID, FIRST_USER_ID + self.workload.users_amount):
+                self._send(user_id, 'start')
+
+    def on_reply(self, chat_id: int, _: str, text: str) -> None:
+        with self._lock:
+
+            pending_message = self._pending.pop(chat_id, None)
+
+            if pending_message is None:  # the next voice segments, the debug user commands
+
+                self.extra_replies_amount += 1
+
+                return
+
+            kind, sending_time = pending_message
+
+            if kind != 'start':
+
+                self.latencies[kind].append(monotonic() - sending_time)
+
+                if text == self.error_message:
+                    self.error_replies_amount += 1
+
+            self._send_next(chat_id)
@@ -1,54 +1,198 @@
+from time import monotonic
 from random import choice
+from signal import signal, SIGTERM, default_int_handler
 from pathlib import Path
-
-from telebot import TeleBot, types, custom_filters
+from collections import deque
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor, Future
+from asyncio import Task, create_task, to_thread
+
+from telebot import TeleBot, types, custom_filters, apihelper, asyncio_filters, asyncio_helper, asyncio_storage
+from telebot.apihelper import ApiException, ApiTelegramException
+from requests.exceptions import RequestException
+from aiohttp import ClientError
 from telebot.storage import StateMemoryStorage
-from sqlalchemy.orm import Session
 
 from services.stt import stt
 from services.tts import tts
 from services.gpt import gpt
+from services.http_client import ServiceUnavailableError
+from metrics import metrics
+from get_logger import get_logger
 from settings import (
     BOT_TOKEN,
+    BOT_WORKERS_AMOUNT,
+    BOT_RUNTIME_MODE,
+    ASYNC_RUNTIME_MAX_IN_FLIGHT_UPDATES,
+    BOT_STATE_STORAGE,
+    BOT_STATE_STORAGE_CACHE_MAX_ITEMS,
+    TELEGRAM_API_URL,
+    BOT_SHARD_QUEUE_MAX_SIZE,
+    BOT_STOP_TIMEOUT,
+    MULTIPROCESS_RUNTIME_WORKERS_AMOUNT,
     TTS_CHARACTERS_IN_BLOCK,
     STT_SECONDS_IN_BLOCK,
+    STT_STREAMING_UPLOAD_ENABLED,
+    STT_STREAMING_UPLOAD_CHUNK_SIZE,
     SECOND_BLOCKS_LIMIT_BY_USER,
     CHARACTER_BLOCKS_LIMIT_BY_USER,
     TOKENS_LIMIT_BY_USER,
     WARNING_LOG_FILE_PATH,
     INFO_LOG_FILE_PATH,
+    LOGS_EXPORT_RECORDS_AMOUNT,
+    LOGS_EXPORT_MAX_RECORDS_AMOUNT,
     DEBUG_USER_ID,
+    GPT_STREAMING_ENABLED,
+    GPT_STREAMING_EDIT_INTERVAL,
+    USER_FRIENDLY_REQUEST_ERROR_MESSAGE,
+    LOGGING_REQUEST_UNKNOWN_ERROR_TEMPLATE,
+    VOICE_PIPELINE_ENABLED,
+    VOICE_PIPELINE_MAX_WORKERS,
+    VOICE_PIPELINE_MIN_SEGMENT_LENGTH,
 )
-from sql.database import SessionLocal, create_all_tables
-from sql.models import User
-from sql.crud import UserCrud, UserMessageCrud
+from sql.database import SessionLocal, AsyncSessionLocal, create_all_tables
+from sql.admission import user_admission
+from sql.crud import UserCrud
+from sql.models import User, UserMessage
+from sql.message_journal import message_journal
+from sql.quotas import QuotaReservation, AsyncQuotaReservation, quota_engine
 from sql.model_enums import RolesEnum
 from bot_support_modules.markups import MAIN_MARKUP, DEBUG_MARKUP
 from bot_support_modules.states import DebugStates
+from bot_support_modules.state_storage import DatabaseStateStorage, AsyncDatabaseStateStorage
+from bot_support_modules.dispatcher import UserShardedTeleBot, UserOrderedAsyncTeleBot
+from bot_support_modules.request_context import RequestContext, request_context_provider
+from bot_support_modules.sentence_splitter import SentenceSplitter
+from bot_support_modules.telegram_files import telegram_files_downloader
+from bot_support_modules.conversation_summarizer import conversation_summarizer
+from bot_support_modules.multiprocess_runtime import run_multiprocess_polling
+from bot_support_modules.async_runtime import run_async_polling
+from bot_support_modules.log_export import export_logs
+from bot_support_modules.webhook import run_webhook, start_metrics_server
 from bot_support_modules.validators import (
     max_users_amount_limit_validator,
     request_character_blocks_limit_validator,
     request_second_blocks_limit_validator,
     request_tokens_limit_validator,
-    user_character_blocks_limit_validator,
-    user_second_blocks_limit_validator,
-    user_tokens_limit_validator,
+    character_blocks_quota_validator,
+    second_blocks_quota_validator,
+    tokens_quota_validator,
 )
 
 
-def run_bot() -> None:
+logger = get_logger('main')
+
+HELP_MESSAGE = (
+    'Привет, я - бот-поддержатор! Буду стараться тебя поддерживать, чтобы ты не грустил. Ты можешь просто'
+    ' написать что-то или сказать, а я отвечу!'
+    ' (На каждого пользователя есть лимиты использования бота, без этого никак)\n\n'
+    'Если тебе хочется больше узнать о моих командах, то вот они:\n'
+    '/help или /start - список всех команд (ты уже тут)\n'
+    '/stats - статистика (потраченные токены и т.д.)\n\n'
+    'Далее начинается зона отладки, если ты не уверен в том, что должен писать эти команды, то не пиши их:\n'
+    '/toggle_debug - переход в режим отладки'
+    ' (доступны команды для отладки, отключаются автоматические ответы на сообщения)\n'
+    'Доступно только в режиме отладки:\n'
+    '/stt - тест перевода голоса в текст\n'
+    '/tts - тест перевода текста в голос\n'
+    'Получение логов и метрик по следующим командам доступно не всем:\n'
+    '/get_logs_warning [количество записей] [подстрока] - получение последних записей логов '
+    '(с уровня "предупреждение" и выше), например: /get_logs_warning 100 [ERROR]\n'
+    '/get_logs_info [количество записей] [подстрока] - получение последних записей логов '
+    '(с уровня "информация" и выше), например: /get_logs_info 500 GPT\n'
+    '/perf - время обработки сообщений, запросов в сервисы и базу данных, состояние кэшей и сервисов\n'
+)
 
-    bot = TeleBot(BOT_TOKEN, state_storage=StateMemoryStorage())
+UNKNOWN_MESSAGE_REPLIES = (
+    'О, круто!',
+    'Верно подмечено!',
+    'Как с языка снял',
+    'Какой ты всё-таки умный',
+    'По-любому что-то умное написал',
+    'Как лаконично-то!',
+)
 
-    bot.add_custom_filter(custom_filters.StateFilter(bot))
 
-    def get_state_markup(message: types.Message) -> types.ReplyKeyboardMarkup:
+def get_markup(state: str | None) -> types.ReplyKeyboardMarkup:
+
+    if state == DebugStates.inactive.name:
+        return MAIN_MARKUP
+
+    else:
+        return DEBUG_MARKUP
+
+
+def get_stats_message(user: User | None) -> str:
+
+    character_blocks_spent, second_blocks_spent, tokens_spent = (0, 0, 0) if user is None else (
+        user.character_blocks_spent, user.second_blocks_spent, user.tokens_spent
+    )
+
+    return (
+        f'Потрачено блоков символов ({TTS_CHARACTERS_IN_BLOCK} символов в каждом):'
+        f' {character_blocks_spent} из {CHARACTER_BLOCKS_LIMIT_BY_USER}\n'
+        f'Потрачено блоков секунд ({STT_SECONDS_IN_BLOCK} символов в каждом): {second_blocks_spent} из'
+        f' {SECOND_BLOCKS_LIMIT_BY_USER}\n'
+        f'Потрачено токенов: {tokens_spent} из {TOKENS_LIMIT_BY_USER}'
+    )
 
-        if bot.get_state(message.from_user.id) == DebugStates.inactive.name:
-            return MAIN_MARKUP
+
+def get_logs_command_arguments(command_text: str) -> tuple[int, str | None]:
+    """
+    Return the records amount and the substring of the logs command (for example "/get_logs_info 100 [ERROR]"), both
+    arguments are optional.
+    """
+
+    command_arguments = command_text.split(maxsplit=1)[1:]
+
+    records_amount = LOGS_EXPORT_RECORDS_AMOUNT
+    substring = None
+
+    if command_arguments:
+
+        first_argument, *substring_parts = command_arguments[0].split(maxsplit=1)
+
+        if first_argument.isdigit():
+            records_amount = min(max(int(first_argument), 1), LOGS_EXPORT_MAX_RECORDS_AMOUNT)
+            substring = substring_parts[0] if substring_parts else None
 
         else:
-            return DEBUG_MARKUP
+            substring = command_arguments[0]
+
+    return records_amount, substring
+
+
+def get_unknown_message_reply() -> str:
+    return (
+        choice(UNKNOWN_MESSAGE_REPLIES)
+        + '\n\nЕсли ты хотел, чтобы я что-то сделал, то я не распознал твою команду, пожалуйста, сверься с /help'
+    )
+
+
+def create_bot() -> TeleBot:
+
+    apihelper.API_URL = f'{TELEGRAM_API_URL}/bot{{0}}/{{1}}'
+    apihelper.FILE_URL = f'{TELEGRAM_API_URL}/file/bot{{0}}/{{1}}'
+
+    if BOT_STATE_STORAGE == 'database':
+        state_storage = DatabaseStateStorage(BOT_STATE_STORAGE_CACHE_MAX_ITEMS)
+
+    else:
+        state_storage = StateMemoryStorage()
+
+    bot = UserShardedTeleBot(
+        BOT_TOKEN,
+        state_storage=state_storage,
+        shards_amount=BOT_WORKERS_AMOUNT,
+        shard_queue_max_size=BOT_SHARD_QUEUE_MAX_SIZE,
+    )
+
+    bot.add_custom_filter(custom_filters.StateFilter(bot))
+
+    tts_executor = ThreadPoolExecutor(VOICE_PIPELINE_MAX_WORKERS, thread_name_prefix='tts_worker')
+
+    def get_state_markup(message: types.Message) -> types.ReplyKeyboardMarkup:
+        return get_markup(bot.get_state(message.from_user.id))
 
     @bot.message_handler(commands=['help', 'start'])
     def help_handler(message: types.Message):
@@ -56,40 +200,16 @@ def run_bot() -> None:
         if bot.get_state(message.from_user.id) is None:
             bot.set_state(message.from_user.id, DebugStates.inactive)
 
-        reply_message = (
-            'Привет, я - бот-поддержатор! Буду стараться тебя поддерживать, чтобы ты не грустил. Ты можешь просто'
-            ' написать что-то или сказать, а я отвечу!'
-            ' (На каждого пользователя есть лимиты использования бота, без этого никак)\n\n'
-            'Если тебе хочется больше узнать о моих командах, то вот они:\n'
-            '/help или /start - список всех команд (ты уже тут)\n'
-            '/stats - статистика (потраченные токены и т.д.)\n\n'
-            'Далее начинается зона отладки, если ты не уверен в том, что должен писать эти команды, то не пиши их:\n'
-            '/toggle_debug - переход в режим отладки'
-            ' (доступны команды для отладки, отключаются автоматические ответы на сообщения)\n'
-            'Доступно только в режиме отладки:\n'
-            '/stt - тест перевода голоса в текст\n'
-            '/tts - тест перевода текста в голос\n'
-            'Получение логов по следующим командам доступно не всем:\n'
-            '/get_logs_warning - получение файла с логами (с уровня "предупреждение" и выше)\n'
-            '/get_logs_info - получение файла с логами (с уровня "информация" и выше)\n'
-        )
-
-        bot.reply_to(message, reply_message, reply_markup=get_state_markup(message))
+        bot.reply_to(message, HELP_MESSAGE, reply_markup=get_state_markup(message))
 
     @bot.message_handler(commands=['stats'])
     def stats_handler(message: types.Message):
-        with SessionLocal() as session:
 
-            user = UserCrud(session).get_or_create(telegram_id=message.from_user.id)
+        # the user is not created here, so /stats does not take a place within the users amount limit
+        with SessionLocal() as session:
+            user = UserCrud(session).get(telegram_id=message.from_user.id)
 
-            bot.reply_to(
-                message,
-                f'Потрачено блоков символов ({TTS_CHARACTERS_IN_BLOCK} символов в каждом):'
-                f' {user.character_blocks_spent} из {CHARACTER_BLOCKS_LIMIT_BY_USER}\n'
-                f'Потрачено блоков секунд ({STT_SECONDS_IN_BLOCK} символов в каждом): {user.second_blocks_spent} из'
-                f' {SECOND_BLOCKS_LIMIT_BY_USER}\n'
-                f'Потрачено токенов: {user.tokens_spent} из {TOKENS_LIMIT_BY_USER}',
-            )
+        bot.reply_to(message, get_stats_message(user))
 
     @bot.message_handler(commands=['toggle_debug'])
     @max_users_amount_limit_validator(bot)
@@ -104,49 +224,72 @@ def run_bot() -> None:
         bot.reply_to(message, 'Debug режим переключён', reply_markup=get_state_markup(message))
 
     @request_character_blocks_limit_validator(bot)
-    @user_character_blocks_limit_validator(bot)
-    def ask_tts(_: types.Message, prompt: str, user: User, session: Session) -> bytes | str:
+    @character_blocks_quota_validator(bot)
+    def ask_tts(
+            _: types.Message, prompt: str, __: RequestContext, quota_reservation: QuotaReservation
+    ) -> bytes | str:
         """
         Return a byte voice message if success else an error message string.
         """
+
         tts_answer = tts.ask(prompt)
 
         if isinstance(tts_answer, bytes):
+            quota_reservation.settle()
 
-            user.character_blocks_spent += tts.get_character_blocks(len(prompt))
-
-            session.commit()
+        else:
+            quota_reservation.release()
 
         return tts_answer
 
     @request_second_blocks_limit_validator(bot)
-    @user_second_blocks_limit_validator(bot)
-    def ask_stt(message: types.Message, user: User, session: Session) -> tuple[bool, str]:
+    @second_blocks_quota_validator(bot)
+    def ask_stt(
+            message: types.Message, _: RequestContext, quota_reservation: QuotaReservation
+    ) -> tuple[bool, str]:
         """
         Return a recognized string and True if success else an error message string and False.
         """
 
-        stt_prompt: bytes = bot.download_file(bot.get_file(message.voice.file_id).file_path)
+        file_path = bot.get_file(message.voice.file_id).file_path
 
-        is_success, stt_answer = stt.ask(stt_prompt)
+        try:
+            if STT_STREAMING_UPLOAD_ENABLED:
+                # a download failed after the upload start fails the STT request
+                with telegram_files_downloader.open(file_path, STT_STREAMING_UPLOAD_CHUNK_SIZE) as stt_prompt_chunks:
+                    is_success, stt_answer = stt.ask(stt_prompt_chunks)
 
-        if is_success:
+            else:
+                with metrics.measure(
+                        'bot_service_request_duration_seconds', service='Telegram files', operation='download'
+                ):
+                    voice_file = bot.download_file(file_path)
 
-            user.second_blocks_spent += stt.get_second_blocks(message.voice.duration)
+                is_success, stt_answer = stt.ask(voice_file)
 
-            session.commit()
+        except (ApiException, RequestException, ServiceUnavailableError) as e:
 
-        return is_success, stt_answer
+            logger.error(LOGGING_REQUEST_UNKNOWN_ERROR_TEMPLATE.format(
+                service_name='Telegram files', error=e, context=file_path
+            ))
 
-    def _debug_stt(message: types.Message):
-        with SessionLocal() as session:
+            is_success, stt_answer = False, USER_FRIENDLY_REQUEST_ERROR_MESSAGE
 
-            user = UserCrud(session).get_or_create(telegram_id=message.from_user.id)
+        if is_success:
+            quota_reservation.settle()
 
-            stt_answer = ask_stt(message, user, session)
+        else:
+            quota_reservation.release()
+
+        return is_success, stt_answer
 
-            if stt_answer is not None:
-                bot.reply_to(message, stt_answer[1], reply_markup=DEBUG_MARKUP)
+    @request_context_provider()
+    def _debug_stt(message: types.Message, context: RequestContext):
+
+        stt_answer = ask_stt(message, context)
+
+        if stt_answer is not None:
+            bot.reply_to(message, stt_answer[1], reply_markup=DEBUG_MARKUP)
 
     @bot.message_handler(commands=['stt'], state=DebugStates.active)
     @max_users_amount_limit_validator(bot)
@@ -156,20 +299,18 @@ def run_bot() -> None:
 
         bot.register_next_step_handler(message, _debug_stt)
 
-    def _debug_tts(message: types.Message):
-        with SessionLocal() as session:
+    @request_context_provider()
+    def _debug_tts(message: types.Message, context: RequestContext):
 
-            user = UserCrud(session).get_or_create(telegram_id=message.from_user.id)
+        tts_answer = ask_tts(message, message.text, context)
 
-            tts_answer = ask_tts(message, message.text, user, session)
+        if tts_answer is not None:
 
-            if tts_answer is not None:
-
-                if isinstance(tts_answer, bytes):
-                    bot.send_voice(message.from_user.id, tts_answer, reply_markup=DEBUG_MARKUP)
+            if isinstance(tts_answer, bytes):
+                bot.send_voice(message.from_user.id, tts_answer, reply_markup=DEBUG_MARKUP)
 
-                else:
-                    bot.reply_to(message, tts_answer, reply_markup=DEBUG_MARKUP)
+            else:
+                bot.reply_to(message, tts_answer, reply_markup=DEBUG_MARKUP)
 
     @bot.message_handler(commands=['tts'], state=DebugStates.active)
     @max_users_amount_limit_validator(bot)
@@ -180,120 +321,792 @@ def run_bot() -> None:
         bot.register_next_step_handler(message, _debug_tts)
 
     def _get_logs_file_handler(message: types.Message, log_file_path: Path, visible_file_name: str) -> None:
-        with open(log_file_path, 'rb') as f:
+        """
+        Send the last records of the log file (and its rotated backups) as a gzip file. The command arguments are the
+        optional records amount and substring (for example "/get_logs_info 100 [ERROR]").
+        """
+
+        records_amount, substring = get_logs_command_arguments(message.text)
 
-            file_data = f.read()
+        file_data = export_logs(log_file_path, records_amount, substring)
 
-            if not file_data:
+        if file_data is None:
 
-                bot.reply_to(message, 'Файл с логами пуст!')
+            bot.reply_to(message, 'Подходящих записей в логах нет!' if substring else 'Файл с логами пуст!')
 
-                return
+            return
 
-            bot.send_document(message.chat.id, file_data, visible_file_name=visible_file_name)
+        bot.send_document(message.chat.id, file_data, visible_file_name=visible_file_name)
 
     @bot.message_handler(commands=['get_logs_warning'], func=lambda message: message.from_user.id == DEBUG_USER_ID)
     def get_logs_warning_handler(message: types.Message):
-        _get_logs_file_handler(message, WARNING_LOG_FILE_PATH, 'logs_warning.log')
+        _get_logs_file_handler(message, WARNING_LOG_FILE_PATH, 'logs_warning.log.gz')
 
     @bot.message_handler(commands=['get_logs_info'], func=lambda message: message.from_user.id == DEBUG_USER_ID)
     def get_logs_info_handler(message: types.Message):
-        _get_logs_file_handler(message, INFO_LOG_FILE_PATH, 'logs_info.log')
+        _get_logs_file_handler(message, INFO_LOG_FILE_PATH, 'logs_info.log.gz')
+
+    @bot.message_handler(commands=['perf'], func=lambda message: message.from_user.id == DEBUG_USER_ID)
+    def perf_handler(message: types.Message):
+
+        if not metrics.is_enabled:
+
+            bot.reply_to(message, 'Метрики отключены (METRICS_ENABLED)')
+
+            return
+
+        bot.reply_to(message, metrics.render_summary() or 'Метрик пока нет')
+
+    def _save_gpt_answer(
+            prompt: str,
+            gpt_answer: str,
+            tokens_spent: int,
+            context: RequestContext,
+            quota_reservation: QuotaReservation,
+    ) -> None:
+
+        user_id = context.user.id
+
+        message_journal.add(
+            UserMessage(user_id=user_id, text=prompt, role=RolesEnum.USER),
+            UserMessage(user_id=user_id, text=gpt_answer, role=RolesEnum.ASSISTANT),
+        )
+
+        quota_reservation.settle(tokens_spent)
 
     @request_tokens_limit_validator(bot)
-    @user_tokens_limit_validator(bot)
-    def ask_gpt(_: types.Message, prompt: str, user: User, session: Session) -> tuple[bool, str]:
+    @tokens_quota_validator(bot)
+    def ask_gpt(
+            _: types.Message, prompt: str, context: RequestContext, quota_reservation: QuotaReservation
+    ) -> tuple[bool, str]:
         """
         Return gpt response and True if success else an error message string and False.
         """
 
-        gpt_answer, tokens_spent = gpt.ask(prompt, user.messages[:10])
+        history, summary = conversation_summarizer.get_context(context.session, context.user.id)
+
+        gpt_answer, tokens_spent = gpt.ask(prompt, history, summary)
+
+        if tokens_spent is not None:
+            _save_gpt_answer(prompt, gpt_answer, tokens_spent, context, quota_reservation)
+
+        else:
+            quota_reservation.release()
+
+        return tokens_spent is not None, gpt_answer
+
+    def _edit_reply_text(reply: types.Message, text: str) -> None:
+
+        try:
+            bot.edit_message_text(text, reply.chat.id, reply.message_id)
+
+        except ApiTelegramException as e:
+            logger.warning(f'Cannot edit the message text: {e}')
+
+    @request_tokens_limit_validator(bot)
+    @tokens_quota_validator(bot)
+    def ask_gpt_streaming(
+            message: types.Message, prompt: str, context: RequestContext, quota_reservation: QuotaReservation
+    ) -> None:
+        """
+        Reply with a placeholder message and edit it (not more often than every GPT_STREAMING_EDIT_INTERVAL seconds)
+        while the gpt answer is being generated.
+        """
+
+        history, summary = conversation_summarizer.get_context(context.session, context.user.id)
 
-        if tokens_spent:
+        reply = bot.reply_to(message, 'Думаю...')
 
-            user.tokens_spent += tokens_spent
+        shown_text = reply.text
+        last_edit_time = monotonic()
+        gpt_answer, tokens_spent = USER_FRIENDLY_REQUEST_ERROR_MESSAGE, None
 
-            user_message_crud = UserMessageCrud(session)
+        for gpt_answer, tokens_spent, _ in gpt.ask_stream(prompt, history, summary):
+            if gpt_answer and gpt_answer != shown_text and monotonic() - last_edit_time >= GPT_STREAMING_EDIT_INTERVAL:
 
-            user_message_crud.create(user=user, text=prompt, role=RolesEnum.USER)
-            user_message_crud.create(user=user, text=gpt_answer, role=RolesEnum.ASSISTANT)
+                _edit_reply_text(reply, gpt_answer)
 
-            session.commit()
+                shown_text = gpt_answer
+                last_edit_time = monotonic()
+
+        if tokens_spent is not None:
+            _save_gpt_answer(prompt, gpt_answer, tokens_spent, context, quota_reservation)
+
+        else:
+            quota_reservation.release()
 
-        return bool(tokens_spent), gpt_answer
+        if gpt_answer != shown_text:
+            _edit_reply_text(reply, gpt_answer)
 
     @bot.message_handler(content_types=['text'], state=DebugStates.inactive)
     @max_users_amount_limit_validator(bot)
-    def process_text_message(message: types.Message):
-        with SessionLocal() as session:
+    @request_context_provider()
+    def process_text_message(message: types.Message, context: RequestContext):
+
+        if GPT_STREAMING_ENABLED:
+
+            ask_gpt_streaming(message, message.text, context)
+
+            return
+
+        gpt_answer = ask_gpt(message, message.text, context)
 
-            user = UserCrud(session).get_or_create(telegram_id=message.from_user.id)
+        if gpt_answer is not None:
+            bot.reply_to(message, gpt_answer[1])
 
-            gpt_answer = ask_gpt(message, message.text, user, session)
+    @request_character_blocks_limit_validator(bot)
+    @character_blocks_quota_validator(bot)
+    def _submit_tts_segment(
+            _: types.Message, segment: str, __: RequestContext, quota_reservation: QuotaReservation
+    ) -> tuple[Future, QuotaReservation]:
+        """
+        Start the segment synthesis, its reservation must be settled or released when the synthesis is finished.
+        """
+
+        return tts_executor.submit(copy_context().run, tts.ask, segment), quota_reservation  # keep the request id
+
+    @request_tokens_limit_validator(bot)
+    @tokens_quota_validator(bot)
+    def ask_gpt_and_tts_pipelined(
+            message: types.Message, prompt: str, context: RequestContext, quota_reservation: QuotaReservation
+    ) -> None:
+        """
+        Split the streamed gpt answer into segments of whole sentences and synthesize them concurrently while the answer
+        is still being generated. Voice messages are sent in the answer order as soon as they are ready.
+        """
+
+        history, summary = conversation_summarizer.get_context(context.session, context.user.id)
+
+        sentence_splitter = SentenceSplitter(VOICE_PIPELINE_MIN_SEGMENT_LENGTH)
+        tts_segments: deque[tuple[Future, QuotaReservation, int]] = deque()  # with the segments lengths
+        # the answer is charged as a whole text, not by the segments (each one would be rounded up to a block)
+        charged_characters_amount = 0
+        is_submitting_stopped = False  # a limit is exceeded or a synthesis failed
+        is_sending_stopped = False  # a synthesis failed, the following segments must not be sent to keep the order
+
+        def submit_tts_segments(segments: list[str]) -> None:
+
+            nonlocal is_submitting_stopped
+
+            for segment in segments:
+
+                if is_submitting_stopped:
+                    return
+
+                tts_segment = _submit_tts_segment(message, segment, context)
+
+                if tts_segment is None:  # a limit is exceeded, the validator has already replied
+                    is_submitting_stopped = True
+
+                else:
+                    tts_segments.append((*tts_segment, len(segment)))
+
+        def send_tts_segments(wait: bool) -> None:
+
+            nonlocal is_submitting_stopped, is_sending_stopped, charged_characters_amount
+
+            while tts_segments and (wait or tts_segments[0][0].done()):
+
+                tts_future, tts_segment_reservation, segment_length = tts_segments.popleft()
+                tts_answer = tts_future.result()
+
+                if isinstance(tts_answer, bytes) and not is_sending_stopped:
+
+                    if tts_segment_reservation.amount:  # else the segment is cached and free
+
+                        charged_character_blocks = tts.get_character_blocks(charged_characters_amount)
+                        charged_characters_amount += segment_length
+
+                        tts_segment_reservation.settle(
+                            tts.get_character_blocks(charged_characters_amount) - charged_character_blocks
+                        )
+
+                    else:
+                        tts_segment_reservation.settle()
+
+                    bot.send_voice(message.from_user.id, tts_answer)
+
+                else:
+
+                    tts_segment_reservation.release()
+
+                    if not is_sending_stopped:
+
+                        is_submitting_stopped = is_sending_stopped = True
+
+                        bot.reply_to(message, tts_answer)
+
+        gpt_answer, tokens_spent = USER_FRIENDLY_REQUEST_ERROR_MESSAGE, None
+
+        try:
+
+            for gpt_answer, tokens_spent, is_final in gpt.ask_stream(prompt, history, summary):
+                if not is_final:  # the final item is the whole answer or the error message
+
+                    submit_tts_segments(sentence_splitter.feed(gpt_answer))
+                    send_tts_segments(wait=False)
+
+            if tokens_spent is not None:
+
+                _save_gpt_answer(prompt, gpt_answer, tokens_spent, context, quota_reservation)
+
+                submit_tts_segments(sentence_splitter.flush(gpt_answer))
+                send_tts_segments(wait=True)
+
+            else:
+                quota_reservation.release()
+
+        finally:
+            # not empty only if the answer has failed or the pipeline is interrupted, the synthesized segments of the
+            # failed answer are not sent
+            for tts_future, tts_segment_reservation, _ in tts_segments:
+
+                tts_future.cancel()
+                tts_segment_reservation.release()
 
-            if gpt_answer is not None:
-                bot.reply_to(message, gpt_answer[1])
+        if tokens_spent is None:
+            bot.reply_to(message, gpt_answer)
 
     @bot.message_handler(content_types=['voice'], state=DebugStates.inactive)
     @max_users_amount_limit_validator(bot)
-    def process_voice_message(message: types.Message):
-        with SessionLocal() as session:
+    @request_context_provider()
+    def process_voice_message(message: types.Message, context: RequestContext):
 
-            user = UserCrud(session).get_or_create(telegram_id=message.from_user.id)
+        stt_result = ask_stt(message, context)
 
-            stt_result = ask_stt(message, user, session)
+        if stt_result is None:
+            return
 
-            if stt_result is None:
-                return
+        elif not stt_result[0]:
 
-            elif not stt_result[0]:
+            bot.reply_to(message, stt_result[1])
 
-                bot.reply_to(message, stt_result[1])
+            return
 
-                return
+        if VOICE_PIPELINE_ENABLED:
 
-            gpt_answer = ask_gpt(message, stt_result[1], user, session)
+            ask_gpt_and_tts_pipelined(message, stt_result[1], context)
 
-            if gpt_answer is None:
-                return
+            return
 
-            elif not gpt_answer[0]:
+        gpt_answer = ask_gpt(message, stt_result[1], context)
 
-                bot.reply_to(message, gpt_answer[1])
+        if gpt_answer is None:
+            return
 
-                return
+        elif not gpt_answer[0]:
 
-            tts_answer = ask_tts(message, gpt_answer[1], user, session)
+            bot.reply_to(message, gpt_answer[1])
 
-            if isinstance(tts_answer, bytes):
-                bot.send_voice(message.from_user.id, tts_answer)
+            return
 
-            else:
-                bot.reply_to(message, tts_answer)
+        tts_answer = ask_tts(message, gpt_answer[1], context)
+
+        if isinstance(tts_answer, bytes):
+            bot.send_voice(message.from_user.id, tts_answer)
+
+        else:
+            bot.reply_to(message, tts_answer)
 
     @bot.message_handler(content_types=['text'])
     def unknown_messages_handler(message: types.Message):
+        bot.reply_to(message, get_unknown_message_reply(), reply_markup=get_state_markup(message))
 
-        replies = (
-            'О, круто!',
-            'Верно подмечено!',
-            'Как с языка снял',
-            'Какой ты всё-таки умный',
-            'По-любому что-то умное написал',
-            'Как лаконично-то!',
-        )
+    return bot
+
+
+def create_async_bot() -> UserOrderedAsyncTeleBot:
+    """
+    Create the bot of the async mode: the handlers of create_bot as coroutines using the async services and sessions,
+    wrapped by the same validators. The /stt and /tts test messages are waited for by the states.
+    """
+
+    if BOT_STATE_STORAGE == 'database':
+        state_storage = AsyncDatabaseStateStorage(BOT_STATE_STORAGE_CACHE_MAX_ITEMS)
+
+    else:
+        state_storage = asyncio_storage.StateMemoryStorage()
+
+    bot = UserOrderedAsyncTeleBot(
+        BOT_TOKEN, state_storage=state_storage, max_in_flight_updates=ASYNC_RUNTIME_MAX_IN_FLIGHT_UPDATES
+    )
+
+    bot.add_custom_filter(asyncio_filters.StateFilter(bot))
+
+    async def get_state_markup(message: types.Message) -> types.ReplyKeyboardMarkup:
+        return get_markup(await bot.get_state(message.from_user.id))
+
+    @bot.message_handler(commands=['help', 'start'])
+    async def help_handler(message: types.Message):
+
+        if await bot.get_state(message.from_user.id) is None:
+            await bot.set_state(message.from_user.id, DebugStates.inactive.name)
+
+        await bot.reply_to(message, HELP_MESSAGE, reply_markup=await get_state_markup(message))
+
+    @bot.message_handler(commands=['stats'])
+    async def stats_handler(message: types.Message):
+
+        # the user is not created here, so /stats does not take a place within the users amount limit
+        async with AsyncSessionLocal() as session:
+            user = await session.run_sync(
+                lambda sync_session: UserCrud(sync_session).get(telegram_id=message.from_user.id)
+            )
+
+        await bot.reply_to(message, get_stats_message(user))
+
+    @bot.message_handler(commands=['toggle_debug'])
+    @max_users_amount_limit_validator(bot)
+    async def toggle_debug(message: types.Message):
+
+        if await bot.get_state(message.from_user.id) == DebugStates.active.name:
+            await bot.set_state(message.from_user.id, DebugStates.inactive.name)
+
+        else:
+            await bot.set_state(message.from_user.id, DebugStates.active.name)
+
+        await bot.reply_to(message, 'Debug режим переключён', reply_markup=await get_state_markup(message))
+
+    @request_character_blocks_limit_validator(bot)
+    @character_blocks_quota_validator(bot)
+    async def ask_tts(
+            _: types.Message, prompt: str, __: RequestContext, quota_reservation: AsyncQuotaReservation
+    ) -> bytes | str:
+        """
+        Return a byte voice message if success else an error message string.
+        """
+
+        tts_answer = await tts.ask_async(prompt)
+
+        if isinstance(tts_answer, bytes):
+            await quota_reservation.settle()
+
+        else:
+            await quota_reservation.release()
+
+        return tts_answer
+
+    @request_second_blocks_limit_validator(bot)
+    @second_blocks_quota_validator(bot)
+    async def ask_stt(
+            message: types.Message, _: RequestContext, quota_reservation: AsyncQuotaReservation
+    ) -> tuple[bool, str]:
+        """
+        Return a recognized string and True if success else an error message string and False.
+        """
+
+        file_path = (await bot.get_file(message.voice.file_id)).file_path
+
+        try:
+            if STT_STREAMING_UPLOAD_ENABLED:
+                # a download failed after the upload start fails the STT request
+                async with telegram_files_downloader.open_async(
+                        file_path, STT_STREAMING_UPLOAD_CHUNK_SIZE
+                ) as stt_prompt_chunks:
+                    is_success, stt_answer = await stt.ask_async(stt_prompt_chunks)
+
+            else:
+                with metrics.measure(
+                        'bot_service_request_duration_seconds', service='Telegram files', operation='download'
+                ):
+                    voice_file = await bot.download_file(file_path)
+
+                is_success, stt_answer = await stt.ask_async(voice_file)
+
+        except (asyncio_helper.ApiException, ClientError, TimeoutError, ServiceUnavailableError) as e:
+
+            logger.error(LOGGING_REQUEST_UNKNOWN_ERROR_TEMPLATE.format(
+                service_name='Telegram files', error=e, context=file_path
+            ))
+
+            is_success, stt_answer = False, USER_FRIENDLY_REQUEST_ERROR_MESSAGE
+
+        if is_success:
+            await quota_reservation.settle()
+
+        else:
+            await quota_reservation.release()
+
+        return is_success, stt_answer
+
+    @bot.message_handler(commands=['stt'], state=DebugStates.active.name)
+    @max_users_amount_limit_validator(bot)
+    async def debug_stt(message: types.Message):
+
+        await bot.set_state(message.from_user.id, DebugStates.waiting_stt_voice.name)
+
+        await bot.reply_to(message, 'Отправьте голосовое сообщение для теста')
+
+    @bot.message_handler(content_types=['voice'], state=DebugStates.waiting_stt_voice.name)
+    @request_context_provider()
+    async def _debug_stt(message: types.Message, context: RequestContext):
+
+        await bot.set_state(message.from_user.id, DebugStates.active.name)
+
+        stt_answer = await ask_stt(message, context)
+
+        if stt_answer is not None:
+            await bot.reply_to(message, stt_answer[1], reply_markup=DEBUG_MARKUP)
+
+    @bot.message_handler(commands=['tts'], state=DebugStates.active.name)
+    @max_users_amount_limit_validator(bot)
+    async def debug_tts(message: types.Message):
+
+        await bot.set_state(message.from_user.id, DebugStates.waiting_tts_text.name)
+
+        await bot.reply_to(message, 'Отправьте текстовое сообщение для теста')
+
+    @bot.message_handler(content_types=['text'], state=DebugStates.waiting_tts_text.name)
+    @request_context_provider()
+    async def _debug_tts(message: types.Message, context: RequestContext):
+
+        await bot.set_state(message.from_user.id, DebugStates.active.name)
+
+        tts_answer = await ask_tts(message, message.text, context)
+
+        if tts_answer is not None:
+
+            if isinstance(tts_answer, bytes):
+                await bot.send_voice(message.from_user.id, tts_answer, reply_markup=DEBUG_MARKUP)
+
+            else:
+                await bot.reply_to(message, tts_answer, reply_markup=DEBUG_MARKUP)
+
+    async def _get_logs_file_handler(message: types.Message, log_file_path: Path, visible_file_name: str) -> None:
+        """
+        Send the last records of the log file as a gzip file (see create_bot), the file is read in a thread.
+        """
+
+        records_amount, substring = get_logs_command_arguments(message.text)
+
+        file_data = await to_thread(export_logs, log_file_path, records_amount, substring)
+
+        if file_data is None:
+
+            await bot.reply_to(message, 'Подходящих записей в логах нет!' if substring else 'Файл с логами пуст!')
 
-        help_message = (
-            '\n\nЕсли ты хотел, чтобы я что-то сделал, то я не распознал твою команду, пожалуйста, сверься с /help'
+            return
+
+        await bot.send_document(message.chat.id, file_data, visible_file_name=visible_file_name)
+
+    @bot.message_handler(commands=['get_logs_warning'], func=lambda message: message.from_user.id == DEBUG_USER_ID)
+    async def get_logs_warning_handler(message: types.Message):
+        await _get_logs_file_handler(message, WARNING_LOG_FILE_PATH, 'logs_warning.log.gz')
+
+    @bot.message_handler(commands=['get_logs_info'], func=lambda message: message.from_user.id == DEBUG_USER_ID)
+    async def get_logs_info_handler(message: types.Message):
+        await _get_logs_file_handler(message, INFO_LOG_FILE_PATH, 'logs_info.log.gz')
+
+    @bot.message_handler(commands=['perf'], func=lambda message: message.from_user.id == DEBUG_USER_ID)
+    async def perf_handler(message: types.Message):
+
+        if not metrics.is_enabled:
+
+            await bot.reply_to(message, 'Метрики отключены (METRICS_ENABLED)')
+
+            return
+
+        await bot.reply_to(message, metrics.render_summary() or 'Метрик пока нет')
+
+    async def _save_gpt_answer(
+            prompt: str,
+            gpt_answer: str,
+            tokens_spent: int,
+            context: RequestContext,
+            quota_reservation: AsyncQuotaReservation,
+    ) -> None:
+
+        user_id = context.user.id
+
+        await message_journal.add_async(
+            UserMessage(user_id=user_id, text=prompt, role=RolesEnum.USER),
+            UserMessage(user_id=user_id, text=gpt_answer, role=RolesEnum.ASSISTANT),
         )
 
-        bot.reply_to(message, choice(replies) + help_message, reply_markup=get_state_markup(message))
+        await quota_reservation.settle(tokens_spent)
+
+    @request_tokens_limit_validator(bot)
+    @tokens_quota_validator(bot)
+    async def ask_gpt(
+            _: types.Message, prompt: str, context: RequestContext, quota_reservation: AsyncQuotaReservation
+    ) -> tuple[bool, str]:
+        """
+        Return gpt response and True if success else an error message string and False.
+        """
+
+        history, summary = await conversation_summarizer.get_context_async(context.session, context.user.id)
+
+        gpt_answer, tokens_spent = await gpt.ask_async(prompt, history, summary)
+
+        if tokens_spent is not None:
+            await _save_gpt_answer(prompt, gpt_answer, tokens_spent, context, quota_reservation)
+
+        else:
+            await quota_reservation.release()
+
+        return tokens_spent is not None, gpt_answer
+
+    async def _edit_reply_text(reply: types.Message, text: str) -> None:
+
+        try:
+            await bot.edit_message_text(text, reply.chat.id, reply.message_id)
+
+        except asyncio_helper.ApiTelegramException as e:
+            logger.warning(f'Cannot edit the message text: {e}')
+
+    @request_tokens_limit_validator(bot)
+    @tokens_quota_validator(bot)
+    async def ask_gpt_streaming(
+            message: types.Message, prompt: str, context: RequestContext, quota_reservation: AsyncQuotaReservation
+    ) -> None:
+        """
+        Reply with a placeholder message and edit it (not more often than every GPT_STREAMING_EDIT_INTERVAL seconds)
+        while the gpt answer is being generated.
+        """
+
+        history, summary = await conversation_summarizer.get_context_async(context.session, context.user.id)
+
+        reply = await bot.reply_to(message, 'Думаю...')
+
+        shown_text = reply.text
+        last_edit_time = monotonic()
+        gpt_answer, tokens_spent = USER_FRIENDLY_REQUEST_ERROR_MESSAGE, None
+
+        async for gpt_answer, tokens_spent, _ in gpt.ask_stream_async(prompt, history, summary):
+            if gpt_answer and gpt_answer != shown_text and monotonic() - last_edit_time >= GPT_STREAMING_EDIT_INTERVAL:
+
+                await _edit_reply_text(reply, gpt_answer)
+
+                shown_text = gpt_answer
+                last_edit_time = monotonic()
+
+        if tokens_spent is not None:
+            await _save_gpt_answer(prompt, gpt_answer, tokens_spent, context, quota_reservation)
+
+        else:
+            await quota_reservation.release()
+
+        if gpt_answer != shown_text:
+            await _edit_reply_text(reply, gpt_answer)
+
+    @bot.message_handler(content_types=['text'], state=DebugStates.inactive.name)
+    @max_users_amount_limit_validator(bot)
+    @request_context_provider()
+    async def process_text_message(message: types.Message, context: RequestContext):
+
+        if GPT_STREAMING_ENABLED:
 
-    bot.infinity_polling()
+            await ask_gpt_streaming(message, message.text, context)
+
+            return
+
+        gpt_answer = await ask_gpt(message, message.text, context)
+
+        if gpt_answer is not None:
+            await bot.reply_to(message, gpt_answer[1])
+
+    @request_character_blocks_limit_validator(bot)
+    @character_blocks_quota_validator(bot)
+    async def _submit_tts_segment(
+            _: types.Message, segment: str, __: RequestContext, quota_reservation: AsyncQuotaReservation
+    ) -> tuple[Task, AsyncQuotaReservation]:
+        """
+        Start the segment synthesis, its reservation must be settled or released when the synthesis is finished.
+        """
+
+        return create_task(tts.ask_async(segment)), quota_reservation  # the task keeps the request id
+
+    @request_tokens_limit_validator(bot)
+    @tokens_quota_validator(bot)
+    async def ask_gpt_and_tts_pipelined(
+            message: types.Message, prompt: str, context: RequestContext, quota_reservation: AsyncQuotaReservation
+    ) -> None:
+        """
+        Split the streamed gpt answer into segments of whole sentences and synthesize them concurrently while the answer
+        is still being generated (see create_bot), the segments are synthesized by the tasks.
+        """
+
+        history, summary = await conversation_summarizer.get_context_async(context.session, context.user.id)
+
+        sentence_splitter = SentenceSplitter(VOICE_PIPELINE_MIN_SEGMENT_LENGTH)
+        tts_segments: deque[tuple[Task, AsyncQuotaReservation, int]] = deque()  # with the segments lengths
+        charged_characters_amount = 0
+        is_submitting_stopped = False
+        is_sending_stopped = False
+
+        async def submit_tts_segments(segments: list[str]) -> None:
+
+            nonlocal is_submitting_stopped
+
+            for segment in segments:
+
+                if is_submitting_stopped:
+                    return
+
+                tts_segment = await _submit_tts_segment(message, segment, context)
+
+                if tts_segment is None:  # a limit is exceeded, the validator has already replied
+                    is_submitting_stopped = True
+
+                else:
+                    tts_segments.append((*tts_segment, len(segment)))
+
+        async def send_tts_segments(wait: bool) -> None:
+
+            nonlocal is_submitting_stopped, is_sending_stopped, charged_characters_amount
+
+            while tts_segments and (wait or tts_segments[0][0].done()):
+
+                tts_task, tts_segment_reservation, segment_length = tts_segments.popleft()
+                tts_answer = await tts_task
+
+                if isinstance(tts_answer, bytes) and not is_sending_stopped:
+
+                    if tts_segment_reservation.amount:  # else the segment is cached and free
+
+                        charged_character_blocks = tts.get_character_blocks(charged_characters_amount)
+                        charged_characters_amount += segment_length
+
+                        await tts_segment_reservation.settle(
+                            tts.get_character_blocks(charged_characters_amount) - charged_character_blocks
+                        )
+
+                    else:
+                        await tts_segment_reservation.settle()
+
+                    await bot.send_voice(message.from_user.id, tts_answer)
+
+                else:
+
+                    await tts_segment_reservation.release()
+
+                    if not is_sending_stopped:
+
+                        is_submitting_stopped = is_sending_stopped = True
+
+                        await bot.reply_to(message, tts_answer)
+
+        gpt_answer, tokens_spent = USER_FRIENDLY_REQUEST_ERROR_MESSAGE, None
+
+        try:
+
+            async for gpt_answer, tokens_spent, is_final in gpt.ask_stream_async(prompt, history, summary):
+                if not is_final:  # the final item is the whole answer or the error message
+
+                    await submit_tts_segments(sentence_splitter.feed(gpt_answer))
+                    await send_tts_segments(wait=False)
+
+            if tokens_spent is not None:
+
+                await _save_gpt_answer(prompt, gpt_answer, tokens_spent, context, quota_reservation)
+
+                await submit_tts_segments(sentence_splitter.flush(gpt_answer))
+                await send_tts_segments(wait=True)
+
+            else:
+                await quota_reservation.release()
+
+        finally:
+            # not empty only if the answer has failed or the pipeline is interrupted
+            for tts_task, tts_segment_reservation, _ in tts_segments:
+
+                tts_task.cancel()
+                await tts_segment_reservation.release()
+
+        if tokens_spent is None:
+            await bot.reply_to(message, gpt_answer)
+
+    @bot.message_handler(content_types=['voice'], state=DebugStates.inactive.name)
+    @max_users_amount_limit_validator(bot)
+    @request_context_provider()
+    async def process_voice_message(message: types.Message, context: RequestContext):
+
+        stt_result = await ask_stt(message, context)
+
+        if stt_result is None:
+            return
+
+        elif not stt_result[0]:
+
+            await bot.reply_to(message, stt_result[1])
+
+            return
+
+        if VOICE_PIPELINE_ENABLED:
+
+            await ask_gpt_and_tts_pipelined(message, stt_result[1], context)
+
+            return
+
+        gpt_answer = await ask_gpt(message, stt_result[1], context)
+
+        if gpt_answer is None:
+            return
+
+        elif not gpt_answer[0]:
+
+            await bot.reply_to(message, gpt_answer[1])
+
+            return
+
+        tts_answer = await ask_tts(message, gpt_answer[1], context)
+
+        if isinstance(tts_answer, bytes):
+            await bot.send_voice(message.from_user.id, tts_answer)
+
+        else:
+            await bot.reply_to(message, tts_answer)
+
+    @bot.message_handler(content_types=['text'])
+    async def unknown_messages_handler(message: types.Message):
+        await bot.reply_to(message, get_unknown_message_reply(), reply_markup=await get_state_markup(message))
+
+    return bot
+
+
+def stop_on_sigterm() -> None:
+    """
+    Stop the bot on SIGTERM (docker stop) as on Ctrl+C: the runtime mode stops receiving updates, waits for the queued
+    ones to be processed (up to BOT_STOP_TIMEOUT seconds) and the interpreter exits normally, so the atexit handlers
+    save the message journal and write the queued log records.
+    """
+
+    signal(SIGTERM, default_int_handler)
+
+
+def run_bot() -> None:
+
+    # the webhook server and the multiprocess mode workers serve the metrics themselves
+    if metrics.is_enabled and BOT_RUNTIME_MODE not in ('webhook', 'multiprocess'):
+        start_metrics_server()
+
+    if BOT_RUNTIME_MODE == 'webhook':
+        run_webhook(create_bot())
+
+    elif BOT_RUNTIME_MODE == 'multiprocess':
+        run_multiprocess_polling(create_bot, MULTIPROCESS_RUNTIME_WORKERS_AMOUNT)
+
+    elif BOT_RUNTIME_MODE == 'async':
+        run_async_polling(create_async_bot)
+
+    else:
+        bot = create_bot()
+
+        bot.remove_webhook()  # polling does not work while the webhook is set
+        bot.infinity_polling()  # returns on KeyboardInterrupt
+
+        bot.wait_for_shards(BOT_STOP_TIMEOUT)
 
 
 if __name__ == '__main__':
 
     create_all_tables()
 
+    with SessionLocal() as session:
+        user_admission.warm_up(session)
+
+    quota_engine.start_sweeping()
+
+    stop_on_sigterm()
+
     run_bot()
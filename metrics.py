@@ -0,0 +1,305 @@
+from time import time, perf_counter
+from bisect import bisect_left
+from functools import wraps
+from inspect import iscoroutinefunction
+from contextlib import nullcontext
+from threading import local, Lock
+from typing import Callable, Any, ContextManager
+
+from settings import METRICS_ENABLED
+
+
+# upper bounds (in seconds) of the histograms buckets, the last bucket is +Inf
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+NULL_CONTEXT = nullcontext()  # it is reusable
+
+HISTOGRAMS_HELP = {
+    'bot_handler_duration_seconds': 'Telegram messages handlers duration',
+    'bot_service_request_duration_seconds': 'External services requests duration (streamed ones to the headers)',
+    'bot_db_query_duration_seconds': 'Database queries duration',
+    'bot_db_commit_duration_seconds': 'Database sessions commits duration (with the flush)',
+    'bot_webhook_queue_duration_seconds': 'Webhook updates waiting from the acceptance until passed to the shards',
+}
+
+
+def _escape_label_value(label_value: str) -> str:
+    return label_value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _HistogramShard:
+
+    __slots__ = ('buckets_counts', 'values_sum')
+
+    def __init__(self) -> None:
+
+        self.buckets_counts = [0] * (len(BUCKETS) + 1)
+        self.values_sum = 0.0
+
+
+class _Measurement:
+
+    __slots__ = ('histogram', 'start_time')
+
+    def __init__(self, histogram: 'Histogram') -> None:
+        self.histogram = histogram
+
+    def __enter__(self) -> None:
+        self.start_time = perf_counter()
+
+    def __exit__(self, *_) -> None:
+        self.histogram.observe(perf_counter() - self.start_time)
+
+
+class Histogram:
+    """
+    Every thread writes into its own shard, so the observations take no lock (the lock is taken only once per thread
+    to register its shard). The shards are summed up on reading.
+    """
+
+    def __init__(self, name: str, labels: dict[str, str]) -> None:
+
+        self.name = name
+        self.labels = labels
+
+        self._shards: list[_HistogramShard] = []
+        self._shards_lock = Lock()
+        self._local = local()
+
+    def _create_shard(self) -> _HistogramShard:
+
+        shard = self._local.shard = _HistogramShard()
+
+        with self._shards_lock:
+            self._shards.append(shard)
+
+        return shard
+
+    def observe(self, value: float) -> None:
+
+        shard = getattr(self._local, 'shard', None) or self._create_shard()
+
+        shard.buckets_counts[bisect_left(BUCKETS, value)] += 1
+        shard.values_sum += value
+
+    def time(self) -> _Measurement:
+        """
+        Return a context manager which observes the time spent in it.
+        """
+
+        return _Measurement(self)
+
+    def get_snapshot(self) -> tuple[list[int], float]:
+        """
+        Return the buckets counts (not cumulative) and the sum of the observed values.
+        """
+
+        with self._shards_lock:
+            shards = self._shards[:]
+
+        buckets_counts = [sum(counts) for counts in zip(*(shard.buckets_counts for shard in shards))]
+
+        return buckets_counts or [0] * (len(BUCKETS) + 1), sum(shard.values_sum for shard in shards)
+
+    @staticmethod
+    def get_quantile(buckets_counts: list[int], quantile: float) -> float:
+        """
+        Return the quantile estimate (linear inside the bucket, like Prometheus histogram_quantile does).
+        """
+
+        rank = quantile * sum(buckets_counts)
+        cumulative_count = 0
+
+        for bucket_index, bucket_count in enumerate(buckets_counts):
+
+            if bucket_count and cumulative_count + bucket_count >= rank:
+
+                if bucket_index == len(BUCKETS):  # +Inf bucket
+                    return BUCKETS[-1]
+
+                lower_bound = BUCKETS[bucket_index - 1] if bucket_index else 0
+
+                return lower_bound + (BUCKETS[bucket_index] - lower_bound) * (rank - cumulative_count) / bucket_count
+
+            cumulative_count += bucket_count
+
+        return 0
+
+
+class Metrics:
+    """
+    Registry of the latency histograms and the gauges (the values are taken on reading by the registered functions).
+    If the metrics are disabled, the measurements do nothing.
+    """
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, is_enabled: bool) -> None:
+
+        self.is_enabled = is_enabled
+        self.start_time = time()
+
+        self._histograms: dict[tuple, Histogram] = {}
+        self._gauges: dict[str, tuple[str, list[tuple[dict[str, str], Callable[[], float]]]]] = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def _format_labels(labels: dict[str, str]) -> str:
+
+        if not labels:
+            return ''
+
+        labels_text = ','.join(
+            f'{label_name}="{_escape_label_value(str(label_value))}"' for label_name, label_value in labels.items()
+        )
+
+        return f'{{{labels_text}}}'
+
+    def get_histogram(self, name: str, **labels: str) -> Histogram:
+
+        key = (name, *labels.items())
+
+        histogram = self._histograms.get(key)
+
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram(name, labels))
+
+        return histogram
+
+    def measure(self, name: str, **labels: str) -> ContextManager:
+        """
+        Return a context manager which observes the time spent in it by the histogram.
+        """
+
+        if not self.is_enabled:
+            return NULL_CONTEXT
+
+        return self.get_histogram(name, **labels).time()
+
+    def timed(self, name: str, **labels: str) -> Callable:
+        """
+        Return a decorator which observes the function (or the coroutine function) execution time by the histogram.
+        """
+
+        def decorator(func: Callable) -> Callable:
+
+            if not self.is_enabled:
+                return func
+
+            histogram = self.get_histogram(name, **labels)
+
+            if iscoroutinefunction(func):
+
+                @wraps(func)
+                async def _async_timed(*args, **kwargs) -> Any:
+                    with histogram.time():
+                        return await func(*args, **kwargs)
+
+                return _async_timed
+
+            @wraps(func)
+            def _timed(*args, **kwargs) -> Any:
+                with histogram.time():
+                    return func(*args, **kwargs)
+
+            return _timed
+
+        return decorator
+
+    def register_gauge(self, name: str, help_text: str, get_value: Callable[[], float], **labels: str) -> None:
+
+        if not self.is_enabled:
+            return
+
+        with self._lock:
+            self._gauges.setdefault(name, (help_text, []))[1].append((labels, get_value))
+
+    def _get_histograms_by_name(self) -> dict[str, list[Histogram]]:
+
+        histograms_by_name = {}
+
+        for histogram in sorted(self._histograms.copy().values(), key=lambda item: (item.name, *item.labels.values())):
+            histograms_by_name.setdefault(histogram.name, []).append(histogram)
+
+        return histograms_by_name
+
+    def render_prometheus(self) -> str:
+        """
+        Return the metrics in the Prometheus text exposition format.
+        """
+
+        lines = []
+
+        for name, histograms in self._get_histograms_by_name().items():
+
+            lines += [f'# HELP {name} {HISTOGRAMS_HELP.get(name, name)}', f'# TYPE {name} histogram']
+
+            for histogram in histograms:
+
+                buckets_counts, values_sum = histogram.get_snapshot()
+                cumulative_count = 0
+
+                for bucket_bound, bucket_count in zip((*BUCKETS, '+Inf'), buckets_counts):
+
+                    cumulative_count += bucket_count
+
+                    bucket_labels = self._format_labels({**histogram.labels, 'le': str(bucket_bound)})
+
+                    lines.append(f'{name}_bucket{bucket_labels} {cumulative_count}')
+
+                labels_text = self._format_labels(histogram.labels)
+
+                lines += [f'{name}_sum{labels_text} {values_sum}', f'{name}_count{labels_text} {cumulative_count}']
+
+        for name, (help_text, gauges) in sorted(self._gauges.copy().items()):
+
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge']
+
+            for labels, get_value in gauges:
+                lines.append(f'{name}{self._format_labels(labels)} {float(get_value())}')
+
+        return '\n'.join(lines) + '\n'
+
+    def render_summary(self) -> str:
+        """
+        Return a short human-readable report: requests amount, throughput and latency quantiles (in milliseconds) of
+        every histogram and the gauges values.
+        """
+
+        uptime = max(time() - self.start_time, 1)
+        lines = []
+
+        for name, histograms in self._get_histograms_by_name().items():
+
+            histograms_lines = []
+
+            for histogram in histograms:
+
+                buckets_counts, _ = histogram.get_snapshot()
+                requests_amount = sum(buckets_counts)
+
+                if not requests_amount:
+                    continue
+
+                quantiles_text = ', '.join(
+                    f'p{int(quantile * 100)} {Histogram.get_quantile(buckets_counts, quantile) * 1000:.1f}'
+                    for quantile in self.QUANTILES
+                )
+
+                histograms_lines.append(
+                    f'  {" ".join(histogram.labels.values()) or "all"}: {requests_amount} '
+                    f'({requests_amount / uptime:.2f}/s), {quantiles_text} ms'
+                )
+
+            if histograms_lines:
+                lines += [f'{name.removeprefix("bot_").removesuffix("_duration_seconds")}:', *histograms_lines]
+
+        for name, (_, gauges) in sorted(self._gauges.copy().items()):
+            for labels, get_value in gauges:
+                lines.append(f'{name.removeprefix("bot_")}{self._format_labels(labels)}: {get_value():.2f}')
+
+        return '\n'.join(lines)
+
+
+metrics = Metrics(METRICS_ENABLED)
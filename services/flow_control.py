@@ -0,0 +1,181 @@
+from time import monotonic
+from collections import deque
+from threading import Condition, Lock
+from asyncio import Future, get_running_loop, wait_for
+
+from get_logger import get_logger
+
+
+def _set_future_result(future: Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class AIMDConcurrencyLimiter:
+    """
+    Limits the number of concurrent requests to a service. The limit grows additively (by 1 per limit successful
+    requests) while the service responds in time and is halved on every overload signal (an error, a 429/5xx
+    response or a slow response), so a degraded service gets fewer requests and the threads are not blocked on it. The
+    threads and the coroutines (of the async mode) share the limit.
+    """
+
+    def __init__(self, min_limit: int, max_limit: int) -> None:
+
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+
+        self.limit: float = max_limit
+        self.in_flight = 0
+
+        self._condition = Condition()
+        self._async_waiters: deque[Future] = deque()  # the coroutines waiting for a free slot
+
+    def acquire(self, timeout: float) -> bool:
+        """
+        Wait for a free slot, return False if there is no free slot within the timeout.
+        """
+
+        with self._condition:
+
+            is_acquired = self._condition.wait_for(lambda: self.in_flight < int(self.limit), timeout)
+
+            if is_acquired:
+                self.in_flight += 1
+
+            return is_acquired
+
+    async def acquire_async(self, timeout: float) -> bool:
+        """
+        Like acquire, but the coroutine waits without blocking its event loop.
+        """
+
+        loop = get_running_loop()
+        deadline = loop.time() + timeout
+
+        while True:
+
+            with self._condition:
+
+                if self.in_flight < int(self.limit):
+
+                    self.in_flight += 1
+
+                    return True
+
+                slot_released = loop.create_future()
+
+                self._async_waiters.append(slot_released)
+
+            try:
+                await wait_for(slot_released, deadline - loop.time())
+
+            except TimeoutError:
+                return False
+
+    def _notify_async_waiters(self) -> None:
+        """
+        Wake up as many waiting coroutines as there are free slots (they check the limit again), it is called under the
+        condition lock.
+        """
+
+        free_slots_amount = int(self.limit) - self.in_flight
+
+        while free_slots_amount > 0 and self._async_waiters:
+
+            slot_released = self._async_waiters.popleft()
+
+            if not slot_released.done():  # else its wait is timed out
+
+                slot_released.get_loop().call_soon_threadsafe(_set_future_result, slot_released)
+
+                free_slots_amount -= 1
+
+    def cancel(self) -> None:
+        """
+        Release the slot of the request that was not sent, the limit is not changed.
+        """
+
+        with self._condition:
+
+            self.in_flight -= 1
+
+            self._condition.notify()
+            self._notify_async_waiters()
+
+    def release(self, is_overloaded: bool) -> None:
+        with self._condition:
+
+            self.in_flight -= 1
+
+            if is_overloaded:
+                self.limit = max(self.min_limit, self.limit / 2)
+
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            self._condition.notify_all()
+            self._notify_async_waiters()
+
+
+
+class CircuitBreaker:
+    """
+    Opens after failures_threshold consecutive failures, while it is open the requests are rejected at once. After
+    reset_timeout seconds one trial request is allowed (half-open state), its success closes the circuit, its failure
+    opens it again.
+    """
+
+    def __init__(self, name: str, failures_threshold: int, reset_timeout: float) -> None:
+
+        self.name = name
+        self.failures_threshold = failures_threshold
+        self.reset_timeout = reset_timeout
+
+        self.failures_amount = 0
+        self.opened_at: float | None = None
+        self.is_trial_request_sent = False
+
+        self.logger = get_logger('main')
+
+        self._lock = Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow_request(self) -> bool:
+        with self._lock:
+
+            if self.opened_at is None:
+                return True
+
+            if self.is_trial_request_sent or monotonic() - self.opened_at < self.reset_timeout:
+                return False
+
+            self.is_trial_request_sent = True
+
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+
+            if self.opened_at is not None:
+                self.logger.info(f'{self.name} circuit is closed')
+
+            self.failures_amount = 0
+            self.opened_at = None
+            self.is_trial_request_sent = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+
+            self.failures_amount += 1
+
+            if self.is_trial_request_sent or (
+                    self.opened_at is None and self.failures_amount >= self.failures_threshold
+            ):
+
+                self.logger.warning(f'{self.name} circuit is opened for {self.reset_timeout} seconds')
+
+                self.opened_at = monotonic()
+                self.is_trial_request_sent = False
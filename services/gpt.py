@@ -1,8 +1,17 @@
-from functools import lru_cache
+import re
+from json import loads
+from math import ceil
+from typing import Any, Iterator, AsyncIterator
+from asyncio import to_thread
 
-from requests import post
+from requests import Response
+from aiohttp import ClientResponse
 
+from metrics import metrics
 from get_logger import get_logger
+from services.http_client import HTTPClient, AsyncHTTPClient
+from services.tokens_cache import TokensCountCache
+from services.gpt_cache import GPTResponseCache
 from sql.models import UserMessage
 from settings import (
     GPT_API_KEY,
@@ -12,7 +21,19 @@ from settings import (
     GPT_MODEL,
     GPT_TEMPERATURE,
     GPT_SYSTEM_PROMPT,
+    GPT_SUMMARY_SYSTEM_PROMPT,
     GPT_RESPONSE_MAX_TOKENS,
+    GPT_TOKENS_ESTIMATE_CHARACTERS_PER_TOKEN,
+    GPT_TOKENS_CACHE_MAX_ITEMS,
+    GPT_TOKENS_CACHE_TTL,
+    GPT_TOKENS_CACHE_SHARED,
+    GPT_RESPONSE_CACHE_ENABLED,
+    GPT_RESPONSE_CACHE_MAX_ITEMS,
+    GPT_RESPONSE_CACHE_TTL,
+    GPT_RESPONSE_CACHE_VARIANTS_AMOUNT,
+    GPT_RESPONSE_CACHE_HISTORY_MESSAGES_AMOUNT,
+    GPT_RESPONSE_CACHE_MAX_PROMPT_LENGTH,
+    GPT_RESPONSE_CACHE_HITS_ARE_CHARGED,
     USER_FRIENDLY_REQUEST_ERROR_MESSAGE,
     LOGGING_REQUEST_UNKNOWN_ERROR_TEMPLATE,
     LOGGING_REQUEST_BAD_STATUS_ERROR_TEMPLATE,
@@ -21,101 +42,529 @@ from settings import (
 
 class GPT:
 
+    FINAL_ALTERNATIVE_STATUSES = ('ALTERNATIVE_STATUS_FINAL', 'ALTERNATIVE_STATUS_TRUNCATED_FINAL')
+    SUMMARY_MESSAGE_TEMPLATE = 'Краткое содержание предыдущей части разговора: {summary}'
+    TOKENIZER_SERVICE_TOKENS_AMOUNT = 2  # the start of the text and the word boundary before the first word
+    # the characters of the tokenizer vocabulary: never split into byte tokens, so never more than a token each
+    VOCABULARY_CHARACTERS_PATTERN = re.compile(r'[\u0400-\u04ff]')  # cyrillic
+
     def __init__(self) -> None:
 
         self.logger = get_logger('main')
+        self.http_client = HTTPClient('GPT')
+        self.async_http_client = AsyncHTTPClient(self.http_client)
+        self.tokens_cache = TokensCountCache(GPT_TOKENS_CACHE_MAX_ITEMS, GPT_TOKENS_CACHE_TTL, GPT_TOKENS_CACHE_SHARED)
+        self.response_cache = None
+
+        if GPT_RESPONSE_CACHE_ENABLED:
+            self.response_cache = GPTResponseCache(
+                GPT_RESPONSE_CACHE_MAX_ITEMS,
+                GPT_RESPONSE_CACHE_TTL,
+                GPT_RESPONSE_CACHE_VARIANTS_AMOUNT,
+                GPT_RESPONSE_CACHE_HISTORY_MESSAGES_AMOUNT,
+                GPT_RESPONSE_CACHE_MAX_PROMPT_LENGTH,
+            )
+
+            metrics.register_gauge(
+                'bot_cache_hit_rate', 'Caches hit rates', lambda: self.response_cache.hit_rate, cache='GPT responses'
+            )
+
+        metrics.register_gauge(
+            'bot_cache_hit_rate', 'Caches hit rates', lambda: self.tokens_cache.hit_rate, cache='GPT tokens'
+        )
+
         self.model_uri = f'gpt://{GPT_FOLDER_ID}/{GPT_MODEL}'
         self.headers = {
             'Content-Type': 'application/json',
             'Authorization': f'Api-Key {GPT_API_KEY}',
         }
 
-    @lru_cache(maxsize=25)  # cannot use just "cache" because tokenization is not static
+    def _log_exception(self, error: Exception | str, context: str, log_extra: dict[str, Any] | None = None) -> None:
+        self.logger.error(LOGGING_REQUEST_UNKNOWN_ERROR_TEMPLATE.format(
+            service_name='GPT', error=error, context=context
+        ), extra=log_extra or self.http_client.get_log_extra())
+
+    def _log_bad_status(self, response_status_code: int, context: str, log_extra: dict[str, Any]) -> None:
+        self.logger.error(LOGGING_REQUEST_BAD_STATUS_ERROR_TEMPLATE.format(
+            service_name='GPT', status_code=response_status_code, context=context
+        ), extra=log_extra)
+
+    def _get_tokenize_request_arguments(self, prompt: str) -> dict[str, Any]:
+        return {
+            'operation': 'tokenize',
+            'headers': self.headers,
+            'json': {
+                'modelUri': self.model_uri,
+                'text': prompt,
+            },
+        }
+
     def get_prompt_tokens_amount(self, prompt: str) -> int | None:
 
+        tokens_amount = self.tokens_cache.get(prompt)
+
+        if tokens_amount is not None:
+            return tokens_amount
+
         try:
-            response = post(
-                GPT_TOKENIZE_URL,
-                headers=self.headers,
-                json={
-                    'modelUri': self.model_uri,
-                    'text': prompt,
-                },
+            response = self.http_client.post(GPT_TOKENIZE_URL, **self._get_tokenize_request_arguments(prompt))
+
+        except Exception as e:
+
+            self._log_exception(e, prompt)
+
+            return
+
+        if response.status_code != 200:
+
+            self._log_bad_status(response.status_code, prompt, self.http_client.get_log_extra(response))
+
+            return
+
+        tokens_amount = len(response.json()['tokens'])
+
+        self.tokens_cache.set(prompt, tokens_amount)
+
+        return tokens_amount
+
+    async def get_prompt_tokens_amount_async(self, prompt: str) -> int | None:
+        """
+        Like get_prompt_tokens_amount, for the async mode. The shared counts are read and written in the default
+        executor threads.
+        """
+
+        if self.tokens_cache.is_shared:
+            tokens_amount = await to_thread(self.tokens_cache.get, prompt)
+
+        else:
+            tokens_amount = self.tokens_cache.get(prompt)
+
+        if tokens_amount is not None:
+            return tokens_amount
+
+        try:
+            response = await self.async_http_client.post(
+                GPT_TOKENIZE_URL, **self._get_tokenize_request_arguments(prompt)
             )
 
         except Exception as e:
 
-            self.logger.error(LOGGING_REQUEST_UNKNOWN_ERROR_TEMPLATE.format(
-                service_name='GPT', error=e, context=prompt
-            ))
+            self._log_exception(e, prompt)
 
             return
 
-        response_status_code = response.status_code
+        if response.status != 200:
+
+            self._log_bad_status(response.status, prompt, self.async_http_client.get_log_extra(response))
+
+            return
+
+        tokens_amount = len((await response.json(content_type=None))['tokens'])
+
+        if self.tokens_cache.is_shared:
+            await to_thread(self.tokens_cache.set, prompt, tokens_amount)
+
+        else:
+            self.tokens_cache.set(prompt, tokens_amount)
+
+        return tokens_amount
+
+    @staticmethod
+    def estimate_prompt_tokens_amount(prompt: str) -> int:
+        """
+        Return a typical prompt tokens amount (used for the quota reservations and the history budget, the spent
+        tokens are settled by the real amount).
+        """
+
+        return ceil(len(prompt) / GPT_TOKENS_ESTIMATE_CHARACTERS_PER_TOKEN)
+
+    @classmethod
+    def get_prompt_tokens_upper_bound(cls, prompt: str) -> int:
+        """
+        Return an amount the prompt tokens never exceed: every token of the byte-fallback tokenizer covers at least one
+        byte of the UTF-8 encoded prompt, except the service tokens, and the cyrillic characters are never split into
+        their two bytes (the bytes bound would be twice the length of a russian prompt).
+        """
+
+        other_characters = cls.VOCABULARY_CHARACTERS_PATTERN.sub('', prompt)
+        vocabulary_characters_amount = len(prompt) - len(other_characters)
+
+        return vocabulary_characters_amount + len(other_characters.encode()) + cls.TOKENIZER_SERVICE_TOKENS_AMOUNT
+
+    def is_prompt_within_tokens_limit(self, prompt: str, tokens_limit: int) -> bool:
+        """
+        Return True if the prompt tokens amount is not greater than the tokens_limit. The prompt passes without the
+        remote tokenizer if its upper bound is within the limit, else the tokenizer is requested (the prompt is
+        rejected if the tokenizer is unavailable, the bound is the only safe estimate then).
+        """
+
+        if self.get_prompt_tokens_upper_bound(prompt) <= tokens_limit:
+            return True
 
-        if response_status_code != 200:
+        tokens_amount = self.get_prompt_tokens_amount(prompt)
 
-            self.logger.error(LOGGING_REQUEST_BAD_STATUS_ERROR_TEMPLATE.format(
-                service_name='GPT', status_code=response_status_code, context=prompt
-            ))
+        return tokens_amount is not None and tokens_amount <= tokens_limit
 
+    async def is_prompt_within_tokens_limit_async(self, prompt: str, tokens_limit: int) -> bool:
+
+        if self.get_prompt_tokens_upper_bound(prompt) <= tokens_limit:
+            return True
+
+        tokens_amount = await self.get_prompt_tokens_amount_async(prompt)
+
+        return tokens_amount is not None and tokens_amount <= tokens_limit
+
+    def get_messages(
+            self, prompt: str, previous_messages: list[UserMessage], summary: str | None = None
+    ) -> list[dict[str, str]]:
+
+        messages = [{'role': 'system', 'text': GPT_SYSTEM_PROMPT}]
+
+        if summary:
+            messages.append({'role': 'system', 'text': self.SUMMARY_MESSAGE_TEMPLATE.format(summary=summary)})
+
+        messages.extend({'role': str(message.role), 'text': message.text} for message in previous_messages)
+        messages.append({'role': 'user', 'text': prompt})
+
+        return messages
+
+    def _get_response_cache_key(
+            self, prompt: str, previous_messages: list[UserMessage], summary: str | None
+    ) -> str | None:
+        """
+        Return the response cache key or None if the answer must not be cached.
+        """
+
+        if self.response_cache is not None:
+            return self.response_cache.get_key(prompt, previous_messages, summary)
+
+    def _get_cached_answer(self, response_cache_key: str | None) -> tuple[str, int] | None:
+        """
+        Return a cached answer and a number of tokens to charge for it (0 if GPT_RESPONSE_CACHE_HITS_ARE_CHARGED is
+        False) or None if there is no answer to return.
+        """
+
+        if response_cache_key is None:
             return
 
-        return len(response.json()['tokens'])
+        cached_answer = self.response_cache.get(response_cache_key)
+
+        if cached_answer is None:
+            return
+
+        self.logger.info('GPT answer is taken from the cache')
+
+        answer, tokens_spent = cached_answer
 
-    def ask(self, prompt: str, previous_messages: list[UserMessage]) -> tuple[str, int | None]:
+        return answer, tokens_spent if GPT_RESPONSE_CACHE_HITS_ARE_CHARGED else 0
+
+    def _get_completion_request_arguments(self, messages: list[dict[str, str]], stream: bool) -> dict[str, Any]:
+        return {
+            'operation': 'completion',
+            'headers': self.headers,
+            'json': {
+                'modelUri': self.model_uri,
+                'completionOptions': {
+                    'temperature': GPT_TEMPERATURE,
+                    'maxTokens': GPT_RESPONSE_MAX_TOKENS,
+                    'stream': stream,
+                },
+                'messages': messages,
+            },
+            'stream': stream,
+        }
+
+    def _post_completion_request(self, messages: list[dict[str, str]], prompt: str, stream: bool) -> Response | None:
         """
-        Return a GPT answer text and a total number of tokens spent on this request if success else an error message
-        and None.
+        Return a completion response if success else log the error (with the prompt as the context) and return None.
         """
 
-        messages = [
-            {'role': 'system', 'text': GPT_SYSTEM_PROMPT},
-            *({'role': str(message.role), 'text': message.text} for message in previous_messages),
-            {'role': 'user', 'text': prompt},
-        ]
+        try:
+            response = self.http_client.post(GPT_URL, **self._get_completion_request_arguments(messages, stream))
+
+        except Exception as e:
+
+            self._log_exception(e, prompt)
+
+            return
+
+        if response.status_code != 200:
+
+            self._log_bad_status(response.status_code, prompt, self.http_client.get_log_extra(response))
+
+            response.close()
+
+            return
+
+        return response
+
+    async def _post_completion_request_async(
+            self, messages: list[dict[str, str]], prompt: str, stream: bool
+    ) -> ClientResponse | None:
 
         try:
-            response = post(
-                GPT_URL,
-                headers=self.headers,
-                json={
-                    'modelUri': self.model_uri,
-                    'completionOptions': {
-                        'temperature': GPT_TEMPERATURE,
-                        'maxTokens': GPT_RESPONSE_MAX_TOKENS,
-                        'stream': False,
-                    },
-                    'messages': messages,
-                },
+            response = await self.async_http_client.post(
+                GPT_URL, **self._get_completion_request_arguments(messages, stream)
             )
 
         except Exception as e:
 
-            self.logger.error(LOGGING_REQUEST_UNKNOWN_ERROR_TEMPLATE.format(
-                service_name='GPT', error=e, context=prompt
-            ))
+            self._log_exception(e, prompt)
 
-            return USER_FRIENDLY_REQUEST_ERROR_MESSAGE, None
+            return
 
-        response_status_code = response.status_code
+        if response.status != 200:
 
-        if response_status_code != 200:
+            self._log_bad_status(response.status, prompt, self.async_http_client.get_log_extra(response))
 
-            self.logger.error(LOGGING_REQUEST_BAD_STATUS_ERROR_TEMPLATE.format(
-                service_name='GPT', status_code=response_status_code, context=prompt
-            ))
+            response.release()
 
-            return USER_FRIENDLY_REQUEST_ERROR_MESSAGE, None
+            return
+
+        return response
 
-        response_json = response.json()['result']
+    def _save_answer(self, response_cache_key: str | None, response_json: dict) -> tuple[str, int]:
+        """
+        Return the answer text and the tokens spent on it from the final completion result, cache the answer.
+        """
 
         answer = response_json['alternatives'][0]['message']['text']
         tokens_spent = int(response_json['usage']['completionTokens'])
 
-        self.logger.info('GPT request success')
+        if response_cache_key is not None:
+            self.response_cache.add(response_cache_key, answer, tokens_spent)
 
         return answer, tokens_spent
 
+    def ask(
+            self, prompt: str, previous_messages: list[UserMessage], summary: str | None = None
+    ) -> tuple[str, int | None]:
+        """
+        Return a GPT answer text and a total number of tokens spent on this request if success else an error message
+        and None. The summary of the conversation older than previous_messages is sent as a system message.
+        """
+
+        response_cache_key = self._get_response_cache_key(prompt, previous_messages, summary)
+        cached_answer = self._get_cached_answer(response_cache_key)
+
+        if cached_answer is not None:
+            return cached_answer
+
+        response = self._post_completion_request(
+            self.get_messages(prompt, previous_messages, summary), prompt, stream=False
+        )
+
+        if response is None:
+            return USER_FRIENDLY_REQUEST_ERROR_MESSAGE, None
+
+        self.logger.info('GPT request success', extra=self.http_client.get_log_extra(response))
+
+        return self._save_answer(response_cache_key, response.json()['result'])
+
+    async def ask_async(
+            self, prompt: str, previous_messages: list[UserMessage], summary: str | None = None
+    ) -> tuple[str, int | None]:
+        """
+        Like ask, for the async mode.
+        """
+
+        response_cache_key = self._get_response_cache_key(prompt, previous_messages, summary)
+        cached_answer = self._get_cached_answer(response_cache_key)
+
+        if cached_answer is not None:
+            return cached_answer
+
+        response = await self._post_completion_request_async(
+            self.get_messages(prompt, previous_messages, summary), prompt, stream=False
+        )
+
+        if response is None:
+            return USER_FRIENDLY_REQUEST_ERROR_MESSAGE, None
+
+        self.logger.info('GPT request success', extra=self.async_http_client.get_log_extra(response))
+
+        return self._save_answer(response_cache_key, (await response.json(content_type=None))['result'])
+
+    def _parse_stream_line(
+            self, line: bytes, response_cache_key: str | None, log_extra: dict[str, Any]
+    ) -> tuple[str, int | None, bool] | None:
+        """
+        Return the item to yield by the stream line (None for an empty line), the final answer is cached.
+        """
+
+        if not line.strip():
+            return
+
+        response_json = loads(line)['result']
+        alternative = response_json['alternatives'][0]
+
+        if alternative['status'] in self.FINAL_ALTERNATIVE_STATUSES:
+
+            self.logger.info('GPT request success', extra=log_extra)
+
+            return *self._save_answer(response_cache_key, response_json), True
+
+        return alternative['message']['text'], None, False
+
+    def ask_stream(
+            self, prompt: str, previous_messages: list[UserMessage], summary: str | None = None
+    ) -> Iterator[tuple[str, int | None, bool]]:
+        """
+        Yield a GPT answer text generated so far, None and False while the answer is being generated. The last yielded
+        item is the whole answer text, a total number of tokens spent on this request and True if success else an error
+        message, None and True.
+        """
+
+        response_cache_key = self._get_response_cache_key(prompt, previous_messages, summary)
+        cached_answer = self._get_cached_answer(response_cache_key)
+
+        if cached_answer is not None:
+
+            yield *cached_answer, True
+
+            return
+
+        response = self._post_completion_request(
+            self.get_messages(prompt, previous_messages, summary), prompt, stream=True
+        )
+
+        if response is None:
+
+            yield USER_FRIENDLY_REQUEST_ERROR_MESSAGE, None, True
+
+            return
+
+        try:
+            with response:
+                for line in response.iter_lines():
+
+                    stream_item = self._parse_stream_line(
+                        line, response_cache_key, self.http_client.get_log_extra(response)
+                    )
+
+                    if stream_item is None:
+                        continue
+
+                    yield stream_item
+
+                    if stream_item[2]:
+                        return
+
+        except Exception as e:
+
+            self._log_exception(e, prompt, self.http_client.get_log_extra(response))
+
+            yield USER_FRIENDLY_REQUEST_ERROR_MESSAGE, None, True
+
+            return
+
+        self._log_exception(
+            'the stream ended without a final answer', prompt, self.http_client.get_log_extra(response)
+        )
+
+        yield USER_FRIENDLY_REQUEST_ERROR_MESSAGE, None, True
+
+    async def ask_stream_async(
+            self, prompt: str, previous_messages: list[UserMessage], summary: str | None = None
+    ) -> AsyncIterator[tuple[str, int | None, bool]]:
+        """
+        Like ask_stream, for the async mode.
+        """
+
+        response_cache_key = self._get_response_cache_key(prompt, previous_messages, summary)
+        cached_answer = self._get_cached_answer(response_cache_key)
+
+        if cached_answer is not None:
+
+            yield *cached_answer, True
+
+            return
+
+        response = await self._post_completion_request_async(
+            self.get_messages(prompt, previous_messages, summary), prompt, stream=True
+        )
+
+        if response is None:
+
+            yield USER_FRIENDLY_REQUEST_ERROR_MESSAGE, None, True
+
+            return
+
+        try:
+            async with response:
+                async for line in response.content:
+
+                    stream_item = self._parse_stream_line(
+                        line, response_cache_key, self.async_http_client.get_log_extra(response)
+                    )
+
+                    if stream_item is None:
+                        continue
+
+                    yield stream_item
+
+                    if stream_item[2]:
+                        return
+
+        except Exception as e:
+
+            self._log_exception(e, prompt, self.async_http_client.get_log_extra(response))
+
+            yield USER_FRIENDLY_REQUEST_ERROR_MESSAGE, None, True
+
+            return
+
+        self._log_exception(
+            'the stream ended without a final answer', prompt, self.async_http_client.get_log_extra(response)
+        )
+
+        yield USER_FRIENDLY_REQUEST_ERROR_MESSAGE, None, True
+
+    def _get_summary_messages(self, summary: str | None, messages: list[UserMessage]) -> tuple[list[dict], str]:
+        """
+        Return the summary request messages and the conversation (the context of the request errors).
+        """
+
+        conversation = '\n'.join(f'{message.role}: {message.text}' for message in messages)
+
+        if summary:
+            conversation = f'{self.SUMMARY_MESSAGE_TEMPLATE.format(summary=summary)}\n\n{conversation}'
+
+        return [{'role': 'system', 'text': GPT_SUMMARY_SYSTEM_PROMPT}, {'role': 'user', 'text': conversation}], \
+            conversation
+
+    def _get_summary(self, response_json: dict, log_extra: dict[str, Any]) -> str:
+
+        self.logger.info(
+            f'GPT summary request success, tokens spent: {response_json["usage"]["totalTokens"]}', extra=log_extra
+        )
+
+        return response_json['alternatives'][0]['message']['text']
+
+    def summarize(self, summary: str | None, messages: list[UserMessage]) -> str | None:
+        """
+        Return a new summary of the conversation (the previous summary continued by the messages) if success else None.
+        """
+
+        response = self._post_completion_request(*self._get_summary_messages(summary, messages), stream=False)
+
+        if response is None:
+            return
+
+        return self._get_summary(response.json()['result'], self.http_client.get_log_extra(response))
+
+    async def summarize_async(self, summary: str | None, messages: list[UserMessage]) -> str | None:
+
+        response = await self._post_completion_request_async(
+            *self._get_summary_messages(summary, messages), stream=False
+        )
+
+        if response is None:
+            return
+
+        return self._get_summary(
+            (await response.json(content_type=None))['result'], self.async_http_client.get_log_extra(response)
+        )
+
 
 gpt = GPT()
@@ -0,0 +1,130 @@
+import re
+from time import time
+from hashlib import sha256
+from threading import Lock
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from sql.models import UserMessage
+from settings import GPT_MODEL, GPT_SYSTEM_PROMPT
+
+
+@dataclass
+class GPTResponseCacheItem:
+
+    expires_at: float
+    variants: list[tuple[str, int]] = field(default_factory=list)  # (answer, tokens spent)
+    answers_amount: int = 0  # the answers added, the same answers are stored once
+    next_variant_index: int = 0
+
+
+class GPTResponseCache:
+    """
+    Bounded LRU cache of the GPT answers with TTL expiry. The key is the normalized prompt (case, whitespace and
+    punctuation are folded) and a fingerprint of the last history_messages_amount messages and the summary. The first
+    variants_amount answers for every key are collected (all requests are misses until then, the same answers are
+    stored once), after that the hits rotate them, so the answers do not feel canned.
+    """
+
+    PUNCTUATION_PATTERN = re.compile(r'[^\w\s]')
+    WHITESPACE_PATTERN = re.compile(r'\s+')
+
+    def __init__(
+            self, max_items: int, ttl: float, variants_amount: int, history_messages_amount: int, max_prompt_length: int
+    ) -> None:
+
+        self.max_items = max_items
+        self.ttl = ttl
+        self.variants_amount = variants_amount
+        self.history_messages_amount = history_messages_amount
+        self.max_prompt_length = max_prompt_length
+
+        self.hits = 0
+        self.misses = 0
+
+        self._items: OrderedDict[str, GPTResponseCacheItem] = OrderedDict()
+        self._lock = Lock()
+
+    @property
+    def hit_rate(self) -> float:
+
+        requests_amount = self.hits + self.misses
+
+        return self.hits / requests_amount if requests_amount else 0
+
+    @classmethod
+    def normalize(cls, text: str) -> str:
+
+        text = cls.PUNCTUATION_PATTERN.sub(' ', text.lower().replace('ё', 'е'))
+
+        return cls.WHITESPACE_PATTERN.sub(' ', text).strip()
+
+    def get_key(self, prompt: str, previous_messages: list[UserMessage], summary: str | None) -> str | None:
+        """
+        Return the cache key or None if the prompt is too long to be cached.
+        """
+
+        if len(prompt) > self.max_prompt_length:
+            return
+
+        history = previous_messages[-self.history_messages_amount:] if self.history_messages_amount else []
+
+        key_parts = [
+            GPT_MODEL,
+            GPT_SYSTEM_PROMPT,
+            summary or '',
+            *(f'{message.role}: {self.normalize(message.text)}' for message in history),
+            self.normalize(prompt),
+        ]
+
+        return sha256('\0'.join(key_parts).encode()).hexdigest()
+
+    def get(self, key: str) -> tuple[str, int] | None:
+
+        with self._lock:
+
+            item = self._items.get(key)
+
+            if item is not None and item.expires_at <= time():
+
+                del self._items[key]
+
+                item = None
+
+            if item is None or item.answers_amount < self.variants_amount:
+
+                self.misses += 1
+
+                return
+
+            self._items.move_to_end(key)
+
+            self.hits += 1
+
+            variant = item.variants[item.next_variant_index]
+
+            item.next_variant_index = (item.next_variant_index + 1) % len(item.variants)
+
+            return variant
+
+    def add(self, key: str, answer: str, tokens_spent: int) -> None:
+        """
+        Add the answer variant, the same answers are stored once.
+        """
+
+        with self._lock:
+
+            item = self._items.get(key)
+
+            if item is None or item.expires_at <= time():
+                item = self._items[key] = GPTResponseCacheItem(time() + self.ttl)
+
+            item.answers_amount += 1
+
+            if len(item.variants) < self.variants_amount and answer not in (variant[0] for variant in item.variants):
+                item.variants.append((answer, tokens_spent))
+
+            self._items.move_to_end(key)
+
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
@@ -0,0 +1,349 @@
+from time import monotonic
+from random import random
+from typing import Any
+from datetime import timedelta
+from asyncio import AbstractEventLoop, CancelledError, get_running_loop, sleep
+
+from requests import Session, Response
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from aiohttp import ClientSession, ClientResponse, ClientTimeout, ClientConnectorError, TCPConnector
+
+from metrics import metrics
+from services.flow_control import AIMDConcurrencyLimiter, CircuitBreaker
+from settings import (
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    HTTP_RETRIES_AMOUNT,
+    HTTP_RETRY_BACKOFF_FACTOR,
+    HTTP_RETRY_BACKOFF_JITTER,
+    HTTP_CONCURRENCY_MIN_LIMIT,
+    HTTP_CONCURRENCY_MAX_LIMIT,
+    HTTP_CONCURRENCY_QUEUE_TIMEOUT,
+    HTTP_CONCURRENCY_SLOW_RESPONSE_TIME,
+    HTTP_CIRCUIT_BREAKER_FAILURES_THRESHOLD,
+    HTTP_CIRCUIT_BREAKER_RESET_TIMEOUT,
+)
+
+
+class ServiceUnavailableError(Exception):
+    """
+    The request is rejected without sending: the service circuit is open.
+    """
+
+
+class HTTPClient:
+    """
+    Keep-alive HTTP client with its own connection pool (one per service), timeouts and retries with jittered backoff
+    for 429 and 5xx responses. The requests go through the service adaptive concurrency limiter and circuit breaker,
+    so a failing service fails fast with ServiceUnavailableError instead of blocking the handlers. The connection pool
+    is sized by the limiter max limit (the most requests sent at once).
+    """
+
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(self, service_name: str, pool_size: int = HTTP_CONCURRENCY_MAX_LIMIT) -> None:
+
+        retry = Retry(
+            total=HTTP_RETRIES_AMOUNT,
+            connect=HTTP_RETRIES_AMOUNT,
+            read=0,  # the request may be already processed (and billed) by the service
+            status_forcelist=self.RETRY_STATUS_CODES,
+            allowed_methods=None,  # retry POST requests too
+            backoff_factor=HTTP_RETRY_BACKOFF_FACTOR,
+            backoff_jitter=HTTP_RETRY_BACKOFF_JITTER,
+            respect_retry_after_header=True,
+            raise_on_status=False,  # return the last response, its status code is handled by the services
+        )
+
+        self.session = self._create_session(HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry))
+        # for the streamed request bodies, they can not be sent again
+        self.no_retries_session = self._create_session(
+            HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        )
+
+        self.service_name = service_name
+        self.pool_size = pool_size
+
+        self.concurrency_limiter = AIMDConcurrencyLimiter(HTTP_CONCURRENCY_MIN_LIMIT, HTTP_CONCURRENCY_MAX_LIMIT)
+        self.circuit_breaker = CircuitBreaker(
+            service_name, HTTP_CIRCUIT_BREAKER_FAILURES_THRESHOLD, HTTP_CIRCUIT_BREAKER_RESET_TIMEOUT
+        )
+
+        metrics.register_gauge(
+            'bot_service_concurrency_limit',
+            'Adaptive concurrency limits of the services requests',
+            lambda: int(self.concurrency_limiter.limit),
+            service=service_name,
+        )
+        metrics.register_gauge(
+            'bot_service_in_flight_requests',
+            'Services requests in flight',
+            lambda: self.concurrency_limiter.in_flight,
+            service=service_name,
+        )
+        metrics.register_gauge(
+            'bot_service_circuit_open',
+            'Services circuits states (1 - open)',
+            lambda: self.circuit_breaker.is_open,
+            service=service_name,
+        )
+
+    @staticmethod
+    def _create_session(adapter: HTTPAdapter) -> Session:
+
+        session = Session()
+
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        return session
+
+    def request(
+            self, method: str, url: str, is_retried: bool = True, operation: str = 'request', **kwargs
+    ) -> Response:
+        """
+        Send the request or raise ServiceUnavailableError. For the streamed responses only the time to the response
+        headers is limited and measured. The request must not be retried if its body is an iterator. The operation is
+        the label of the request duration metric.
+        """
+
+        # the request waits for a free slot while the circuit is closed: the in-flight requests end within the timeouts,
+        # so the queue is not a failure, the waiting requests fail only when the failures open the circuit
+        while not self.concurrency_limiter.acquire(HTTP_CONCURRENCY_QUEUE_TIMEOUT):
+            if self.circuit_breaker.is_open:
+                raise ServiceUnavailableError(f'{self.circuit_breaker.name} circuit is open')
+
+        if not self.circuit_breaker.allow_request():
+
+            self.concurrency_limiter.cancel()
+
+            raise ServiceUnavailableError(f'{self.circuit_breaker.name} circuit is open')
+
+        request_start_time = monotonic()
+
+        request_duration_measurement = metrics.measure(
+            'bot_service_request_duration_seconds', service=self.service_name, operation=operation
+        )
+
+        try:
+            with request_duration_measurement:
+                response = (self.session if is_retried else self.no_retries_session).request(
+                    method, url, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), **kwargs
+                )
+
+        except Exception:
+
+            self.concurrency_limiter.release(is_overloaded=True)
+            self.circuit_breaker.record_failure()
+
+            raise
+
+        is_failed = response.status_code in self.RETRY_STATUS_CODES
+
+        self.concurrency_limiter.release(
+            is_overloaded=is_failed or monotonic() - request_start_time > HTTP_CONCURRENCY_SLOW_RESPONSE_TIME
+        )
+
+        if is_failed:
+            self.circuit_breaker.record_failure()
+
+        else:
+            self.circuit_breaker.record_success()
+
+        return response
+
+    def get_log_extra(self, response: Response | None = None) -> dict[str, Any]:
+        """
+        Return the "extra" of the request log record: the service name and the response latency (the time to the
+        response headers, in seconds) if the response is given.
+        """
+
+        log_extra = {'service_name': self.service_name}
+
+        if response is not None:
+            log_extra['latency'] = response.elapsed.total_seconds()
+
+        return log_extra
+
+    def get(self, url: str, **kwargs) -> Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> Response:
+        return self.request('POST', url, **kwargs)
+
+
+class AsyncHTTPClient:
+    """
+    The asyncio counterpart of the service HTTPClient (for the async mode): the same timeouts and retries with jittered
+    backoff, the requests go through the concurrency limiter and the circuit breaker of the HTTPClient (so the limits
+    and the metrics are shared). The aiohttp session is created on the first request in the running event loop.
+    """
+
+    instances: list['AsyncHTTPClient'] = []
+
+    def __init__(self, http_client: HTTPClient) -> None:
+
+        self.http_client = http_client
+        self.service_name = http_client.service_name
+        self.concurrency_limiter = http_client.concurrency_limiter
+        self.circuit_breaker = http_client.circuit_breaker
+
+        self.session: ClientSession | None = None
+        self._session_loop: AbstractEventLoop | None = None
+
+        AsyncHTTPClient.instances.append(self)
+
+    def _get_session(self) -> ClientSession:
+
+        loop = get_running_loop()
+
+        if self.session is None or self.session.closed or self._session_loop is not loop:
+
+            self.session = ClientSession(
+                connector=TCPConnector(limit=self.http_client.pool_size),
+                timeout=ClientTimeout(total=None, sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT),
+            )
+            self._session_loop = loop
+
+        return self.session
+
+    @staticmethod
+    def _get_retry_delay(retry_number: int, response: ClientResponse | None) -> float:
+        """
+        Return the delay before the retry like urllib3 Retry does: the Retry-After header seconds if it is given, else
+        no delay before the first retry and the exponential backoff with a random jitter before the next ones.
+        """
+
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            return float(response.headers['Retry-After'])
+
+        if retry_number <= 1:
+            return 0
+
+        return HTTP_RETRY_BACKOFF_FACTOR * 2 ** (retry_number - 1) + random() * HTTP_RETRY_BACKOFF_JITTER
+
+    async def _send(self, method: str, url: str, is_retried: bool, stream: bool, **kwargs) -> ClientResponse:
+
+        session = self._get_session()
+        retries_amount = HTTP_RETRIES_AMOUNT if is_retried else 0
+
+        for retry_number in range(retries_amount + 1):
+
+            request_start_time = monotonic()
+
+            try:
+                response = await session.request(method, url, **kwargs)
+
+            except ClientConnectorError:
+
+                if retry_number == retries_amount:
+                    raise
+
+                await sleep(self._get_retry_delay(retry_number + 1, None))
+
+                continue
+
+            response.elapsed = timedelta(seconds=monotonic() - request_start_time)  # like requests.Response.elapsed
+
+            if response.status in HTTPClient.RETRY_STATUS_CODES and retry_number < retries_amount:
+
+                response.release()
+
+                await sleep(self._get_retry_delay(retry_number + 1, response))
+
+                continue
+
+            if not stream:
+                try:
+                    await response.read()  # the connection is released after the body is read
+
+                except BaseException:
+
+                    response.close()
+
+                    raise
+
+            return response
+
+    async def request(
+            self, method: str, url: str, is_retried: bool = True, operation: str = 'request', stream: bool = False,
+            **kwargs
+    ) -> ClientResponse:
+        """
+        Send the request or raise ServiceUnavailableError. The body of the not streamed response is read, the streamed
+        response must be released by the caller (for example, by "async with response"). The request must not be
+        retried if its body is an async iterator. The operation is the label of the request duration metric.
+        """
+
+        while not await self.concurrency_limiter.acquire_async(HTTP_CONCURRENCY_QUEUE_TIMEOUT):
+            if self.circuit_breaker.is_open:
+                raise ServiceUnavailableError(f'{self.circuit_breaker.name} circuit is open')
+
+        if not self.circuit_breaker.allow_request():
+
+            self.concurrency_limiter.cancel()
+
+            raise ServiceUnavailableError(f'{self.circuit_breaker.name} circuit is open')
+
+        request_start_time = monotonic()
+
+        request_duration_measurement = metrics.measure(
+            'bot_service_request_duration_seconds', service=self.service_name, operation=operation
+        )
+
+        try:
+            with request_duration_measurement:
+                response = await self._send(method, url, is_retried, stream, **kwargs)
+
+        except CancelledError:  # the handler is cancelled, it is not a service failure
+
+            self.concurrency_limiter.cancel()
+
+            raise
+
+        except Exception:
+
+            self.concurrency_limiter.release(is_overloaded=True)
+            self.circuit_breaker.record_failure()
+
+            raise
+
+        is_failed = response.status in HTTPClient.RETRY_STATUS_CODES
+
+        self.concurrency_limiter.release(
+            is_overloaded=is_failed or monotonic() - request_start_time > HTTP_CONCURRENCY_SLOW_RESPONSE_TIME
+        )
+
+        if is_failed:
+            self.circuit_breaker.record_failure()
+
+        else:
+            self.circuit_breaker.record_success()
+
+        return response
+
+    def get_log_extra(self, response: ClientResponse | None = None) -> dict[str, Any]:
+        return self.http_client.get_log_extra(response)
+
+    async def get(self, url: str, **kwargs) -> ClientResponse:
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> ClientResponse:
+        return await self.request('POST', url, **kwargs)
+
+    async def close(self) -> None:
+        if self.session is not None:
+
+            await self.session.close()
+
+            self.session = None
+
+    @classmethod
+    async def close_all(cls) -> None:
+        """
+        Close the sessions of all clients (on the event loop stop).
+        """
+
+        for async_http_client in cls.instances:
+            await async_http_client.close()
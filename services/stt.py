@@ -1,9 +1,9 @@
 from math import ceil
+from typing import Any, Iterator, AsyncIterator
 from functools import cache
 
-from requests import post
-
 from get_logger import get_logger
+from services.http_client import HTTPClient, AsyncHTTPClient
 from settings import (
     STT_API_KEY,
     STT_FOLDER_ID,
@@ -19,50 +19,86 @@ from settings import (
 class STT:
 
     def __init__(self):
+
         self.logger = get_logger('main')
+        self.http_client = HTTPClient('STT')
+        self.async_http_client = AsyncHTTPClient(self.http_client)
 
     @staticmethod
     @cache
     def get_second_blocks(duration: float | int) -> int:
         return ceil(duration / STT_SECONDS_IN_BLOCK)
 
-    def ask(self, audio: bytes) -> tuple[bool, str]:
+    @staticmethod
+    def _get_request_arguments(audio: bytes | Iterator[bytes] | AsyncIterator[bytes]) -> dict[str, Any]:
+        return {
+            'headers': {
+                'Authorization': f'Api-Key {STT_API_KEY}',
+            },
+            'params': {
+                'lang': STT_LANGUAGE,
+                'folderId': STT_FOLDER_ID,
+            },
+            'data': audio,
+            'is_retried': isinstance(audio, bytes),
+        }
+
+    def _get_exception_answer(self, error: Exception) -> tuple[bool, str]:
+        """
+        Log the request exception and return the error answer (the same for the bad status).
+        """
+
+        self.logger.error(
+            LOGGING_REQUEST_UNKNOWN_ERROR_TEMPLATE.format(service_name='STT', error=error, context=''),
+            extra=self.http_client.get_log_extra(),
+        )
+
+        return False, USER_FRIENDLY_REQUEST_ERROR_MESSAGE
+
+    def _get_bad_status_answer(self, response_status_code: int, log_extra: dict[str, Any]) -> tuple[bool, str]:
+
+        self.logger.error(LOGGING_REQUEST_BAD_STATUS_ERROR_TEMPLATE.format(
+            service_name='STT', status_code=response_status_code, context=''
+        ), extra=log_extra)
+
+        return False, USER_FRIENDLY_REQUEST_ERROR_MESSAGE
+
+    def ask(self, audio: bytes | Iterator[bytes]) -> tuple[bool, str]:
         """
-        Return a bool (True if success, else False) and a string (error message or STT result).
+        Return a bool (True if success, else False) and a string (error message or STT result). If the audio is an
+        iterator of chunks, it is uploaded while being iterated (chunked transfer encoding) and is not retried.
         """
 
         try:
-            response = post(
-                STT_URL,
-                headers={
-                    'Authorization': f'Api-Key {STT_API_KEY}',
-                },
-                params={
-                    'lang': STT_LANGUAGE,
-                    'folderId': STT_FOLDER_ID,
-                },
-                data=audio,
-            )
+            response = self.http_client.post(STT_URL, **self._get_request_arguments(audio))
 
         except Exception as e:
+            return self._get_exception_answer(e)
 
-            self.logger.error(LOGGING_REQUEST_UNKNOWN_ERROR_TEMPLATE.format(service_name='STT', error=e, context=''))
+        if response.status_code != 200:
+            return self._get_bad_status_answer(response.status_code, self.http_client.get_log_extra(response))
 
-            return False, USER_FRIENDLY_REQUEST_ERROR_MESSAGE
+        self.logger.info('STT request success', extra=self.http_client.get_log_extra(response))
 
-        response_status_code = response.status_code
+        return True, response.json()['result']
 
-        if response_status_code != 200:
+    async def ask_async(self, audio: bytes | AsyncIterator[bytes]) -> tuple[bool, str]:
+        """
+        Like ask, for the async mode: the audio is bytes or an async iterator of chunks.
+        """
 
-            self.logger.error(LOGGING_REQUEST_BAD_STATUS_ERROR_TEMPLATE.format(
-                service_name='STT', status_code=response_status_code, context=''
-            ))
+        try:
+            response = await self.async_http_client.post(STT_URL, **self._get_request_arguments(audio))
+
+        except Exception as e:
+            return self._get_exception_answer(e)
 
-            return False, USER_FRIENDLY_REQUEST_ERROR_MESSAGE
+        if response.status != 200:
+            return self._get_bad_status_answer(response.status, self.async_http_client.get_log_extra(response))
 
-        self.logger.info('STT request success')
+        self.logger.info('STT request success', extra=self.async_http_client.get_log_extra(response))
 
-        return True, response.json()['result']
+        return True, (await response.json(content_type=None))['result']
 
 
 stt = STT()
@@ -0,0 +1,135 @@
+from time import time
+from hashlib import sha256
+from threading import Lock
+from collections import OrderedDict
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from get_logger import get_logger
+from sql.crud import TokensCountCrud
+from sql.database import SessionLocal
+from settings import GPT_MODEL
+
+
+class TokensCountCache:
+    """
+    Bounded LRU cache of the prompt tokens amounts with TTL expiry (tokenization may change with the model). Only
+    successful counts are stored. If is_shared is True, the counts are also stored in the database, so several bot
+    replicas reuse them.
+    """
+
+    def __init__(self, max_items: int, ttl: float, is_shared: bool) -> None:
+
+        self.max_items = max_items
+        self.ttl = ttl
+        self.is_shared = is_shared
+
+        self.hits = 0
+        self.misses = 0
+
+        self.logger = get_logger('main')
+
+        self._items: OrderedDict[str, tuple[int, float]] = OrderedDict()  # key: (tokens amount, expires at)
+        self._lock = Lock()
+        self._sets_amount = 0
+
+    @staticmethod
+    def get_key(prompt: str) -> str:
+        return sha256(f'{GPT_MODEL}\0{prompt}'.encode()).hexdigest()
+
+    @property
+    def hit_rate(self) -> float:
+
+        requests_amount = self.hits + self.misses
+
+        return self.hits / requests_amount if requests_amount else 0
+
+    def _remember(self, key: str, tokens_amount: int, expires_at: float) -> None:
+        with self._lock:
+
+            self._items[key] = (tokens_amount, expires_at)
+
+            self._items.move_to_end(key)
+
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def _get_shared(self, key: str) -> tuple[int, float] | None:
+
+        try:
+            with SessionLocal() as session:
+
+                tokens_count = TokensCountCrud(session).get_actual(key)
+
+                return None if tokens_count is None else (tokens_count.tokens_amount, tokens_count.expires_at)
+
+        except SQLAlchemyError as e:
+
+            self.logger.error(f'Cannot get the shared tokens count: {e}')
+
+            return
+
+    def _set_shared(self, key: str, tokens_amount: int, expires_at: float) -> None:
+
+        try:
+            with SessionLocal() as session:
+
+                tokens_count_crud = TokensCountCrud(session)
+
+                tokens_count_crud.save(key, tokens_amount, expires_at)
+
+                self._sets_amount += 1
+
+                if self._sets_amount % self.max_items == 0:
+                    tokens_count_crud.delete_expired()
+
+        except SQLAlchemyError as e:
+            self.logger.error(f'Cannot save the shared tokens count: {e}')  # another replica may save it concurrently
+
+    def get(self, prompt: str) -> int | None:
+
+        key = self.get_key(prompt)
+
+        with self._lock:
+
+            item = self._items.get(key)
+
+            if item is not None and item[1] <= time():
+
+                del self._items[key]
+
+                item = None
+
+            if item is not None:
+
+                self._items.move_to_end(key)
+
+                self.hits += 1
+
+                return item[0]
+
+        if self.is_shared:
+
+            item = self._get_shared(key)
+
+            if item is not None:
+
+                self._remember(key, *item)
+
+                with self._lock:
+                    self.hits += 1
+
+                return item[0]
+
+        with self._lock:
+            self.misses += 1
+
+    def set(self, prompt: str, tokens_amount: int) -> None:
+
+        key = self.get_key(prompt)
+        expires_at = time() + self.ttl
+
+        self._remember(key, tokens_amount, expires_at)
+
+        if self.is_shared:
+            self._set_shared(key, tokens_amount, expires_at)
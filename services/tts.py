@@ -1,9 +1,12 @@
 from math import ceil
+from typing import Any
+from asyncio import to_thread
 from functools import cache
 
-from requests import post
-
+from metrics import metrics
 from get_logger import get_logger
+from services.http_client import HTTPClient, AsyncHTTPClient
+from services.tts_cache import TTSCache
 from settings import (
     TTS_API_KEY,
     TTS_FOLDER_ID,
@@ -11,6 +14,11 @@ from settings import (
     TTS_URL,
     TTS_LANGUAGE,
     TTS_VOICE,
+    TTS_CACHE_ENABLED,
+    TTS_CACHE_DIR,
+    TTS_CACHE_MAX_SIZE,
+    TTS_CACHE_MEMORY_MAX_ITEMS,
+    TTS_CACHE_HITS_ARE_CHARGED,
     USER_FRIENDLY_REQUEST_ERROR_MESSAGE,
     LOGGING_REQUEST_UNKNOWN_ERROR_TEMPLATE,
     LOGGING_REQUEST_BAD_STATUS_ERROR_TEMPLATE
@@ -20,51 +28,124 @@ from settings import (
 class TTS:
 
     def __init__(self):
+
         self.logger = get_logger('main')
+        self.http_client = HTTPClient('TTS')
+        self.async_http_client = AsyncHTTPClient(self.http_client)
+        self.cache = None
+
+        if TTS_CACHE_ENABLED:
+            self.cache = TTSCache(TTS_CACHE_DIR, TTS_CACHE_MAX_SIZE, TTS_CACHE_MEMORY_MAX_ITEMS)
+
+            metrics.register_gauge('bot_cache_hit_rate', 'Caches hit rates', lambda: self.cache.hit_rate, cache='TTS')
 
     @staticmethod
     @cache
     def get_character_blocks(characters_amount: int) -> int:
         return ceil(characters_amount / TTS_CHARACTERS_IN_BLOCK)
 
+    def get_request_character_blocks(self, text: str) -> int:
+        """
+        Return the number of character blocks to charge for the text synthesis. Cached texts are free if
+        TTS_CACHE_HITS_ARE_CHARGED is False.
+        """
+
+        if self.cache is not None and not TTS_CACHE_HITS_ARE_CHARGED and self.cache.contains(text):
+            return 0
+
+        return self.get_character_blocks(len(text))
+
+    @staticmethod
+    def _get_request_arguments(text: str) -> dict[str, Any]:
+        return {
+            'headers': {
+                'Authorization': f'Api-Key {TTS_API_KEY}',
+            },
+            'data': {
+                'text': text,
+                'lang': TTS_LANGUAGE,
+                'voice': TTS_VOICE,
+                'folderId': TTS_FOLDER_ID,
+            },
+        }
+
+    def _get_exception_answer(self, error: Exception, text: str) -> str:
+        """
+        Log the request exception and return the error answer (the same for the bad status).
+        """
+
+        self.logger.error(
+            LOGGING_REQUEST_UNKNOWN_ERROR_TEMPLATE.format(service_name='TTS', error=error, context=text),
+            extra=self.http_client.get_log_extra(),
+        )
+
+        return USER_FRIENDLY_REQUEST_ERROR_MESSAGE
+
+    def _get_bad_status_answer(self, response_status_code: int, text: str, log_extra: dict[str, Any]) -> str:
+
+        self.logger.error(LOGGING_REQUEST_BAD_STATUS_ERROR_TEMPLATE.format(
+            service_name='TTS', status_code=response_status_code, context=text
+        ), extra=log_extra)
+
+        return USER_FRIENDLY_REQUEST_ERROR_MESSAGE
+
     def ask(self, text: str) -> bytes | str:
         """
         Return bytes if success and string with an error message else.
         """
 
+        if self.cache is not None:
+
+            cached_audio = self.cache.get(text)
+
+            if cached_audio is not None:
+                return cached_audio
+
         try:
-            response = post(
-                TTS_URL,
-                headers={
-                    'Authorization': f'Api-Key {TTS_API_KEY}',
-                },
-                data={
-                    'text': text,
-                    'lang': TTS_LANGUAGE,
-                    'voice': TTS_VOICE,
-                    'folderId': TTS_FOLDER_ID,
-                },
-            )
+            response = self.http_client.post(TTS_URL, **self._get_request_arguments(text))
 
         except Exception as e:
+            return self._get_exception_answer(e, text)
 
-            self.logger.error(LOGGING_REQUEST_UNKNOWN_ERROR_TEMPLATE.format(service_name='TTS', error=e, context=text))
+        if response.status_code != 200:
+            return self._get_bad_status_answer(response.status_code, text, self.http_client.get_log_extra(response))
 
-            return USER_FRIENDLY_REQUEST_ERROR_MESSAGE
+        self.logger.info('TTS request success', extra=self.http_client.get_log_extra(response))
 
-        response_status_code = response.status_code
+        if self.cache is not None:
+            self.cache.set(text, response.content)
 
-        if response_status_code != 200:
+        return response.content
 
-            self.logger.error(LOGGING_REQUEST_BAD_STATUS_ERROR_TEMPLATE.format(
-                service_name='TTS', status_code=response_status_code, context=text
-            ))
+    async def ask_async(self, text: str) -> bytes | str:
+        """
+        Like ask, for the async mode. The cache files are read and written in the default executor threads.
+        """
 
-            return USER_FRIENDLY_REQUEST_ERROR_MESSAGE
+        if self.cache is not None:
 
-        self.logger.info('TTS request success')
+            cached_audio = await to_thread(self.cache.get, text)
 
-        return response.content
+            if cached_audio is not None:
+                return cached_audio
+
+        try:
+            response = await self.async_http_client.post(TTS_URL, **self._get_request_arguments(text))
+
+        except Exception as e:
+            return self._get_exception_answer(e, text)
+
+        if response.status != 200:
+            return self._get_bad_status_answer(response.status, text, self.async_http_client.get_log_extra(response))
+
+        self.logger.info('TTS request success', extra=self.async_http_client.get_log_extra(response))
+
+        audio = await response.read()  # the body is already read by the client
+
+        if self.cache is not None:
+            await to_thread(self.cache.set, text, audio)
+
+        return audio
 
 
 tts = TTS()
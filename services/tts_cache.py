@@ -0,0 +1,154 @@
+from os import scandir, utime
+from pathlib import Path
+from hashlib import sha256
+from threading import Lock, get_ident
+from collections import OrderedDict
+
+from settings import TTS_LANGUAGE, TTS_VOICE
+
+
+class TTSCache:
+    """
+    Content-addressed cache of the synthesized audio. A small in-memory LRU tier is placed in front of the disk tier,
+    the disk tier is bounded by size and evicts the least recently used files (by modification time, it is updated on
+    every hit).
+    """
+
+    FILE_SUFFIX = '.ogg'
+
+    def __init__(self, directory: Path, max_size: int, memory_max_items: int) -> None:
+
+        self.directory = directory
+        self.max_size = max_size
+        self.memory_max_items = memory_max_items
+
+        self.hits = 0
+        self.misses = 0
+
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._lock = Lock()
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self._disk_size = sum(entry.stat().st_size for entry in self._scan_files())
+
+    @property
+    def hit_rate(self) -> float:
+
+        requests_amount = self.hits + self.misses
+
+        return self.hits / requests_amount if requests_amount else 0
+
+    @staticmethod
+    def get_key(text: str) -> str:
+        return sha256(f'{TTS_LANGUAGE}\0{TTS_VOICE}\0{text}'.encode()).hexdigest()
+
+    def _get_path(self, key: str) -> Path:
+        return self.directory / f'{key}{self.FILE_SUFFIX}'
+
+    def _scan_files(self) -> list:
+        return [entry for entry in scandir(self.directory) if entry.name.endswith(self.FILE_SUFFIX)]
+
+    def _remember(self, key: str, audio: bytes, is_hit: bool = False) -> None:
+        with self._lock:
+
+            if is_hit:
+                self.hits += 1
+
+            self._memory[key] = audio
+
+            self._memory.move_to_end(key)
+
+            while len(self._memory) > self.memory_max_items:
+                self._memory.popitem(last=False)
+
+    def contains(self, text: str) -> bool:
+
+        key = self.get_key(text)
+
+        return key in self._memory or self._get_path(key).exists()
+
+    def get(self, text: str) -> bytes | None:
+
+        key = self.get_key(text)
+        path = self._get_path(key)
+
+        with self._lock:
+
+            audio = self._memory.get(key)
+
+            if audio is not None:
+
+                self._memory.move_to_end(key)
+
+                self.hits += 1
+
+        if audio is not None:
+
+            try:
+                utime(path)  # keep the hot file in the disk tier too
+
+            except FileNotFoundError:
+                pass
+
+            return audio
+
+        try:
+
+            audio = path.read_bytes()
+
+            utime(path)
+
+        except FileNotFoundError:
+
+            with self._lock:
+                self.misses += 1
+
+            return
+
+        self._remember(key, audio, is_hit=True)
+
+        return audio
+
+    def set(self, text: str, audio: bytes) -> None:
+
+        key = self.get_key(text)
+        path = self._get_path(key)
+        temporary_path = path.with_suffix(f'.{get_ident()}.tmp')
+
+        temporary_path.write_bytes(audio)
+
+        with self._lock:
+
+            try:
+                replaced_size = path.stat().st_size  # the same text synthesized by a concurrent request
+
+            except FileNotFoundError:
+                replaced_size = 0
+
+            temporary_path.replace(path)  # atomic, readers never see a partially written file
+
+            self._disk_size += len(audio) - replaced_size
+
+            if self._disk_size > self.max_size:
+                self._evict()
+
+        self._remember(key, audio)
+
+    def _evict(self) -> None:
+        """
+        Remove the least recently used files until the disk tier fits into max_size. Must be called under the lock.
+        """
+
+        files = sorted(self._scan_files(), key=lambda entry: entry.stat().st_mtime)
+
+        self._disk_size = sum(entry.stat().st_size for entry in files)
+
+        for entry in files:
+
+            if self._disk_size <= self.max_size:
+                break
+
+            self._disk_size -= entry.stat().st_size
+
+            Path(entry.path).unlink(missing_ok=True)
@@ -1,6 +1,7 @@
 from pathlib import Path
-from typing import Any
+from typing import Any, Literal, Self
 
+from pydantic import model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -13,6 +14,71 @@ class Settings(BaseSettings):
 
     WARNING_LOG_FILE_PATH: Path = LOGS_DIR / 'warning.log'
     INFO_LOG_FILE_PATH: Path = LOGS_DIR / 'info.log'
+    LOGS_MAX_FILE_SIZE: int = 1024 * 1024 * 10  # 10 Mb
+    LOGS_BACKUP_COUNT: int = 3  # rotated files (log.1, log.2, ...) kept for every log file
+    LOGS_EXPORT_RECORDS_AMOUNT: int = 1000  # the last records sent by the /get_logs_* commands by default
+    LOGS_EXPORT_MAX_RECORDS_AMOUNT: int = 100000
+    # the records are formatted and written to the files and the console by a background thread
+    LOGS_QUEUE_ENABLED: bool = False
+    LOGS_FORMAT: Literal['text', 'json'] = 'text'  # json - JSON lines with the request id, service name and latency
+
+    # metrics (latency histograms of the handlers, services requests and database queries)
+    METRICS_ENABLED: bool = False
+    # the metrics are served in the Prometheus format on WEBHOOK_HOST:WEBHOOK_PORT (by the webhook server in the
+    # webhook mode, on WEBHOOK_PORT + worker number by every worker in the multiprocess mode)
+    METRICS_PATH: str = '/metrics'
+
+    # bot
+    BOT_RUNTIME_MODE: Literal['threaded', 'webhook', 'multiprocess', 'async'] = 'threaded'
+    BOT_WORKERS_AMOUNT: int = 2
+    BOT_SHARD_QUEUE_MAX_SIZE: int = 100
+    BOT_STOP_TIMEOUT: float = 30  # seconds to process the queued updates on the stop (SIGTERM or Ctrl+C)
+    # updates are received by the main process and processed by the worker processes (by BOT_WORKERS_AMOUNT threads in
+    # every worker), the worker is chosen by the user id hash
+    MULTIPROCESS_RUNTIME_WORKERS_AMOUNT: int = 2
+    # updates processed at once by the coroutines of the async mode, the polling waits while the limit is reached
+    ASYNC_RUNTIME_MAX_IN_FLIGHT_UPDATES: int = 1000
+    BOT_STATE_STORAGE: Literal['memory', 'database'] = 'database'
+    BOT_STATE_STORAGE_CACHE_MAX_ITEMS: int = 10000
+    TELEGRAM_API_URL: str = 'https://api.telegram.org'  # a local Bot API server (or the load tests stand-in)
+
+    # webhook (BOT_RUNTIME_MODE = 'webhook')
+    WEBHOOK_URL: str = ''  # public https url, telegram sends updates to it
+    WEBHOOK_HOST: str = '0.0.0.0'
+    WEBHOOK_PORT: int = 8080
+    WEBHOOK_PATH: str = '/webhook'
+    WEBHOOK_SECRET_TOKEN: str = ''
+    WEBHOOK_QUEUE_MAX_SIZE: int = 1000
+    WEBHOOK_MAX_BODY_SIZE: int = 1024 * 1024  # 1 Mb
+
+    # database
+    DB_POOL_SIZE: int = 5
+    # None - a connection for every handler thread and the message journal (BOT_WORKERS_AMOUNT), the async mode
+    # coroutines share the pool of the async engine (they hold a connection only for a query or a short transaction)
+    DB_MAX_OVERFLOW: int | None = None
+    # conversation messages are saved in the background by batches, 1 saves every message at once
+    MESSAGE_JOURNAL_MAX_BATCH_SIZE: int = 50
+    MESSAGE_JOURNAL_FLUSH_INTERVAL: float = 1  # seconds
+    # seconds, the not finished quota reservations are released after it (checked every sweep interval)
+    QUOTA_RESERVATION_TIMEOUT: float = 60 * 10
+    QUOTA_RESERVATION_SWEEP_INTERVAL: float = 60
+
+    # HTTP (requests to the services)
+    HTTP_CONNECT_TIMEOUT: float = 5
+    HTTP_READ_TIMEOUT: float = 30
+    HTTP_RETRIES_AMOUNT: int = 2
+    HTTP_RETRY_BACKOFF_FACTOR: float = 0.5
+    HTTP_RETRY_BACKOFF_JITTER: float = 0.5
+    # every service has an adaptive (AIMD) concurrent requests limit between the min and the max limits
+    HTTP_CONCURRENCY_MIN_LIMIT: int = 1
+    # None - every handler thread (and the voice pipeline worker) or every in-flight update of the async mode can
+    # request the service at once, the HTTP connection pools are sized by the max limit
+    HTTP_CONCURRENCY_MAX_LIMIT: int | None = None
+    # seconds, the requests waiting for a free slot check the circuit at this interval (they fail only if it is open)
+    HTTP_CONCURRENCY_QUEUE_TIMEOUT: float = 1
+    HTTP_CONCURRENCY_SLOW_RESPONSE_TIME: float = 10  # seconds, slower responses decrease the limit
+    HTTP_CIRCUIT_BREAKER_FAILURES_THRESHOLD: int = 5  # consecutive failures to open the service circuit
+    HTTP_CIRCUIT_BREAKER_RESET_TIMEOUT: float = 30  # seconds, then one trial request is sent
 
     # error messages
     USER_FRIENDLY_REQUEST_ERROR_MESSAGE: str = \
@@ -27,11 +93,24 @@ class Settings(BaseSettings):
     TTS_URL: str = 'https://tts.api.cloud.yandex.net/speech/v1/tts:synthesize'
     TTS_LANGUAGE: str = 'ru-RU'
     TTS_VOICE: str = 'filipp'
+    TTS_CACHE_ENABLED: bool = False
+    TTS_CACHE_DIR: Path = Path(__file__).resolve().parent / 'tts_cache'
+    TTS_CACHE_MAX_SIZE: int = 1024 * 1024 * 100  # 100 Mb
+    TTS_CACHE_MEMORY_MAX_ITEMS: int = 50
+    TTS_CACHE_HITS_ARE_CHARGED: bool = True
+
+    # voice pipeline (GPT answer is synthesized by sentences while it is being generated)
+    VOICE_PIPELINE_ENABLED: bool = False
+    VOICE_PIPELINE_MAX_WORKERS: int = 4
+    VOICE_PIPELINE_MIN_SEGMENT_LENGTH: int = 100
 
     # STT (speech to text)
     STT_SECONDS_IN_BLOCK: int = 15
     STT_URL: str = 'https://stt.api.cloud.yandex.net/speech/v1/stt:recognize'
     STT_LANGUAGE: str = 'ru-RU'
+    # the voice file is uploaded to STT while it is being downloaded from telegram, by chunks
+    STT_STREAMING_UPLOAD_ENABLED: bool = False
+    STT_STREAMING_UPLOAD_CHUNK_SIZE: int = 64 * 1024  # bytes
 
     # GPT
     GPT_URL: str = 'https://llm.api.cloud.yandex.net/foundationModels/v1/completion'
@@ -43,6 +122,30 @@ class Settings(BaseSettings):
         ' Не пиши НИЧЕГО про готовность оказать поддержку или создать хорошее настроение'
     )
     GPT_RESPONSE_MAX_TOKENS: int = 300
+    GPT_HISTORY_MESSAGES_AMOUNT: int = 10
+    # older messages are condensed into a summary when the not summarized history estimate exceeds the budget
+    GPT_HISTORY_SUMMARY_ENABLED: bool = False
+    GPT_HISTORY_SUMMARY_TOKENS_BUDGET: int = 1000
+    GPT_HISTORY_SUMMARY_MAX_MESSAGES: int = 50
+    GPT_HISTORY_SUMMARY_DELETE_MESSAGES: bool = False
+    GPT_SUMMARY_SYSTEM_PROMPT: str = (
+        'Кратко перескажи разговор пользователя с ботом поддержки. Сохрани важные факты о пользователе и его'
+        ' настроении. Пиши только пересказ'
+    )
+    GPT_STREAMING_ENABLED: bool = False
+    GPT_STREAMING_EDIT_INTERVAL: float = 1  # seconds, telegram limits the frequency of message edits
+    # a typical rate for the quota reservations and the history budget, the limits are checked by an upper bound
+    GPT_TOKENS_ESTIMATE_CHARACTERS_PER_TOKEN: float = 3.5
+    GPT_TOKENS_CACHE_MAX_ITEMS: int = 1000
+    GPT_TOKENS_CACHE_TTL: int = 60 * 60 * 24  # seconds, tokenization is not static
+    GPT_TOKENS_CACHE_SHARED: bool = False  # store the counts in the database to share them between replicas
+    GPT_RESPONSE_CACHE_ENABLED: bool = False
+    GPT_RESPONSE_CACHE_MAX_ITEMS: int = 1000
+    GPT_RESPONSE_CACHE_TTL: int = 60 * 60  # seconds
+    GPT_RESPONSE_CACHE_VARIANTS_AMOUNT: int = 3
+    GPT_RESPONSE_CACHE_HISTORY_MESSAGES_AMOUNT: int = 2  # the last history messages are a part of the key
+    GPT_RESPONSE_CACHE_MAX_PROMPT_LENGTH: int = 100  # characters, longer prompts are not cached
+    GPT_RESPONSE_CACHE_HITS_ARE_CHARGED: bool = True
 
     # request limits
     REQUEST_MAX_SECOND_BLOCKS: int = 2
@@ -66,6 +169,28 @@ class Settings(BaseSettings):
     GPT_FOLDER_ID: str
     DEBUG_USER_ID: int
 
+    @model_validator(mode='after')
+    def set_concurrency_defaults(self) -> Self:
+        """
+        Size the not set pools and limits by the handler threads amount of a process (the services limits by the
+        in-flight updates limit in the async mode), so they do not queue the handlers.
+        """
+
+        if self.DB_MAX_OVERFLOW is None:
+            self.DB_MAX_OVERFLOW = max(self.BOT_WORKERS_AMOUNT + 1 - self.DB_POOL_SIZE, 0)
+
+        if self.HTTP_CONCURRENCY_MAX_LIMIT is None:
+
+            if self.BOT_RUNTIME_MODE == 'async':
+                self.HTTP_CONCURRENCY_MAX_LIMIT = self.ASYNC_RUNTIME_MAX_IN_FLIGHT_UPDATES
+
+            else:
+                self.HTTP_CONCURRENCY_MAX_LIMIT = self.BOT_WORKERS_AMOUNT + (
+                    self.VOICE_PIPELINE_MAX_WORKERS if self.VOICE_PIPELINE_ENABLED else 0
+                )
+
+        return self
+
 
 _SETTINGS = Settings()
 
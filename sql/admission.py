@@ -0,0 +1,40 @@
+from asyncio import Lock as AsyncLock
+from threading import Lock
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from .models import User
+
+
+class UserAdmission:
+    """
+    In-process cache of the registered (admitted) users. It is warmed up once at the startup and updated only by the
+    admission (UserCrud.get_or_create_within_limit), so the users amount limit check does not touch the database for
+    the already admitted users.
+    """
+
+    def __init__(self) -> None:
+
+        self._telegram_ids: set[int] = set()
+
+        # serializes the admission of new users in this process, the database guard covers other processes
+        self.lock = Lock()
+        # the coroutines of the async mode wait for it instead of blocking the event loop on the lock
+        self.async_lock = AsyncLock()
+
+    def warm_up(self, session: Session) -> None:
+        self._telegram_ids = set(session.scalars(select(User.telegram_id)))
+
+    @property
+    def users_amount(self) -> int:
+        return len(self._telegram_ids)
+
+    def is_admitted(self, telegram_id: int) -> bool:
+        return telegram_id in self._telegram_ids
+
+    def add(self, telegram_id: int) -> None:
+        self._telegram_ids.add(telegram_id)
+
+
+user_admission = UserAdmission()
@@ -1,18 +1,27 @@
+from time import time
 from typing import Type
 from abc import ABC
 
+from sqlalchemy import select, func, text, insert
 from sqlalchemy.orm import Session, Query
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
-from .models import User, UserMessage
+from .models import User, UserMessage, UserSummary, TokensCount, BotState
 from .database import Base
+from .admission import user_admission
 
 
 class BaseCrud(ABC):
     """
     This abstract class implements base CRUD (only those used in the project) and utility methods.
-    You should inherit this class and override its __init__ method to create a new CRUD class.
+    You should inherit this class and override its __init__ method to create a new CRUD class. Set
+    conflict_index_elements (columns of a unique index) to use "INSERT ... ON CONFLICT" in upsert and get_or_create.
     """
 
+    conflict_index_elements: tuple[str, ...] = ()
+
     def __init__(self, model: Type[Base], db: Session) -> None:
 
         self.model = model
@@ -27,11 +36,78 @@ class BaseCrud(ABC):
         self.db.commit()
         self.db.refresh(object_to_add)
 
-    def create(self, **kwargs) -> Type[Base]:
+    def _get_conflict_insert(self):
+        """
+        Return the dialect insert statement supporting "ON CONFLICT" or None if it is not supported.
+        """
+
+        if not self.conflict_index_elements:
+            return
+
+        dialect_name = self.db.get_bind().dialect.name
+
+        if dialect_name == 'postgresql':
+            return postgresql_insert(self.model)
+
+        elif dialect_name == 'sqlite':
+            return sqlite_insert(self.model)
+
+    def create(self, refresh: bool = True, **kwargs) -> Type[Base]:
+        """
+        If refresh is False, the object is not loaded back after the commit (its attributes are loaded on the first
+        access), so the insert costs one round-trip.
+        """
 
         db_object = self.model(**kwargs)
 
-        self.add_to_db_and_refresh(db_object)
+        if refresh:
+            self.add_to_db_and_refresh(db_object)
+
+        else:
+
+            self.db.add(db_object)
+            self.db.commit()
+
+        return db_object
+
+    def bulk_create(self, rows: list[dict]) -> None:
+        """
+        Insert all rows with one multi-row INSERT, the objects are not loaded.
+        """
+
+        if not rows:
+            return
+
+        self.db.execute(insert(self.model), rows)
+        self.db.commit()
+
+    def upsert(self, **kwargs) -> Type[Base]:
+        """
+        Insert the object or update the existing one with the same conflict_index_elements, one round-trip with
+        "INSERT ... ON CONFLICT DO UPDATE" if it is supported, else session merge.
+        """
+
+        conflict_insert = self._get_conflict_insert()
+
+        if conflict_insert is None:
+
+            db_object = self.db.merge(self.model(**kwargs))
+
+            self.db.commit()
+
+            return db_object
+
+        statement = conflict_insert.values(**kwargs)
+        statement = statement.on_conflict_do_update(
+            index_elements=self.conflict_index_elements,
+            set_={
+                column: statement.excluded[column] for column in kwargs if column not in self.conflict_index_elements
+            },
+        ).returning(self.model)
+
+        db_object = self.db.scalars(statement, execution_options={'populate_existing': True}).one()
+
+        self.db.commit()
 
         return db_object
 
@@ -39,17 +115,159 @@ class BaseCrud(ABC):
         return self._get_query_filtered(**kwargs).first()
 
     def get_or_create(self, **kwargs) -> Type[Base]:
-        return self._get_query_filtered(**kwargs).first() or self.create(**kwargs)
+        """
+        Concurrent creations of the same object never fail: the insert is "INSERT ... ON CONFLICT DO NOTHING RETURNING"
+        if it is supported, else a failed insert is rolled back, and the object created by the winner is returned.
+        """
+
+        db_object = self.get(**kwargs)
+
+        if db_object is not None:
+            return db_object
+
+        conflict_insert = self._get_conflict_insert()
+
+        if conflict_insert is None:
+            try:
+                return self.create(**kwargs)
+
+            except IntegrityError:
+                self.db.rollback()
+
+        else:
+
+            db_object = self.db.scalars(
+                conflict_insert.values(**kwargs)
+                .on_conflict_do_nothing(index_elements=self.conflict_index_elements)
+                .returning(self.model)
+            ).first()
+
+            self.db.commit()
+
+            if db_object is not None:
+                return db_object
+
+        return self.get(**kwargs)
 
     def get_many(self, **kwargs) -> list[Type[Base]]:
         return self._get_query_filtered(**kwargs).all()
 
 
 class UserCrud(BaseCrud):
+
+    conflict_index_elements = ('telegram_id',)
+
     def __init__(self, db: Session) -> None:
         super().__init__(User, db)
 
+    def get_or_create_within_limit(self, users_amount_limit: int, **kwargs) -> User | None:
+        """
+        Return an existing user or create a new one only if the users amount is less than the users_amount_limit, else
+        return None. The check and the creation are serialized between threads (by the admission lock) and between
+        processes (by the table lock on PostgreSQL and the database write lock taken by "BEGIN IMMEDIATE" on SQLite,
+        so two processes cannot both count the same amount and both insert). This is the only way users are admitted.
+        """
+
+        with user_admission.lock:
+
+            dialect_name = self.db.get_bind().dialect.name
+
+            if dialect_name == 'postgresql':
+                self.db.execute(text(f'LOCK TABLE {User.__tablename__} IN SHARE ROW EXCLUSIVE MODE'))
+
+            elif dialect_name == 'sqlite':
+                self.db.execute(text('BEGIN IMMEDIATE'))
+
+            user = self.get(**kwargs)
+
+            if user is None:
+
+                if self.db.scalar(select(func.count()).select_from(User)) >= users_amount_limit:
+
+                    self.db.rollback()
+
+                    return
+
+                user = self.create(**kwargs)
+
+            else:
+                self.db.commit()
+
+            user_admission.add(user.telegram_id)
+
+            return user
+
 
 class UserMessageCrud(BaseCrud):
     def __init__(self, db: Session) -> None:
         super().__init__(UserMessage, db)
+
+    def get_history(self, user_id: int, messages_amount: int, after_message_id: int = 0) -> list[UserMessage]:
+        """
+        Return the last messages_amount messages of the user (newer than after_message_id) in the chronological order.
+        """
+
+        messages = (
+            self._get_query_filtered(user_id=user_id)
+            .filter(UserMessage.id > after_message_id)
+            .order_by(UserMessage.id.desc())
+            .limit(messages_amount)
+        )
+
+        return messages.all()[::-1]
+
+    def delete_history(self, user_id: int, last_message_id: int) -> None:
+        """
+        Delete the messages of the user up to the last_message_id (inclusive).
+        """
+
+        self._get_query_filtered(user_id=user_id).filter(UserMessage.id <= last_message_id).delete()
+        self.db.commit()
+
+
+class UserSummaryCrud(BaseCrud):
+
+    conflict_index_elements = ('user_id',)
+
+    def __init__(self, db: Session) -> None:
+        super().__init__(UserSummary, db)
+
+    def save(self, user_id: int, text: str, last_message_id: int) -> None:
+        self.upsert(user_id=user_id, text=text, last_message_id=last_message_id)
+
+
+class TokensCountCrud(BaseCrud):
+
+    conflict_index_elements = ('prompt_hash',)
+
+    def __init__(self, db: Session) -> None:
+        super().__init__(TokensCount, db)
+
+    def get_actual(self, prompt_hash: str) -> TokensCount | None:
+        return self._get_query_filtered(prompt_hash=prompt_hash).filter(TokensCount.expires_at > time()).first()
+
+    def save(self, prompt_hash: str, tokens_amount: int, expires_at: float) -> None:
+
+        self.upsert(prompt_hash=prompt_hash, tokens_amount=tokens_amount, expires_at=expires_at)
+
+    def delete_expired(self) -> None:
+
+        self.db.query(TokensCount).filter(TokensCount.expires_at <= time()).delete()
+        self.db.commit()
+
+
+class BotStateCrud(BaseCrud):
+
+    conflict_index_elements = ('chat_id', 'user_id')
+
+    def __init__(self, db: Session) -> None:
+        super().__init__(BotState, db)
+
+    def save(self, chat_id: int, user_id: int, state: str | None, data: dict) -> None:
+
+        self.upsert(chat_id=chat_id, user_id=user_id, state=state, data=data)
+
+    def delete(self, chat_id: int, user_id: int) -> None:
+
+        self._get_query_filtered(chat_id=chat_id, user_id=user_id).delete()
+        self.db.commit()
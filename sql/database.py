@@ -1,15 +1,136 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from time import perf_counter
 
-from settings import DB_URL
+from sqlalchemy import create_engine, event, inspect, text, make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine, async_sessionmaker
 
+from metrics import metrics
+from settings import DB_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW
 
-engine = create_engine(DB_URL)
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_engine(DB_URL, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+
+# objects stay loaded after commits, the counters are changed only by SQL expressions (see sql/quotas.py)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+# the async mode sessions, bound to the async engine by create_async_database_engine
+AsyncSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False)
+async_engine: AsyncEngine | None = None
+
+ASYNC_DRIVERS_NAMES = {'sqlite': 'aiosqlite', 'postgresql': 'asyncpg'}
 
 Base = declarative_base()
 
 
+def _start_query_measurement(connection, *_) -> None:
+    connection.info.setdefault('queries_start_times', []).append(perf_counter())
+
+
+def _finish_query_measurement(connection, _, statement: str, *__) -> None:
+    metrics.get_histogram('bot_db_query_duration_seconds', statement=statement.split(None, 1)[0].upper()).observe(
+        perf_counter() - connection.info['queries_start_times'].pop()
+    )
+
+
+def _cancel_query_measurement(exception_context) -> None:
+    if exception_context.connection is not None and exception_context.connection.info.get('queries_start_times'):
+        exception_context.connection.info['queries_start_times'].pop()
+
+
+def _listen_queries_measurements(measured_engine: Engine) -> None:
+    if metrics.is_enabled:
+
+        event.listen(measured_engine, 'before_cursor_execute', _start_query_measurement)
+        event.listen(measured_engine, 'after_cursor_execute', _finish_query_measurement)
+        event.listen(measured_engine, 'handle_error', _cancel_query_measurement)
+
+
+_listen_queries_measurements(engine)
+
+
+def create_async_database_engine() -> AsyncEngine:
+    """
+    Create the engine of the async mode (DB_URL with the asyncio driver of its database, the same pool settings) and
+    bind AsyncSessionLocal to it. The engine is created on demand, so the threaded modes do not need the asyncio
+    drivers.
+    """
+
+    global async_engine
+
+    if async_engine is None:
+
+        db_url = make_url(DB_URL)
+
+        if db_url.get_backend_name() not in ASYNC_DRIVERS_NAMES:
+            raise ValueError(f'The async mode does not support the {db_url.get_backend_name()} database')
+
+        async_engine = create_async_engine(
+            db_url.set(drivername=f'{db_url.get_backend_name()}+{ASYNC_DRIVERS_NAMES[db_url.get_backend_name()]}'),
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+        )
+
+        _listen_queries_measurements(async_engine.sync_engine)
+
+        AsyncSessionLocal.configure(bind=async_engine)
+
+    return async_engine
+
+
+if metrics.is_enabled:
+
+    # the Session class events are emitted by the async mode sessions too
+    @event.listens_for(Session, 'before_commit')
+    def _start_commit_measurement(session) -> None:
+        session.info['commit_start_time'] = perf_counter()
+
+    @event.listens_for(Session, 'after_commit')
+    def _finish_commit_measurement(session) -> None:
+
+        commit_start_time = session.info.pop('commit_start_time', None)
+
+        if commit_start_time is not None:
+            metrics.get_histogram('bot_db_commit_duration_seconds').observe(perf_counter() - commit_start_time)
+
+
+def _add_missing_columns_and_indexes() -> None:
+    """
+    Upgrade the tables created by the previous versions: add the new columns (they must have a server default or be
+    nullable) and create the new indexes. Does nothing if the schema is up to date.
+    """
+
+    inspector = inspect(engine)
+
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+
+            existing_columns_names = {column['name'] for column in inspector.get_columns(table.name)}
+
+            for column in table.columns:
+                if column.name not in existing_columns_names:
+                    connection.execute(text(
+                        f'ALTER TABLE {table.name} ADD COLUMN {CreateColumn(column).compile(dialect=engine.dialect)}'
+                    ))
+
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+
 def create_all_tables() -> None:
+
+    is_quota_reservations_table_created = not inspect(engine).has_table('quota_reservations')
+
     Base.metadata.create_all(bind=engine)
+
+    _add_missing_columns_and_indexes()
+
+    if is_quota_reservations_table_created:
+        # the amounts reserved by the previous versions have no reservation records, so they could never be released
+        with engine.begin() as connection:
+            connection.execute(text(
+                'UPDATE users SET second_blocks_reserved = 0, character_blocks_reserved = 0, tokens_reserved = 0'
+            ))
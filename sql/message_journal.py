@@ -0,0 +1,176 @@
+import atexit
+from time import sleep
+from asyncio import to_thread
+from threading import Condition, Lock, Thread
+
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import UserMessage
+from .crud import UserMessageCrud
+from .database import SessionLocal
+from get_logger import get_logger
+from settings import MESSAGE_JOURNAL_MAX_BATCH_SIZE, MESSAGE_JOURNAL_FLUSH_INTERVAL
+
+
+class MessageJournal:
+    """
+    Write-behind journal of the conversation messages. Messages are buffered in memory and saved by one multi-row
+    INSERT when max_batch_size messages are collected (in the adding thread) or every flush_interval seconds (in
+    the background thread), and on the interpreter exit. The history merges the not yet saved messages, so the next
+    request of the user always sees the previous answer.
+    """
+
+    def __init__(self, max_batch_size: int, flush_interval: float) -> None:
+
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+
+        self.logger = get_logger('main')
+
+        self._pending: list[UserMessage] = []
+        self._flushing: list[UserMessage] = []
+        self._flushes_started = 0
+        self._condition = Condition()
+        self._flush_lock = Lock()  # one flush at a time
+        self._flusher: Thread | None = None
+
+        atexit.register(self.flush)
+
+    def _flush_periodically(self) -> None:
+        while True:
+
+            sleep(self.flush_interval)
+
+            self.flush()
+
+    def _add(self, messages: tuple[UserMessage, ...]) -> bool:
+        """
+        Add the messages to the pending ones, return True if the batch is full.
+        """
+
+        with self._condition:
+
+            if self._flusher is None:
+
+                self._flusher = Thread(target=self._flush_periodically, name='message_journal', daemon=True)
+
+                self._flusher.start()
+
+            self._pending.extend(messages)
+
+            return len(self._pending) >= self.max_batch_size
+
+    def add(self, *messages: UserMessage) -> None:
+        """
+        Add the transient (not added to a session) messages, they are saved in the given order.
+        """
+
+        if self._add(messages):
+            self.flush()
+
+    async def add_async(self, *messages: UserMessage) -> None:
+        """
+        Like add, for the async mode, the full batch is saved in a default executor thread.
+        """
+
+        if self._add(messages):
+            await to_thread(self.flush)
+
+    def flush(self) -> None:
+        with self._flush_lock:
+
+            with self._condition:
+
+                if not self._pending:
+                    return
+
+                self._flushing, self._pending = self._pending, []
+                self._flushes_started += 1
+
+            try:
+                with SessionLocal() as session:
+                    UserMessageCrud(session).bulk_create([
+                        {'user_id': message.user_id, 'role': message.role, 'text': message.text}
+                        for message in self._flushing
+                    ])
+
+            except SQLAlchemyError as e:
+
+                self.logger.error(f'Cannot save {len(self._flushing)} messages, they will be saved later: {e}')
+
+                with self._condition:
+                    self._pending[:0] = self._flushing
+
+            finally:
+                with self._condition:
+
+                    self._flushing = []
+
+                    self._condition.notify_all()
+
+    def get_history(
+            self, session: Session, user_id: int, messages_amount: int, after_message_id: int = 0
+    ) -> list[UserMessage]:
+        """
+        Return the last messages_amount messages of the user (newer than after_message_id) in the chronological order,
+        including the pending ones.
+        If a flush is started while the saved history is loading, it is loaded again, so the flushed messages are never
+        lost or duplicated.
+        """
+
+        while True:
+
+            with self._condition:
+
+                self._condition.wait_for(lambda: not self._flushing)
+
+                flushes_started = self._flushes_started
+                pending = [message for message in self._pending if message.user_id == user_id]
+
+            history = UserMessageCrud(session).get_history(user_id, messages_amount, after_message_id)
+
+            with self._condition:
+                if self._flushes_started == flushes_started:
+                    return (history + pending)[-messages_amount:]
+
+    def _wait_for_flush(self) -> None:
+        with self._condition:
+            self._condition.wait_for(lambda: not self._flushing)
+
+    async def get_history_async(
+            self, session: AsyncSession, user_id: int, messages_amount: int, after_message_id: int = 0
+    ) -> list[UserMessage]:
+        """
+        Like get_history, for the async mode. A flush in progress is waited for in a default executor thread: the
+        event loop must not be blocked, the flush can wait for a database lock held by a coroutine.
+        """
+
+        while True:
+
+            with self._condition:
+
+                is_flushing = bool(self._flushing)
+
+                flushes_started = self._flushes_started
+                pending = [message for message in self._pending if message.user_id == user_id]
+
+            if is_flushing:
+
+                await to_thread(self._wait_for_flush)
+
+                continue
+
+            history = await session.run_sync(
+                lambda sync_session: UserMessageCrud(sync_session).get_history(
+                    user_id, messages_amount, after_message_id
+                )
+            )
+
+            with self._condition:
+                if self._flushes_started == flushes_started:
+                    return (history + pending)[-messages_amount:]
+
+
+message_journal = MessageJournal(MESSAGE_JOURNAL_MAX_BATCH_SIZE, MESSAGE_JOURNAL_FLUSH_INTERVAL)
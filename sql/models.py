@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, ForeignKey, Enum, String
+from sqlalchemy import Column, Integer, ForeignKey, Enum, String, Index, Float, BigInteger, JSON
 from sqlalchemy.orm import relationship
 
 from .database import Base
@@ -14,13 +14,35 @@ class User(Base):
     second_blocks_spent = Column(Integer, nullable=False, default=0)
     character_blocks_spent = Column(Integer, nullable=False, default=0)
     tokens_spent = Column(Integer, nullable=False, default=0)
+    # reserved by the requests in progress, see sql/quotas.py
+    second_blocks_reserved = Column(Integer, nullable=False, default=0, server_default='0')
+    character_blocks_reserved = Column(Integer, nullable=False, default=0, server_default='0')
+    tokens_reserved = Column(Integer, nullable=False, default=0, server_default='0')
 
     messages = relationship('UserMessage', back_populates='user')
+    summary = relationship('UserSummary', back_populates='user', uselist=False)
+
+
+class UserQuotaReservation(Base):
+    """
+    A reservation in progress, its amount is a part of the user *_reserved counter (see sql/quotas.py).
+    """
+
+    __tablename__ = 'quota_reservations'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    resource = Column(String, nullable=False)
+    amount = Column(Integer, nullable=False)
+    reserved_at = Column(Float, nullable=False, index=True)  # unix timestamp
 
 
 class UserMessage(Base):
 
     __tablename__ = 'user_messages'
+    __table_args__ = (
+        Index('ix_user_messages_user_id_id', 'user_id', 'id'),  # for the recent history query
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -31,3 +53,33 @@ class UserMessage(Base):
     text = Column(String, nullable=False)
 
     user = relationship('User', back_populates='messages')
+
+
+class UserSummary(Base):
+
+    __tablename__ = 'user_summaries'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    text = Column(String, nullable=False)
+    last_message_id = Column(Integer, nullable=False)  # the last summarized message
+
+    user = relationship('User', back_populates='summary')
+
+
+class TokensCount(Base):
+
+    __tablename__ = 'tokens_counts'
+
+    prompt_hash = Column(String(64), primary_key=True)
+    tokens_amount = Column(Integer, nullable=False)
+    expires_at = Column(Float, nullable=False, index=True)  # unix timestamp
+
+
+class BotState(Base):
+
+    __tablename__ = 'bot_states'
+
+    chat_id = Column(BigInteger, primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)
+    state = Column(String, nullable=True)
+    data = Column(JSON, nullable=False, default=dict)
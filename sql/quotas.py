@@ -0,0 +1,251 @@
+from time import time, sleep
+from enum import Enum
+from threading import Thread
+
+from sqlalchemy import update, delete, select
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import User, UserQuotaReservation
+from .database import SessionLocal
+from get_logger import get_logger
+from settings import (
+    SECOND_BLOCKS_LIMIT_BY_USER,
+    CHARACTER_BLOCKS_LIMIT_BY_USER,
+    TOKENS_LIMIT_BY_USER,
+    QUOTA_RESERVATION_TIMEOUT,
+    QUOTA_RESERVATION_SWEEP_INTERVAL,
+)
+
+
+class QuotaResource(Enum):
+
+    SECOND_BLOCKS = 'second_blocks'
+    CHARACTER_BLOCKS = 'character_blocks'
+    TOKENS = 'tokens'
+
+    @property
+    def spent_column(self):
+        return getattr(User, f'{self.value}_spent')
+
+    @property
+    def reserved_column(self):
+        return getattr(User, f'{self.value}_reserved')
+
+    @property
+    def limit(self) -> int:
+        return {
+            QuotaResource.SECOND_BLOCKS: SECOND_BLOCKS_LIMIT_BY_USER,
+            QuotaResource.CHARACTER_BLOCKS: CHARACTER_BLOCKS_LIMIT_BY_USER,
+            QuotaResource.TOKENS: TOKENS_LIMIT_BY_USER,
+        }[self]
+
+
+def _delete_reservation_record(session: Session, record_id: int) -> bool:
+    """
+    Delete the reservation record, return True if it was deleted by this call. Only the deleting transaction takes
+    the reservation amount out of the reserved counter, so a reservation finished and released as an expired one at
+    once is subtracted once.
+    """
+
+    return session.execute(
+        delete(UserQuotaReservation).where(UserQuotaReservation.id == record_id),
+        execution_options={'synchronize_session': False},
+    ).rowcount == 1
+
+
+class QuotaReservation:
+    """
+    The amount of the resource reserved for the user. It must be finished once: settled with the real spent amount
+    after a successful request or released after a failed one.
+    """
+
+    def __init__(self, session: Session, user: User, resource: QuotaResource, amount: int, record_id: int) -> None:
+
+        self.session = session
+        self.user = user
+        self.resource = resource
+        self.amount = amount
+        self.record_id = record_id
+
+        self.is_finished = False
+
+    def _finish(self, spent_amount: int) -> None:
+
+        if self.is_finished:
+            return
+
+        reserved_column, spent_column = self.resource.reserved_column, self.resource.spent_column
+
+        values = {spent_column: spent_column + spent_amount}
+
+        # else the reservation is already released as an expired one
+        if _delete_reservation_record(self.session, self.record_id):
+            values[reserved_column] = reserved_column - self.amount
+
+        self.session.execute(
+            update(User).where(User.id == self.user.id).values(values),
+            execution_options={'synchronize_session': False},
+        )
+        self.session.commit()
+
+        self.is_finished = True
+
+    def settle(self, spent_amount: int | None = None) -> None:
+        """
+        Move the reservation into the spent amount, spent_amount replaces the reserved (estimated) amount if given.
+        """
+
+        self._finish(self.amount if spent_amount is None else spent_amount)
+
+    def release(self) -> None:
+        self._finish(0)
+
+
+class AsyncQuotaReservation:
+    """
+    The QuotaReservation of the async mode, it is finished by the same statements run in the async session.
+    """
+
+    def __init__(self, session: AsyncSession, quota_reservation: QuotaReservation) -> None:
+
+        self.session = session
+        self.quota_reservation = quota_reservation
+
+    @property
+    def amount(self) -> int:
+        return self.quota_reservation.amount
+
+    @property
+    def is_finished(self) -> bool:
+        return self.quota_reservation.is_finished
+
+    async def settle(self, spent_amount: int | None = None) -> None:
+        await self.session.run_sync(lambda _: self.quota_reservation.settle(spent_amount))
+
+    async def release(self) -> None:
+        await self.session.run_sync(lambda _: self.quota_reservation.release())
+
+
+class QuotaEngine:
+    """
+    Reserves the users resources before the external requests with one conditional
+    "UPDATE ... SET reserved = reserved + amount WHERE spent + reserved + amount <= limit" statement, so concurrent
+    requests of one user (from any thread or process) can never exceed the limit together. Every reservation is
+    recorded with its time, the reservations not finished for QUOTA_RESERVATION_TIMEOUT (left by the requests
+    interrupted by a restart or a crash) are released by the periodic sweep.
+    """
+
+    def __init__(self, timeout: float, sweep_interval: float) -> None:
+
+        self.timeout = timeout
+        self.sweep_interval = sweep_interval
+
+        self.logger = get_logger('main')
+
+        self._sweeper: Thread | None = None
+
+    @staticmethod
+    def reserve(session: Session, user: User, resource: QuotaResource, amount: int) -> QuotaReservation | None:
+        """
+        Return the reservation or None if the amount does not fit into the user limit.
+        """
+
+        reserved_column, spent_column = resource.reserved_column, resource.spent_column
+
+        result = session.execute(
+            update(User)
+            .where(User.id == user.id, spent_column + reserved_column + amount <= resource.limit)
+            .values({reserved_column: reserved_column + amount}),
+            execution_options={'synchronize_session': False},
+        )
+
+        if result.rowcount != 1:
+
+            session.commit()  # a rollback would expire the loaded user
+
+            return
+
+        record = UserQuotaReservation(user_id=user.id, resource=resource.value, amount=amount, reserved_at=time())
+
+        session.add(record)
+        session.commit()  # the reservation must be visible to the other requests right away
+
+        return QuotaReservation(session, user, resource, amount, record.id)
+
+    async def reserve_async(
+            self, session: AsyncSession, user: User, resource: QuotaResource, amount: int
+    ) -> AsyncQuotaReservation | None:
+        """
+        Like reserve, for the async mode.
+        """
+
+        quota_reservation = await session.run_sync(self.reserve, user, resource, amount)
+
+        return None if quota_reservation is None else AsyncQuotaReservation(session, quota_reservation)
+
+    def release_expired(self, session: Session) -> int:
+        """
+        Release the reservations older than the timeout (longer than any request lasts), return their amount. The
+        reservations of the requests still in progress (in other processes or replicas) are newer, so they are kept.
+        """
+
+        expired_records = session.execute(
+            select(
+                UserQuotaReservation.id,
+                UserQuotaReservation.user_id,
+                UserQuotaReservation.resource,
+                UserQuotaReservation.amount,
+            ).where(UserQuotaReservation.reserved_at < time() - self.timeout)
+        ).all()
+
+        session.commit()
+
+        released_reservations_amount = 0
+
+        for record_id, user_id, resource_value, amount in expired_records:
+
+            if _delete_reservation_record(session, record_id):
+
+                reserved_column = QuotaResource(resource_value).reserved_column
+
+                session.execute(
+                    update(User).where(User.id == user_id).values({reserved_column: reserved_column - amount}),
+                    execution_options={'synchronize_session': False},
+                )
+
+                released_reservations_amount += 1
+
+            session.commit()
+
+        return released_reservations_amount
+
+    def _sweep_periodically(self) -> None:
+        while True:
+
+            try:
+                with SessionLocal() as session:
+                    released_reservations_amount = self.release_expired(session)
+
+                if released_reservations_amount:
+                    self.logger.warning(f'{released_reservations_amount} expired quota reservations are released')
+
+            except SQLAlchemyError as e:
+                self.logger.error(f'Cannot release the expired quota reservations: {e}')
+
+            sleep(self.sweep_interval)
+
+    def start_sweeping(self) -> None:
+        """
+        Release the expired reservations now and then every sweep_interval seconds in a background thread.
+        """
+
+        if self._sweeper is None:
+
+            self._sweeper = Thread(target=self._sweep_periodically, name='quota_sweeper', daemon=True)
+
+            self._sweeper.start()
+
+
+quota_engine = QuotaEngine(QUOTA_RESERVATION_TIMEOUT, QUOTA_RESERVATION_SWEEP_INTERVAL)
@@ -0,0 +1,149 @@
+"""
+The settings are read on the import, so the environment is set before the project modules are imported. The tests
+use a temporary SQLite database or TEST_DB_URL (for example, a local PostgreSQL database, its tables are dropped).
+"""
+
+import os
+from pathlib import Path
+from tempfile import mkdtemp
+
+import pytest
+
+
+TEMPORARY_DIR = Path(mkdtemp(prefix='bot_tests_'))
+
+os.environ.update({
+    'DB_URL': os.environ.get('TEST_DB_URL') or f'sqlite:///{TEMPORARY_DIR / "bot.db"}',
+    'BOT_TOKEN': '123456:test',
+    'STT_API_KEY': 'key',
+    'STT_FOLDER_ID': 'folder',
+    'TTS_API_KEY': 'key',
+    'TTS_FOLDER_ID': 'folder',
+    'GPT_API_KEY': 'key',
+    'GPT_FOLDER_ID': 'folder',
+    'DEBUG_USER_ID': '1',
+    'LOGS_DIR': str(TEMPORARY_DIR / 'logs'),
+    'WARNING_LOG_FILE_PATH': str(TEMPORARY_DIR / 'warning.log'),
+    'INFO_LOG_FILE_PATH': str(TEMPORARY_DIR / 'info.log'),
+    'TTS_CACHE_DIR': str(TEMPORARY_DIR / 'tts_cache'),
+})
+
+from sql.models import Base  # noqa: E402 (the tables are registered by the import)
+from sql.database import engine, SessionLocal  # noqa: E402
+from sql.admission import user_admission  # noqa: E402
+from sql.message_journal import message_journal  # noqa: E402
+
+
+STT_TEXT = 'Привет, как дела?'
+
+
+@pytest.fixture
+def database():
+    """
+    Recreate the tables, return the session factory.
+    """
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+
+    with SessionLocal() as session:
+        user_admission.warm_up(session)  # forget the users of the previous tests
+
+    yield SessionLocal
+
+    message_journal.flush()  # the pending messages belong to this test database
+
+    engine.dispose()
+
+
+class TelegramStub:
+    """
+    Replaces the Telegram Bot API requests, the sent messages texts are collected by the chat id.
+    """
+
+    def __init__(self) -> None:
+
+        self.requests: list[tuple[str, dict]] = []
+        self.last_message_id = 0
+
+    def get_texts(self, chat_id: int) -> list[str]:
+        return [
+            params.get('text', '') for method_name, params in self.requests
+            if method_name in ('sendMessage', 'editMessageText') and int(params['chat_id']) == chat_id
+        ]
+
+    def make_request(self, _, method_name: str, method: str = 'get', params: dict | None = None, files=None):
+
+        self.requests.append((method_name, params or {}))
+
+        if method_name == 'getFile':
+            return {'file_id': params['file_id'], 'file_unique_id': params['file_id'], 'file_path': 'voice/file.oga'}
+
+        if method_name not in ('sendMessage', 'sendVoice', 'sendDocument', 'editMessageText'):
+            return True
+
+        self.last_message_id += 1
+
+        return {
+            'message_id': self.last_message_id,
+            'date': 0,
+            'chat': {'id': int(params['chat_id']), 'type': 'private'},
+            'text': params.get('text', ''),
+        }
+
+
+@pytest.fixture
+def telegram(monkeypatch):
+
+    from telebot import apihelper
+
+    telegram_stub = TelegramStub()
+
+    monkeypatch.setattr(apihelper, '_make_request', telegram_stub.make_request)
+    monkeypatch.setattr(apihelper, 'download_file', lambda token, file_path: b'voice')
+
+    return telegram_stub
+
+
+@pytest.fixture
+def bot(database, telegram, monkeypatch):
+    """
+    The bot with the stubbed Telegram and services, bot.process(user_id, text) processes one text message of the user
+    in this thread, bot.process_voice(user_id, duration) processes one voice message (recognized as STT_TEXT).
+    """
+
+    import main
+    from telebot import TeleBot, types
+    from services.gpt import gpt
+    from services.stt import stt
+
+    monkeypatch.setattr(gpt, 'ask', lambda prompt, previous_messages, summary=None: (f'Ответ на "{prompt}"', 10))
+    monkeypatch.setattr(gpt, 'get_prompt_tokens_amount', lambda prompt: len(prompt) // 4 + 1)
+    monkeypatch.setattr(stt, 'ask', lambda audio: (True, STT_TEXT))
+
+    test_bot = main.create_bot()
+    updates_amount = 0
+
+    def process_message(user_id: int, message_content: dict) -> None:
+
+        nonlocal updates_amount
+
+        updates_amount += 1
+
+        TeleBot.process_new_updates(test_bot, [types.Update.de_json({
+            'update_id': updates_amount,
+            'message': {
+                'message_id': updates_amount,
+                'date': 0,
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+                **message_content,
+            },
+        })])
+
+    test_bot.process = lambda user_id, text: process_message(user_id, {'text': text})
+    test_bot.process_voice = lambda user_id, duration: process_message(user_id, {
+        'voice': {'file_id': f'voice_{user_id}', 'file_unique_id': 'voice', 'duration': duration},
+    })
+
+    return test_bot
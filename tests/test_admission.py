@@ -0,0 +1,74 @@
+from multiprocessing import get_context
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+
+from sql.models import User
+from sql.crud import UserCrud
+from sql.database import Base
+from bot_support_modules import validators
+
+
+USERS_LIMIT_ERROR = 'К сожалению, в боте есть лимит на максимальное число пользователей, он превышен('
+
+
+def _count_users(session_factory) -> int:
+    with session_factory() as session:
+        return session.scalar(select(func.count()).select_from(User))
+
+
+def test_stats_does_not_admit_users_over_limit(bot, telegram, database, monkeypatch):
+
+    monkeypatch.setattr(validators, 'MAX_USERS_AMOUNT_LIMIT', 1)
+
+    for user_id in (1, 2):
+        bot.process(user_id, '/start')
+
+    bot.process(1, 'Привет')
+    bot.process(2, 'Привет')
+
+    assert telegram.get_texts(1)[-1] == 'Ответ на "Привет"'
+    assert telegram.get_texts(2)[-1] == USERS_LIMIT_ERROR
+
+    bot.process(2, '/stats')
+
+    assert 'Потрачено токенов: 0 из' in telegram.get_texts(2)[-1]
+
+    bot.process(2, 'Привет')
+
+    assert telegram.get_texts(2)[-1] == USERS_LIMIT_ERROR
+    assert _count_users(database) == 1
+
+
+def _admit_users(database_url: str, first_telegram_id: int, users_amount: int, users_limit: int) -> None:
+
+    session_factory = sessionmaker(bind=create_engine(database_url, connect_args={'timeout': 30}))
+
+    for telegram_id in range(first_telegram_id, first_telegram_id + users_amount):
+        with session_factory() as session:
+            UserCrud(session).get_or_create_within_limit(users_limit, telegram_id=telegram_id)
+
+
+def test_users_limit_holds_between_processes(tmp_path):
+
+    database_url = f'sqlite:///{tmp_path / "admission.db"}'
+    users_limit = 25
+
+    Base.metadata.create_all(bind=create_engine(database_url))
+
+    context = get_context('spawn')
+    processes = [
+        context.Process(target=_admit_users, args=(database_url, process_number * 1000, 50, users_limit))
+        for process_number in range(4)
+    ]
+
+    for process in processes:
+        process.start()
+
+    for process in processes:
+
+        process.join(60)
+
+        assert process.exitcode == 0
+
+    assert _count_users(sessionmaker(bind=create_engine(database_url))) == users_limit
@@ -0,0 +1,241 @@
+from random import random
+from typing import Any, Coroutine
+from asyncio import Lock, run, sleep
+
+import pytest
+from sqlalchemy import select, func
+from telebot import asyncio_helper, types
+
+import main
+from services.gpt import gpt
+from services.stt import stt
+from services.tts import tts
+from services.http_client import AsyncHTTPClient
+from sql import database as database_module, quotas
+from sql.admission import user_admission
+from sql.database import create_async_database_engine
+from bot_support_modules import validators
+from sql.models import User, UserQuotaReservation
+from conftest import STT_TEXT
+from settings import USER_FRIENDLY_REQUEST_ERROR_MESSAGE
+
+
+USERS_IDS = (10, 11, 12)
+MESSAGES_AMOUNT_BY_USER = 100
+
+
+class ConcurrencyCounter:
+    """
+    Counts the stubbed GPT requests in progress, keeps the max amount. The requests last the duration seconds (a
+    random time up to 10 ms if it is None).
+    """
+
+    def __init__(self) -> None:
+
+        self.in_progress = 0
+        self.max_in_progress = 0
+        self.duration = None
+
+    async def ask(self, prompt: str, *_, **__) -> tuple[str, int]:
+
+        self.in_progress += 1
+        self.max_in_progress = max(self.max_in_progress, self.in_progress)
+
+        await sleep(random() * 0.01 if self.duration is None else self.duration)
+
+        self.in_progress -= 1
+
+        return f'Ответ на "{prompt}"', 10
+
+
+def run_with_engine(coroutine: Coroutine) -> Any:
+    """
+    Run the coroutine in a new event loop, then close the async engine connections and the services sessions (they
+    belong to the loop).
+    """
+
+    async def _run() -> Any:
+        try:
+            return await coroutine
+
+        finally:
+
+            await database_module.async_engine.dispose()
+            await AsyncHTTPClient.close_all()
+
+    return run(_run())
+
+
+@pytest.fixture
+def async_bot(database, telegram, monkeypatch):
+    """
+    The async mode bot with the stubbed Telegram (the requests are collected by the telegram fixture) and services,
+    async_bot.process(*updates_batches) processes the batches one by one in a new event loop (the bot is used in one
+    loop, like in the async mode), return False if they are not processed in time.
+    """
+
+    async def process_request(token, url, method='get', params=None, files=None, **_):
+        return telegram.make_request(token, url, method, params, files)
+
+    async def download_file(*_) -> bytes:
+        return b'voice'
+
+    async def ask_stt(_) -> tuple[bool, str]:
+        return True, STT_TEXT
+
+    async def ask_tts(text: str) -> bytes:
+        return text.encode()
+
+    async def get_prompt_tokens_amount(prompt: str) -> int:
+        return len(prompt) // 4 + 1
+
+    create_async_database_engine()
+
+    monkeypatch.setattr(asyncio_helper, '_process_request', process_request)
+    monkeypatch.setattr(asyncio_helper, 'download_file', download_file)
+    monkeypatch.setattr(gpt, 'ask_async', ConcurrencyCounter().ask)
+    monkeypatch.setattr(gpt, 'get_prompt_tokens_amount_async', get_prompt_tokens_amount)
+    monkeypatch.setattr(stt, 'ask_async', ask_stt)
+    monkeypatch.setattr(tts, 'ask_async', ask_tts)
+    monkeypatch.setattr(user_admission, 'async_lock', Lock())  # bound to the event loop of the test
+    monkeypatch.setattr(quotas, 'TOKENS_LIMIT_BY_USER', 10 ** 9)
+
+    test_bot = main.create_async_bot()
+
+    async def process(updates_batches: tuple[list[types.Update], ...]) -> bool:
+
+        for updates in updates_batches:
+
+            await test_bot.process_new_updates(updates)
+
+            if not await test_bot.wait_for_updates(60):
+                return False
+
+        return True
+
+    test_bot.process = lambda *updates_batches: run_with_engine(process(updates_batches))
+
+    return test_bot
+
+
+def get_update(update_id: int, user_id: int, message_content: dict) -> types.Update:
+    return types.Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+            **message_content,
+        },
+    })
+
+
+def get_text_update(update_id: int, user_id: int, text: str) -> types.Update:
+    return get_update(update_id, user_id, {'text': text})
+
+
+def get_answers(telegram, user_id: int) -> list[str]:
+    return [text for text in telegram.get_texts(user_id) if text.startswith('Ответ на')]
+
+
+def get_user(session_factory, user_id: int) -> User:
+    with session_factory() as session:
+        return session.scalar(select(User).where(User.telegram_id == user_id))
+
+
+def get_start_updates(users_ids: tuple[int, ...]) -> list[types.Update]:
+    return [get_text_update(user_id, user_id, '/start') for user_id in users_ids]
+
+
+def test_user_updates_are_processed_in_order(async_bot, telegram, database):
+
+    updates = [
+        get_text_update(message_number * len(USERS_IDS) + user_number + 100, user_id, f'Сообщение {message_number}')
+        for message_number in range(MESSAGES_AMOUNT_BY_USER) for user_number, user_id in enumerate(USERS_IDS)
+    ]
+
+    assert async_bot.process(get_start_updates(USERS_IDS), updates)
+    assert gpt.ask_async.__self__.max_in_progress > 1  # the users are processed concurrently
+
+    for user_id in USERS_IDS:
+
+        assert get_answers(telegram, user_id) == [
+            f'Ответ на "Сообщение {message_number}"' for message_number in range(MESSAGES_AMOUNT_BY_USER)
+        ]
+
+        user = get_user(database, user_id)
+
+        assert (user.tokens_spent, user.tokens_reserved) == (MESSAGES_AMOUNT_BY_USER * 10, 0)
+
+
+def test_in_flight_updates_are_limited(database, telegram, monkeypatch, request):
+
+    monkeypatch.setattr(main, 'ASYNC_RUNTIME_MAX_IN_FLIGHT_UPDATES', 5)
+    monkeypatch.setattr(validators, 'MAX_USERS_AMOUNT_LIMIT', 100)
+
+    async_bot = request.getfixturevalue('async_bot')
+    users_ids = tuple(range(100, 150))
+
+    gpt.ask_async.__self__.duration = 0.1  # longer than the database requests of the next updates
+
+    assert async_bot.process(
+        get_start_updates(users_ids), [get_text_update(user_id + 1000, user_id, 'Привет') for user_id in users_ids]
+    )
+    assert gpt.ask_async.__self__.max_in_progress == 5
+    assert all(get_answers(telegram, user_id) == ['Ответ на "Привет"'] for user_id in users_ids)
+
+
+@pytest.mark.parametrize('gpt_answer', [(USER_FRIENDLY_REQUEST_ERROR_MESSAGE, None), RuntimeError('GPT stub error')])
+def test_failed_answer_releases_reservation(async_bot, telegram, database, monkeypatch, gpt_answer):
+
+    async def ask(*_, **__) -> tuple[str, int | None]:
+
+        if isinstance(gpt_answer, Exception):
+            raise gpt_answer
+
+        return gpt_answer
+
+    monkeypatch.setattr(gpt, 'ask_async', ask)
+
+    assert async_bot.process(get_start_updates(USERS_IDS[:1]), [get_text_update(100, USERS_IDS[0], 'Привет')])
+
+    user = get_user(database, USERS_IDS[0])
+
+    assert (user.tokens_spent, user.tokens_reserved) == (0, 0)
+
+    with database() as session:
+        assert session.scalar(select(func.count(UserQuotaReservation.id))) == 0
+
+    if not isinstance(gpt_answer, Exception):
+        assert telegram.get_texts(USERS_IDS[0])[-1] == USER_FRIENDLY_REQUEST_ERROR_MESSAGE
+
+
+def test_voice_message_is_answered_with_voice(async_bot, telegram, database):
+
+    user_id = USERS_IDS[0]
+
+    assert async_bot.process(get_start_updates((user_id,)), [get_update(100, user_id, {
+        'voice': {'file_id': 'voice', 'file_unique_id': 'voice', 'duration': 3},
+    })])
+
+    user = get_user(database, user_id)
+
+    assert [method_name for method_name, _ in telegram.requests[-2:]] == ['getFile', 'sendVoice']
+    assert user.second_blocks_spent == 1 and user.character_blocks_spent == 1 and user.tokens_spent == 10
+    assert (user.second_blocks_reserved, user.character_blocks_reserved, user.tokens_reserved) == (0, 0, 0)
+
+
+def test_debug_tts_waits_for_text_message(async_bot, telegram, database):
+
+    user_id = USERS_IDS[0]
+
+    assert async_bot.process(get_start_updates((user_id,)), [
+        get_text_update(100, user_id, '/toggle_debug'),
+        get_text_update(101, user_id, '/tts'),
+        get_text_update(102, user_id, 'Привет'),
+    ])
+
+    assert telegram.get_texts(user_id)[-2:] == ['Debug режим переключён', 'Отправьте текстовое сообщение для теста']
+    assert telegram.requests[-1][0] == 'sendVoice'
+    assert get_user(database, user_id).character_blocks_spent == 1
@@ -0,0 +1,173 @@
+import pytest
+
+from services.gpt import gpt
+from sql.crud import UserCrud, UserMessageCrud, UserSummaryCrud
+from sql.models import UserMessage
+from sql.model_enums import RolesEnum
+from sql.message_journal import message_journal
+from bot_support_modules.conversation_summarizer import ConversationSummarizer
+from settings import GPT_HISTORY_MESSAGES_AMOUNT
+
+
+TOKENS_BUDGET = 100
+MESSAGE_TEXT = 'x' * 20  # 20 tokens, a character per token
+
+
+@pytest.fixture
+def summarizer(monkeypatch):
+
+    monkeypatch.setattr(gpt, 'estimate_prompt_tokens_amount', len)
+
+    return ConversationSummarizer(True, TOKENS_BUDGET, 50, False)
+
+
+@pytest.fixture
+def summarize_requests(monkeypatch):
+    """
+    Replace the GPT summarization, collect the previous summaries and the summarized messages texts. The new summary
+    is "Пересказ <number of the request>", the requests fail while summarize_requests.is_failing is True.
+    """
+
+    class SummarizeRequests(list):
+        is_failing = False
+
+    requests = SummarizeRequests()
+
+    def summarize(summary: str | None, messages: list[UserMessage]) -> str | None:
+
+        requests.append((summary, [message.text for message in messages]))
+
+        return None if requests.is_failing else f'Пересказ {len(requests)}'
+
+    monkeypatch.setattr(gpt, 'summarize', summarize)
+
+    return requests
+
+
+@pytest.fixture
+def user_id(database):
+
+    with database() as session:
+        return UserCrud(session).create(telegram_id=100).id
+
+
+def add_messages(database, user_id: int, texts: list[str]) -> None:
+    with database() as session:
+        UserMessageCrud(session).bulk_create([
+            {'user_id': user_id, 'role': RolesEnum.USER, 'text': text} for text in texts
+        ])
+
+
+def get_messages(texts: list[str], first_id: int | None = 1) -> list[UserMessage]:
+    return [
+        UserMessage(id=None if first_id is None else first_id + number, user_id=1, role=RolesEnum.USER, text=text)
+        for number, text in enumerate(texts)
+    ]
+
+
+def test_split_keeps_newest_messages_within_half_budget(summarizer):
+
+    messages = get_messages([MESSAGE_TEXT] * 6)
+
+    summarized_messages, kept_messages = summarizer._split(messages)
+
+    assert summarized_messages == messages[:4]
+    assert kept_messages == messages[4:]  # 40 tokens, the third one would exceed 50
+
+
+def test_split_keeps_not_more_than_history_messages_amount(summarizer):
+
+    messages = get_messages(['x'] * (GPT_HISTORY_MESSAGES_AMOUNT + 5))
+
+    assert len(summarizer._split(messages)[1]) == GPT_HISTORY_MESSAGES_AMOUNT
+
+
+def test_split_never_summarizes_pending_messages(summarizer):
+
+    saved_messages = get_messages([MESSAGE_TEXT] * 3)
+    pending_messages = get_messages([MESSAGE_TEXT] * 3, first_id=None)
+
+    summarized_messages, kept_messages = summarizer._split(saved_messages + pending_messages)
+
+    assert summarized_messages == saved_messages
+    assert kept_messages == pending_messages
+
+    assert summarizer._split(pending_messages) == ([], pending_messages)
+
+
+def test_history_within_budget_is_not_summarized(database, summarizer, summarize_requests, user_id):
+
+    add_messages(database, user_id, [MESSAGE_TEXT] * 5)
+
+    with database() as session:
+        messages, summary = summarizer.get_context(session, user_id)
+
+    assert len(messages) == 5
+    assert summary is None
+    assert not summarize_requests
+
+
+def test_summary_is_continued_incrementally(database, summarizer, summarize_requests, user_id):
+
+    add_messages(database, user_id, [f'{number:02}' + MESSAGE_TEXT[2:] for number in range(6)])
+
+    with database() as session:
+        messages, summary = summarizer.get_context(session, user_id)
+
+    assert summary == 'Пересказ 1'
+    assert [message.text[:2] for message in messages] == ['04', '05']
+    assert summarize_requests[0] == (None, [f'{number:02}' + MESSAGE_TEXT[2:] for number in range(4)])
+
+    add_messages(database, user_id, [f'{number:02}' + MESSAGE_TEXT[2:] for number in range(6, 10)])
+
+    with database() as session:
+
+        messages, summary = summarizer.get_context(session, user_id)
+
+        assert UserSummaryCrud(session).get(user_id=user_id).text == 'Пересказ 2'
+
+    # only the messages after the first summary are summarized, the first summary is continued
+    assert summary == 'Пересказ 2'
+    assert summarize_requests[1] == ('Пересказ 1', [f'{number:02}' + MESSAGE_TEXT[2:] for number in range(4, 8)])
+    assert [message.text[:2] for message in messages] == ['08', '09']
+
+
+def test_failed_summary_is_retried_on_next_request(database, summarizer, summarize_requests, user_id):
+
+    add_messages(database, user_id, [MESSAGE_TEXT] * 6)
+
+    summarize_requests.is_failing = True
+
+    with database() as session:
+
+        messages, summary = summarizer.get_context(session, user_id)
+
+        assert UserSummaryCrud(session).get(user_id=user_id) is None
+
+    # the older messages are not sent this time
+    assert (len(messages), summary) == (2, None)
+
+    summarize_requests.is_failing = False
+
+    with database() as session:
+        messages, summary = summarizer.get_context(session, user_id)
+
+    assert (len(messages), summary) == (2, 'Пересказ 2')
+    assert summarize_requests[0] == summarize_requests[1]
+
+
+def test_pending_journal_messages_are_not_summarized(database, summarizer, summarize_requests, user_id, monkeypatch):
+
+    add_messages(database, user_id, [MESSAGE_TEXT] * 2)
+
+    get_history = message_journal.get_history
+    pending_messages = [UserMessage(user_id=user_id, role=RolesEnum.USER, text=MESSAGE_TEXT) for _ in range(5)]
+
+    monkeypatch.setattr(message_journal, 'get_history', lambda *args: get_history(*args) + pending_messages)
+
+    with database() as session:
+        messages, summary = summarizer.get_context(session, user_id)
+
+    assert summarize_requests == [(None, [MESSAGE_TEXT] * 2)]
+    assert messages == pending_messages
+    assert summary == 'Пересказ 1'
@@ -0,0 +1,181 @@
+"""
+The "ON CONFLICT" paths run on the tests database: SQLite by default, PostgreSQL if TEST_DB_URL is set (see conftest).
+"""
+
+from types import SimpleNamespace
+from threading import Thread, Barrier
+
+import pytest
+from sqlalchemy import select, func, event
+from sqlalchemy.dialects import postgresql, sqlite
+
+from sql.crud import BaseCrud, UserCrud, UserMessageCrud, TokensCountCrud, BotStateCrud
+from sql.database import engine
+from sql.models import User, TokensCount, BotState
+from sql.model_enums import RolesEnum
+
+
+RACERS_AMOUNT = 8
+
+
+@pytest.fixture(params=['on conflict', 'fallback'])
+def conflict_mode(request, monkeypatch):
+    """
+    Run the test with the dialect "ON CONFLICT" statements and with the fallback of the other dialects.
+    """
+
+    if request.param == 'fallback':
+        monkeypatch.setattr(BaseCrud, '_get_conflict_insert', lambda _: None)
+
+    return request.param
+
+
+@pytest.fixture
+def statements():
+
+    executed_statements = []
+
+    def before_cursor_execute(_, __, statement, *___):
+        executed_statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+
+    yield executed_statements
+
+    event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def test_upsert_inserts_and_updates(database, conflict_mode, statements):
+
+    with database() as session:
+
+        BotStateCrud(session).save(1, 2, 'DebugStates:active', {'key': 'value'})
+        BotStateCrud(session).save(1, 2, 'DebugStates:inactive', {})
+        TokensCountCrud(session).save('hash', 10, 100.0)
+        TokensCountCrud(session).save('hash', 20, 200.0)
+
+    with database() as session:
+
+        bot_state = session.scalars(select(BotState)).one()
+        tokens_count = session.scalars(select(TokensCount)).one()
+
+    assert (bot_state.chat_id, bot_state.user_id) == (1, 2)
+    assert (bot_state.state, bot_state.data) == ('DebugStates:inactive', {})
+    assert (tokens_count.tokens_amount, tokens_count.expires_at) == (20, 200.0)
+
+    if conflict_mode == 'on conflict':
+        assert sum('ON CONFLICT' in statement for statement in statements) == 4
+
+
+def test_upsert_returns_saved_object(database, conflict_mode):
+
+    with database() as session:
+
+        TokensCountCrud(session).save('hash', 10, 100.0)
+
+        tokens_count = TokensCountCrud(session).upsert(prompt_hash='hash', tokens_amount=30, expires_at=300.0)
+
+        assert (tokens_count.prompt_hash, tokens_count.tokens_amount) == ('hash', 30)
+
+
+def test_racing_get_or_create_returns_one_object(database, conflict_mode):
+    """
+    Every racer sees no user and inserts it, only one insert wins and all the racers get its user.
+    """
+
+    barrier = Barrier(RACERS_AMOUNT)
+    users_ids = []
+    errors = []
+
+    def race() -> None:
+        try:
+            with database() as session:
+
+                user_crud = UserCrud(session)
+                get = user_crud.get
+                is_first_get = True
+
+                def get_missing_first(*args, **kwargs):
+
+                    nonlocal is_first_get
+
+                    if is_first_get:
+
+                        is_first_get = False
+
+                        barrier.wait(10)
+
+                        return
+
+                    return get(*args, **kwargs)
+
+                user_crud.get = get_missing_first
+
+                users_ids.append(user_crud.get_or_create(telegram_id=100).id)
+
+        except Exception as e:
+            errors.append(e)
+
+    threads = [Thread(target=race) for _ in range(RACERS_AMOUNT)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+
+    with database() as session:
+
+        assert session.scalar(select(func.count()).select_from(User)) == 1
+        assert set(users_ids) == {session.scalar(select(User.id))}
+
+
+def test_get_or_create_returns_existing_object(database, conflict_mode, statements):
+
+    with database() as session:
+
+        user = UserCrud(session).get_or_create(telegram_id=100)
+
+        statements.clear()
+
+        assert UserCrud(session).get_or_create(telegram_id=100).id == user.id
+        assert len(statements) == 1  # the select
+
+
+def test_bulk_create_inserts_rows_with_one_statement(database, statements):
+
+    with database() as session:
+
+        user = UserCrud(session).create(telegram_id=100)
+
+        statements.clear()
+
+        UserMessageCrud(session).bulk_create([
+            {'user_id': user.id, 'role': RolesEnum.USER if number % 2 else RolesEnum.ASSISTANT, 'text': str(number)}
+            for number in range(50)
+        ])
+        UserMessageCrud(session).bulk_create([])
+
+        assert sum(statement.startswith('INSERT') for statement in statements) == 1
+
+        assert [message.text for message in UserMessageCrud(session).get_history(user.id, 100)] == [
+            str(number) for number in range(50)
+        ]
+
+
+@pytest.mark.parametrize('dialect_name, insert_module', [('postgresql', postgresql), ('sqlite', sqlite)])
+def test_conflict_insert_is_dialect_specific(dialect_name, insert_module):
+
+    session = SimpleNamespace(get_bind=lambda: SimpleNamespace(dialect=SimpleNamespace(name=dialect_name)))
+
+    assert isinstance(UserCrud(session)._get_conflict_insert(), insert_module.Insert)
+    assert UserMessageCrud(session)._get_conflict_insert() is None  # no conflict_index_elements
+
+
+def test_conflict_insert_is_not_used_on_other_dialects():
+
+    session = SimpleNamespace(get_bind=lambda: SimpleNamespace(dialect=SimpleNamespace(name='mysql')))
+
+    assert UserCrud(session)._get_conflict_insert() is None
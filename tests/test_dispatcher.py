@@ -0,0 +1,141 @@
+from threading import Thread, Event
+
+import pytest
+from sqlalchemy import select, func
+from telebot import TeleBot, types
+
+from sql import quotas
+from sql.models import User, UserQuotaReservation
+
+
+USERS_IDS = (10, 11, 12)
+MESSAGES_AMOUNT_BY_USER = 300
+REPLICAS_AMOUNT = 8  # the bot processes handling the same user at once
+
+
+def get_text_update(update_id: int, user_id: int, text: str) -> types.Update:
+    return types.Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+            'text': text,
+        },
+    })
+
+
+def get_answers(telegram, user_id: int) -> list[str]:
+    return [text for text in telegram.get_texts(user_id) if text.startswith('Ответ на')]
+
+
+@pytest.fixture
+def started_bot(bot, monkeypatch):
+    """
+    The bot with the users started and the tokens limit high enough for the stress tests.
+    """
+
+    monkeypatch.setattr(quotas, 'TOKENS_LIMIT_BY_USER', 10 ** 9)
+
+    for user_id in USERS_IDS:
+        bot.process(user_id, '/start')
+
+    return bot
+
+
+def assert_tokens_totals(database, user_id: int, messages_amount: int) -> None:
+
+    with database() as session:
+
+        user = session.scalar(select(User).where(User.telegram_id == user_id))
+
+        assert user.tokens_spent == messages_amount * 10  # the stubbed answer costs 10 tokens
+        assert user.tokens_reserved == 0
+        assert session.scalar(select(func.count(UserQuotaReservation.id))) == 0
+
+
+def test_shards_process_user_messages_in_order(started_bot, telegram, database):
+
+    updates = [
+        get_text_update(message_number * len(USERS_IDS) + user_number + 100, user_id, f'Сообщение {message_number}')
+        for message_number in range(MESSAGES_AMOUNT_BY_USER) for user_number, user_id in enumerate(USERS_IDS)
+    ]
+
+    started_bot.process_new_updates(updates)
+
+    assert started_bot.wait_for_shards(60)
+
+    for user_id in USERS_IDS:
+
+        assert get_answers(telegram, user_id) == [
+            f'Ответ на "Сообщение {message_number}"' for message_number in range(MESSAGES_AMOUNT_BY_USER)
+        ]
+
+        assert_tokens_totals(database, user_id, MESSAGES_AMOUNT_BY_USER)
+
+
+def test_concurrent_messages_of_user_are_charged_exactly(started_bot, telegram, database):
+
+    user_id = USERS_IDS[0]
+    messages_amount_by_replica = MESSAGES_AMOUNT_BY_USER // REPLICAS_AMOUNT
+    errors = []
+
+    def process_messages(replica_number: int) -> None:
+        try:
+            for message_number in range(messages_amount_by_replica):
+
+                update_id = 1000 + replica_number * messages_amount_by_replica + message_number
+
+                # not sharded, like the replicas of the bot
+                TeleBot.process_new_updates(started_bot, [get_text_update(update_id, user_id, 'Привет')])
+
+        except Exception as e:
+            errors.append(e)
+
+    threads = [Thread(target=process_messages, args=(replica_number,)) for replica_number in range(REPLICAS_AMOUNT)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert len(get_answers(telegram, user_id)) == messages_amount_by_replica * REPLICAS_AMOUNT
+
+    assert_tokens_totals(database, user_id, messages_amount_by_replica * REPLICAS_AMOUNT)
+
+
+def test_queued_updates_are_not_polled_again(started_bot, telegram, monkeypatch):
+    """
+    The polling requests the next updates while the shards are still busy with the previous ones, they must not be
+    received (and processed) twice.
+    """
+
+    from services.gpt import gpt
+
+    user_id = USERS_IDS[0]
+    pending_updates = [
+        get_text_update(update_id, user_id, f'Сообщение {update_id}') for update_id in range(2001, 2021)
+    ]
+    answers_allowed = Event()
+
+    def ask(prompt, *_, **__):
+
+        answers_allowed.wait(10)
+
+        return f'Ответ на "{prompt}"', 10
+
+    monkeypatch.setattr(gpt, 'ask', ask)
+    monkeypatch.setattr(started_bot, 'get_updates', lambda offset, **_: [
+        update for update in pending_updates if update.update_id >= offset
+    ])
+
+    started_bot._TeleBot__retrieve_updates()
+    started_bot._TeleBot__retrieve_updates()  # the shard is blocked by the first update
+
+    answers_allowed.set()
+
+    assert started_bot.wait_for_shards(60)
+    assert len(get_answers(telegram, user_id)) == len(pending_updates)
@@ -0,0 +1,178 @@
+from json import dumps
+from datetime import timedelta
+
+import pytest
+from requests import Response
+
+from services import gpt_cache
+from services.gpt import gpt
+from services.gpt_cache import GPTResponseCache
+from sql.models import UserMessage
+from sql.model_enums import RolesEnum
+from settings import USER_FRIENDLY_REQUEST_ERROR_MESSAGE
+
+
+def create_cache(max_items: int = 10, variants_amount: int = 2) -> GPTResponseCache:
+    return GPTResponseCache(max_items, 60, variants_amount, 2, 100)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    The cache time, it is moved by the tests.
+    """
+
+    clock = [1000.0]
+
+    monkeypatch.setattr(gpt_cache, 'time', lambda: clock[0])
+
+    return clock
+
+
+class CompletionPrompts(list):
+    """
+    The prompts sent to the GPT and the next GPT responses: status codes, exceptions or the stream lines (the stream
+    without the final answer is broken).
+    """
+
+    def __init__(self) -> None:
+
+        super().__init__()
+
+        self.responses = []
+
+
+@pytest.fixture
+def completion(monkeypatch):
+    """
+    The GPT with a new response cache (a variant for every key) and the stubbed completion requests, collect the
+    prompts. The responses are the completion.responses items, then 200 ones answering "Ответ на <prompt>".
+    """
+
+    completion_prompts = CompletionPrompts()
+
+    def post(_, json: dict, **__) -> Response:
+
+        prompt = json['messages'][-1]['text']
+
+        completion_prompts.append(prompt)
+
+        response_data = completion_prompts.responses.pop(0) if completion_prompts.responses else 200
+
+        if isinstance(response_data, Exception):
+            raise response_data
+
+        response = Response()
+
+        response.status_code = 200 if isinstance(response_data, list) else response_data
+        response.elapsed = timedelta(seconds=0.1)
+        response._content_consumed = True  # the stream lines are read from the content
+
+        if isinstance(response_data, list):
+            response._content = '\n'.join(dumps({'result': line}) for line in response_data).encode()
+
+        else:
+            response._content = dumps({'result': {
+                'alternatives': [{'message': {'text': f'Ответ на {prompt}'}, 'status': 'ALTERNATIVE_STATUS_FINAL'}],
+                'usage': {'completionTokens': '5'},
+            }}).encode()
+
+        return response
+
+    monkeypatch.setattr(gpt, 'response_cache', create_cache(variants_amount=1))
+    monkeypatch.setattr(gpt.http_client, 'post', post)
+
+    return completion_prompts
+
+
+def test_answers_are_missed_until_variants_are_collected():
+
+    cache = create_cache()
+    key = cache.get_key('Как дела?', [], None)
+
+    cache.add(key, 'Хорошо', 5)
+
+    assert cache.get(key) is None
+
+    cache.add(key, 'Отлично', 6)
+
+    assert [cache.get(key) for _ in range(3)] == [('Хорошо', 5), ('Отлично', 6), ('Хорошо', 5)]
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_same_answers_are_stored_once():
+
+    cache = create_cache()
+    key = cache.get_key('Как дела?', [], None)
+
+    cache.add(key, 'Хорошо', 5)
+    cache.add(key, 'Хорошо', 5)
+
+    assert [cache.get(key) for _ in range(2)] == [('Хорошо', 5), ('Хорошо', 5)]
+
+
+def test_key_is_normalized_and_depends_on_context():
+
+    cache = create_cache()
+    history = [UserMessage(role=RolesEnum.USER, text='Привет'), UserMessage(role=RolesEnum.ASSISTANT, text='Привет!')]
+
+    assert cache.get_key('Как дела?', [], None) == cache.get_key('  как   ДЕЛА ', [], None)
+    assert cache.get_key('Как дела?', [], None) != cache.get_key('Как дела?', history, None)
+    assert cache.get_key('Как дела?', [], None) != cache.get_key('Как дела?', [], 'Краткое содержание')
+    assert cache.get_key('а' * 101, [], None) is None  # too long to be cached
+
+
+def test_answers_expire_after_ttl(clock):
+
+    cache = create_cache(variants_amount=1)
+    key = cache.get_key('Как дела?', [], None)
+
+    cache.add(key, 'Хорошо', 5)
+    clock[0] += 59
+
+    assert cache.get(key) == ('Хорошо', 5)
+
+    clock[0] += 1
+
+    assert cache.get(key) is None
+
+
+def test_least_recently_used_key_is_evicted():
+
+    cache = create_cache(max_items=2, variants_amount=1)
+    first_key, second_key, third_key = (cache.get_key(prompt, [], None) for prompt in ('Первый', 'Второй', 'Третий'))
+
+    cache.add(first_key, 'Первый ответ', 1)
+    cache.add(second_key, 'Второй ответ', 2)
+    cache.get(first_key)
+    cache.add(third_key, 'Третий ответ', 3)
+
+    assert cache.get(second_key) is None  # the least recently used one
+    assert (cache.get(first_key), cache.get(third_key)) == (('Первый ответ', 1), ('Третий ответ', 3))
+
+
+def test_answer_is_cached(completion):
+
+    assert gpt.ask('Как дела?', []) == gpt.ask('Как дела?', []) == ('Ответ на Как дела?', 5)
+    assert completion == ['Как дела?']
+
+
+@pytest.mark.parametrize('failure', [500, 429, ConnectionError('Refused')])
+def test_failed_answer_is_not_cached(completion, failure):
+
+    completion.responses = [failure]
+
+    assert gpt.ask('Как дела?', []) == (USER_FRIENDLY_REQUEST_ERROR_MESSAGE, None)
+    assert gpt.ask('Как дела?', []) == ('Ответ на Как дела?', 5)  # requested again
+    assert completion == ['Как дела?', 'Как дела?']
+
+
+def test_broken_stream_answer_is_not_cached(completion):
+
+    completion.responses = [[
+        {'alternatives': [{'message': {'text': 'Ответ'}, 'status': 'ALTERNATIVE_STATUS_PARTIAL'}]},
+    ]]
+
+    assert list(gpt.ask_stream('Как дела?', []))[-1] == (USER_FRIENDLY_REQUEST_ERROR_MESSAGE, None, True)
+    assert gpt.response_cache.get(gpt.response_cache.get_key('Как дела?', [], None)) is None
+    assert list(gpt.ask_stream('Как дела?', []))[-1] == ('Ответ на Как дела?', 5, True)
@@ -0,0 +1,321 @@
+import random
+from time import sleep, monotonic
+from asyncio import gather, run
+from threading import Thread
+from statistics import quantiles
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+import requests
+
+from services import http_client
+from services.flow_control import AIMDConcurrencyLimiter
+from services.http_client import HTTPClient, AsyncHTTPClient, ServiceUnavailableError
+
+
+class ServiceStub(ThreadingHTTPServer):
+    """
+    Local service with the injected faults: every response is delayed by delay seconds and has the status code (the
+    first responses have the status_codes if given, with the Retry-After header if retry_after is set), every new
+    connection is accepted in connection_delay seconds (like the TLS handshake). The requests times and the
+    connections amount are counted.
+    """
+
+    daemon_threads = True
+
+    def __init__(self) -> None:
+
+        super().__init__(('127.0.0.1', 0), ServiceStubRequestHandler)
+
+        self.delay = 0.0
+        self.status_code = 200
+        self.status_codes = []
+        self.retry_after = None
+        self.connection_delay = 0.0
+
+        self.requests_times = []
+        self.connections_amount = 0
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/'
+
+    def finish_request(self, request, client_address) -> None:
+
+        self.connections_amount += 1
+
+        sleep(self.connection_delay)
+
+        super().finish_request(request, client_address)
+
+
+class ServiceStubRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    disable_nagle_algorithm = True  # the headers and the body are written separately
+
+    def do_POST(self):
+
+        self.server.requests_times.append(monotonic())
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        sleep(self.server.delay)
+
+        self.send_response(self.server.status_codes.pop(0) if self.server.status_codes else self.server.status_code)
+        self.send_header('Content-Length', '2')
+
+        if self.server.retry_after is not None:
+            self.send_header('Retry-After', str(self.server.retry_after))
+
+        self.end_headers()
+
+        self.wfile.write(b'{}')
+
+    def log_message(self, *_) -> None:
+        pass
+
+
+@pytest.fixture
+def service():
+
+    service_stub = ServiceStub()
+
+    Thread(target=service_stub.serve_forever, daemon=True).start()
+
+    yield service_stub
+
+    service_stub.shutdown()
+    service_stub.server_close()
+
+
+@pytest.fixture
+def client(monkeypatch):
+
+    monkeypatch.setattr(http_client, 'HTTP_CONCURRENCY_QUEUE_TIMEOUT', 0.05)
+
+    service_client = HTTPClient('Stub', pool_size=10)
+
+    service_client.concurrency_limiter = AIMDConcurrencyLimiter(1, 10)
+
+    return service_client
+
+
+def send_requests(client: HTTPClient, url: str, requests_amount: int) -> list[int | str]:
+    """
+    Send the requests at once, return their status codes (the exception class names for the failed ones).
+    """
+
+    def send_request(_) -> int | str:
+
+        try:
+            return client.request('POST', url, is_retried=False, json={}).status_code
+
+        except Exception as e:
+            return type(e).__name__
+
+    with ThreadPoolExecutor(requests_amount) as executor:
+        return list(executor.map(send_request, range(requests_amount)))
+
+
+def test_requests_over_limit_wait_for_healthy_service(service, client):
+
+    service.delay = 0.2
+
+    results = send_requests(client, service.url, 100)
+
+    assert results == [200] * 100
+    assert client.concurrency_limiter.in_flight == 0
+
+
+def test_waiting_requests_fail_when_circuit_opens(service, client):
+
+    service.delay = 0.2
+    service.status_code = 500
+
+    results = send_requests(client, service.url, 100)
+
+    # the first failures open the circuit, the rest requests are rejected without sending
+    assert set(results) == {500, 'ServiceUnavailableError'}
+    assert results.count(500) <= 10 + client.circuit_breaker.failures_threshold
+    assert client.circuit_breaker.is_open
+    assert client.concurrency_limiter.in_flight == 0
+
+    with pytest.raises(ServiceUnavailableError):
+        client.request('POST', service.url, is_retried=False, json={})
+
+
+def test_slow_responses_decrease_limit(service, client, monkeypatch):
+
+    monkeypatch.setattr(http_client, 'HTTP_CONCURRENCY_SLOW_RESPONSE_TIME', 0.1)
+
+    service.delay = 0.15
+
+    assert send_requests(client, service.url, 10) == [200] * 10
+    assert client.concurrency_limiter.limit == 1
+    assert not client.circuit_breaker.is_open  # slow responses are not failures
+
+
+def test_timeouts_open_circuit(service, client, monkeypatch):
+
+    monkeypatch.setattr(http_client, 'HTTP_READ_TIMEOUT', 0.1)
+
+    service.delay = 0.3
+
+    results = send_requests(client, service.url, 10)
+
+    assert set(results) <= {'ReadTimeout', 'ConnectionError', 'ServiceUnavailableError'}
+    assert client.circuit_breaker.is_open
+
+
+def measure_latencies(send_request, requests_amount: int) -> tuple[float, float]:
+    """
+    Send the requests one by one, return the p50 and p99 latencies.
+    """
+
+    latencies = []
+
+    for _ in range(requests_amount):
+
+        start_time = monotonic()
+
+        assert send_request().status_code == 200
+
+        latencies.append(monotonic() - start_time)
+
+    percentiles = quantiles(latencies, n=100, method='inclusive')
+
+    return percentiles[49], percentiles[98]
+
+
+def test_connection_is_reused(service, client):
+
+    for _ in range(20):
+        assert client.post(service.url, json={}).status_code == 200
+
+    assert len(service.requests_times) == 20
+    assert service.connections_amount == 1
+
+
+def test_reused_connection_latencies(service, client):
+
+    service.connection_delay = 0.02
+
+    # a new connection for every request, like the module-level requests.post calls before the client
+    new_connection_latencies = measure_latencies(lambda: requests.post(service.url, json={}), 50)
+    connections_amount = service.connections_amount
+
+    reused_connection_latencies = measure_latencies(lambda: client.post(service.url, json={}), 50)
+
+    assert connections_amount == 50
+    assert service.connections_amount == connections_amount + 1
+    # every request waits for its connection, only the first one waits with the client
+    assert min(new_connection_latencies) >= service.connection_delay
+    assert reused_connection_latencies[0] < service.connection_delay
+
+
+def create_retrying_client(monkeypatch, backoff_factor: float, backoff_jitter: float) -> HTTPClient:
+
+    monkeypatch.setattr(http_client, 'HTTP_RETRIES_AMOUNT', 2)
+    monkeypatch.setattr(http_client, 'HTTP_RETRY_BACKOFF_FACTOR', backoff_factor)
+    monkeypatch.setattr(http_client, 'HTTP_RETRY_BACKOFF_JITTER', backoff_jitter)
+
+    return HTTPClient('Stub', pool_size=10)
+
+
+@pytest.mark.parametrize('status_code', HTTPClient.RETRY_STATUS_CODES)
+def test_failed_request_is_retried(service, monkeypatch, status_code):
+
+    service.status_codes = [status_code]
+
+    response = create_retrying_client(monkeypatch, 0, 0).post(service.url, json={})
+
+    assert response.status_code == 200
+    assert len(service.requests_times) == 2
+
+
+def test_retries_amount_is_limited(service, monkeypatch):
+
+    service.status_code = 503
+
+    response = create_retrying_client(monkeypatch, 0, 0).post(service.url, json={})
+
+    assert response.status_code == 503  # the last response is returned
+    assert len(service.requests_times) == 3
+
+
+def test_streamed_request_is_not_retried(service, client):
+
+    service.status_codes = [503]
+
+    assert client.post(service.url, data=iter([b'{}']), is_retried=False).status_code == 503
+    assert len(service.requests_times) == 1
+
+
+def test_retries_backoff_is_jittered(service, monkeypatch):
+
+    service.status_codes = [503, 503]
+
+    monkeypatch.setattr(random, 'random', lambda: 1.0)  # the longest jitter
+
+    response = create_retrying_client(monkeypatch, 0.05, 0.2).post(service.url, json={})
+    first_retry_time, second_retry_time = service.requests_times[1:]
+
+    assert response.status_code == 200
+    # the first retry is sent at once, the second one in backoff_factor * 2 seconds plus the jitter
+    assert first_retry_time - service.requests_times[0] < 0.1
+    assert second_retry_time - first_retry_time >= 0.05 * 2 + 0.2
+
+
+def test_retry_after_header_is_respected(service, monkeypatch):
+
+    service.status_codes = [429]
+    service.retry_after = 1
+
+    response = create_retrying_client(monkeypatch, 0, 0).post(service.url, json={})
+
+    assert response.status_code == 200
+    assert service.requests_times[1] - service.requests_times[0] >= 1
+
+
+async def send_async_requests(client: AsyncHTTPClient, url: str, requests_amount: int) -> list[int]:
+    """
+    Send the requests at once in the event loop, return their status codes.
+    """
+
+    async def send_request() -> int:
+        return (await client.post(url, is_retried=False, json={})).status
+
+    try:
+        return list(await gather(*(send_request() for _ in range(requests_amount))))
+
+    finally:
+        await client.close()
+
+
+def test_async_requests_over_limit_wait_for_healthy_service(service, client):
+
+    service.delay = 0.2
+
+    assert run(send_async_requests(AsyncHTTPClient(client), service.url, 50)) == [200] * 50
+    assert client.concurrency_limiter.in_flight == 0
+    assert len(service.requests_times) == 50
+
+
+@pytest.mark.parametrize('status_code', HTTPClient.RETRY_STATUS_CODES)
+def test_failed_async_request_is_retried(service, monkeypatch, status_code):
+
+    service.status_codes = [status_code]
+
+    async def send_request() -> int:
+
+        async_client = AsyncHTTPClient(create_retrying_client(monkeypatch, 0, 0))
+
+        try:
+            return (await async_client.post(service.url, json={})).status
+
+        finally:
+            await async_client.close()
+
+    assert run(send_request()) == 200
+    assert len(service.requests_times) == 2
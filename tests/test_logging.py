@@ -0,0 +1,75 @@
+import sys
+import pickle
+from io import StringIO
+from json import loads
+from queue import SimpleQueue
+from logging import getLogger, Formatter, StreamHandler, INFO
+from logging.handlers import QueueListener
+
+import pytest
+
+from get_logger import ExceptionKeepingQueueHandler, JSONLinesFormatter
+
+
+@pytest.fixture
+def queue_logger():
+    """
+    A logger writing through the queue into two streams: with the text formatter and with the JSON lines one.
+    """
+
+    logs_queue = SimpleQueue()
+    text_stream, json_stream = StringIO(), StringIO()
+    text_handler, json_handler = StreamHandler(text_stream), StreamHandler(json_stream)
+
+    text_handler.setFormatter(Formatter('[{levelname}] message - "{message}"', style='{'))
+    json_handler.setFormatter(JSONLinesFormatter())
+
+    listener = QueueListener(logs_queue, text_handler, json_handler)
+    logger = getLogger('test_queue_logger')
+
+    logger.setLevel(INFO)
+    logger.addHandler(ExceptionKeepingQueueHandler(logs_queue))
+
+    listener.start()
+
+    yield logger, listener, text_stream, json_stream
+
+    logger.handlers.clear()
+
+
+def test_exception_is_formatted_by_listener_handlers(queue_logger):
+
+    logger, listener, text_stream, json_stream = queue_logger
+
+    try:
+        raise ValueError('Broken')
+
+    except ValueError:
+        logger.exception('Request %s failed', 'GPT', extra={'service_name': 'GPT'})
+
+    listener.stop()
+
+    record_json = loads(json_stream.getvalue())
+
+    assert record_json['message'] == 'Request GPT failed'
+    assert record_json['service_name'] == 'GPT'
+    assert record_json['exception'].startswith('Traceback') and 'ValueError: Broken' in record_json['exception']
+    assert text_stream.getvalue().startswith('[ERROR] message - "Request GPT failed"\nTraceback')
+
+
+def test_prepared_record_can_be_pickled(queue_logger):
+
+    logger, *_ = queue_logger
+    handler = logger.handlers[0]
+
+    try:
+        raise ValueError('Broken')
+
+    except ValueError:
+        record = logger.makeRecord(logger.name, INFO, __file__, 0, 'Failed %s', ('GPT',), sys.exc_info())
+
+    prepared_record = pickle.loads(pickle.dumps(handler.prepare(record)))
+
+    assert prepared_record.getMessage() == 'Failed GPT'
+    assert 'ValueError: Broken' in prepared_record.exc_text
+    assert record.exc_info is not None  # the logged record is not changed for the other handlers
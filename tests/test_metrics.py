@@ -0,0 +1,126 @@
+from time import perf_counter
+from threading import Thread
+
+import pytest
+
+from metrics import BUCKETS, NULL_CONTEXT, Histogram, Metrics
+
+
+THREADS_AMOUNT = 8
+OBSERVATIONS_AMOUNT_BY_THREAD = 10000
+MAX_MEASUREMENT_OVERHEAD = 20 * 10 ** -6  # seconds, generous for the slow CI machines, it is ~1 us usually
+
+
+def test_values_are_counted_in_prometheus_buckets():
+
+    histogram = Histogram('test', {})
+
+    for value in (0, BUCKETS[0], BUCKETS[0] * 1.5, BUCKETS[-1], BUCKETS[-1] + 1):
+        histogram.observe(value)
+
+    buckets_counts, values_sum = histogram.get_snapshot()
+
+    # the bucket bound is inclusive ("le"), the values over the last bound are in the +Inf bucket
+    assert buckets_counts[0] == 2
+    assert buckets_counts[1] == 1
+    assert buckets_counts[-2] == 1
+    assert buckets_counts[-1] == 1
+    assert sum(buckets_counts) == 5
+    assert values_sum == pytest.approx(BUCKETS[0] * 2.5 + BUCKETS[-1] * 2 + 1)
+
+
+def test_concurrent_observations_are_not_lost():
+
+    histogram = Histogram('test', {})
+
+    def observe() -> None:
+        for _ in range(OBSERVATIONS_AMOUNT_BY_THREAD):
+            histogram.observe(0.01)
+
+    threads = [Thread(target=observe) for _ in range(THREADS_AMOUNT)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    buckets_counts, values_sum = histogram.get_snapshot()
+
+    assert sum(buckets_counts) == THREADS_AMOUNT * OBSERVATIONS_AMOUNT_BY_THREAD
+    assert values_sum == pytest.approx(THREADS_AMOUNT * OBSERVATIONS_AMOUNT_BY_THREAD * 0.01)
+
+
+def test_empty_histogram_snapshot():
+    assert Histogram('test', {}).get_snapshot() == ([0] * (len(BUCKETS) + 1), 0)
+
+
+@pytest.mark.parametrize('buckets_counts, quantile, expected_value', [
+    ([0] * (len(BUCKETS) + 1), 0.5, 0),
+    ([10] + [0] * len(BUCKETS), 0.5, BUCKETS[0] / 2),  # linear inside the bucket
+    ([0, 4, 4] + [0] * (len(BUCKETS) - 2), 0.25, (BUCKETS[0] + BUCKETS[1]) / 2),
+    ([0, 4, 4] + [0] * (len(BUCKETS) - 2), 1, BUCKETS[2]),
+    ([1] + [0] * (len(BUCKETS) - 1) + [9], 0.99, BUCKETS[-1]),  # the +Inf bucket
+])
+def test_get_quantile(buckets_counts, quantile, expected_value):
+    assert Histogram.get_quantile(buckets_counts, quantile) == pytest.approx(expected_value)
+
+
+def test_prometheus_rendering():
+
+    metrics = Metrics(True)
+
+    for value in (2 ** -9, 2 ** -9, 0.25):  # exact binary fractions, so the sum is exact
+        metrics.get_histogram('bot_handler_duration_seconds', handler='text').observe(value)
+
+    metrics.get_histogram('bot_handler_duration_seconds', handler='"voice"\n').observe(100)
+    metrics.register_gauge('bot_cache_hit_rate', 'Caches hit rates', lambda: 0.5, cache='TTS')
+
+    lines = metrics.render_prometheus().splitlines()
+
+    assert lines[:2] == [
+        '# HELP bot_handler_duration_seconds Telegram messages handlers duration',
+        '# TYPE bot_handler_duration_seconds histogram',
+    ]
+    assert 'bot_handler_duration_seconds_bucket{handler="text",le="0.001"} 0' in lines
+    assert 'bot_handler_duration_seconds_bucket{handler="text",le="0.0025"} 2' in lines
+    assert 'bot_handler_duration_seconds_bucket{handler="text",le="0.25"} 3' in lines  # cumulative
+    assert 'bot_handler_duration_seconds_bucket{handler="text",le="+Inf"} 3' in lines
+    assert 'bot_handler_duration_seconds_count{handler="text"} 3' in lines
+    assert 'bot_handler_duration_seconds_sum{handler="text"} 0.25390625' in lines
+    assert 'bot_handler_duration_seconds_bucket{handler="\\"voice\\"\\n",le="60"} 0' in lines
+    assert 'bot_handler_duration_seconds_bucket{handler="\\"voice\\"\\n",le="+Inf"} 1' in lines
+    assert lines[-3:] == [
+        '# HELP bot_cache_hit_rate Caches hit rates',
+        '# TYPE bot_cache_hit_rate gauge',
+        'bot_cache_hit_rate{cache="TTS"} 0.5',
+    ]
+
+
+def test_disabled_metrics_do_not_measure():
+
+    metrics = Metrics(False)
+
+    def handler() -> None:
+        pass
+
+    assert metrics.measure('bot_handler_duration_seconds') is NULL_CONTEXT
+    assert metrics.timed('bot_handler_duration_seconds')(handler) is handler
+
+    metrics.register_gauge('bot_cache_hit_rate', 'Caches hit rates', lambda: 0.5)
+
+    assert metrics.render_prometheus() == '\n'
+
+
+def test_measurement_overhead():
+
+    histogram = Metrics(True).get_histogram('bot_db_query_duration_seconds')
+    measurements_amount = 100000
+
+    start_time = perf_counter()
+
+    for _ in range(measurements_amount):
+        with histogram.time():
+            pass
+
+    assert (perf_counter() - start_time) / measurements_amount < MAX_MEASUREMENT_OVERHEAD
@@ -0,0 +1,117 @@
+from time import sleep
+from zlib import crc32
+
+import pytest
+
+from bot_support_modules import multiprocess_runtime
+from bot_support_modules.multiprocess_runtime import _Supervisor, get_update_worker_number
+
+
+WORKERS_AMOUNT = 4
+
+
+def create_update(update_id: int, user_id: int, update_type: str = 'message') -> dict:
+    return {'update_id': update_id, update_type: {'from': {'id': user_id}, 'chat': {'id': user_id}}}
+
+
+@pytest.fixture
+def supervisor(monkeypatch):
+    """
+    The supervisor of the workers sleeping instead of processing the updates (they are left in the queues), the
+    queues hold one update.
+    """
+
+    monkeypatch.setattr(multiprocess_runtime, 'BOT_SHARD_QUEUE_MAX_SIZE', 1)
+    monkeypatch.setattr(multiprocess_runtime, 'WORKER_PUT_TIMEOUT', 0.1)
+
+    workers_supervisor = _Supervisor(lambda: None, WORKERS_AMOUNT)
+
+    workers_supervisor._create_worker = lambda worker_number: workers_supervisor.context.Process(
+        target=sleep, args=(60,), name=f'bot_worker_{worker_number}'
+    )
+    workers_supervisor.workers = [workers_supervisor._create_worker(number) for number in range(WORKERS_AMOUNT)]
+
+    yield workers_supervisor
+
+    for worker in workers_supervisor.workers:
+        if worker.is_alive():
+            worker.kill()
+
+    for updates_queue in workers_supervisor.updates_queues:
+        updates_queue.cancel_join_thread()
+
+
+def test_user_updates_are_routed_to_one_worker():
+
+    for user_id in range(100):
+
+        worker_number = get_update_worker_number(create_update(1, user_id), WORKERS_AMOUNT)
+
+        assert worker_number == crc32(str(user_id).encode()) % WORKERS_AMOUNT
+        assert all(
+            get_update_worker_number(create_update(update_id, user_id, update_type), WORKERS_AMOUNT) == worker_number
+            for update_id, update_type in enumerate(('edited_message', 'callback_query', 'message'), 2)
+        )
+
+
+def test_users_are_distributed_between_workers():
+
+    users_amounts = [0] * WORKERS_AMOUNT
+
+    for user_id in range(1000):
+        users_amounts[get_update_worker_number(create_update(1, user_id), WORKERS_AMOUNT)] += 1
+
+    assert min(users_amounts) > 1000 / WORKERS_AMOUNT * 0.8
+
+
+def test_update_without_user_is_routed_by_update_id():
+
+    update = {'update_id': 7, 'poll': {'id': 'poll'}}
+
+    assert get_update_worker_number(update, WORKERS_AMOUNT) == crc32(b'7') % WORKERS_AMOUNT
+
+
+def test_update_is_put_into_user_worker_queue(supervisor):
+
+    update = create_update(1, 10)
+
+    supervisor.put_update(update)
+
+    assert supervisor.updates_queues[get_update_worker_number(update, WORKERS_AMOUNT)].get(timeout=5) == update
+
+
+def test_dead_worker_is_restarted(supervisor):
+
+    supervisor.start_workers()
+
+    dead_worker = supervisor.workers[1]
+    dead_worker_queue = supervisor.updates_queues[1]
+    alive_workers = supervisor.workers[:1] + supervisor.workers[2:]
+
+    dead_worker.kill()
+    dead_worker.join(5)
+
+    supervisor.restart_dead_workers()
+
+    assert supervisor.workers[1] is not dead_worker and supervisor.workers[1].is_alive()
+    assert supervisor.updates_queues[1] is not dead_worker_queue  # the dead worker could hold the queue lock
+    assert supervisor.workers[:1] + supervisor.workers[2:] == alive_workers
+
+
+def test_dead_worker_is_restarted_when_its_queue_is_full(supervisor):
+
+    supervisor.start_workers()
+
+    user_id = next(
+        user_id for user_id in range(100) if get_update_worker_number(create_update(1, user_id), WORKERS_AMOUNT) == 1
+    )
+    dead_worker = supervisor.workers[1]
+
+    supervisor.put_update(create_update(1, user_id))  # never received by the sleeping worker, the queue is full
+    dead_worker.kill()
+    dead_worker.join(5)
+
+    supervisor.put_update(create_update(2, user_id))
+
+    assert supervisor.workers[1] is not dead_worker and supervisor.workers[1].is_alive()
+    assert supervisor.updates_queues[1].get(timeout=5) == create_update(2, user_id)  # the first update is lost
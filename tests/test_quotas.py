@@ -0,0 +1,105 @@
+from time import time
+
+from sqlalchemy import create_engine, inspect, text, select, update, func
+from sqlalchemy.orm import sessionmaker
+
+from sql import database
+from sql.models import User, UserQuotaReservation
+from sql.crud import UserCrud
+from sql.quotas import QuotaResource, quota_engine
+
+
+# the tables of the first version of the bot
+INITIAL_SCHEMA = (
+    'CREATE TABLE users (id INTEGER PRIMARY KEY, telegram_id INTEGER NOT NULL UNIQUE, '
+    'second_blocks_spent INTEGER NOT NULL, character_blocks_spent INTEGER NOT NULL, tokens_spent INTEGER NOT NULL)',
+    'CREATE TABLE user_messages (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES users (id), '
+    'role VARCHAR(9) NOT NULL, text VARCHAR NOT NULL)',
+    'INSERT INTO users VALUES (1, 100, 0, 0, 5)',
+)
+
+
+def test_create_all_tables_upgrades_initial_schema(tmp_path, monkeypatch):
+
+    old_engine = create_engine(f'sqlite:///{tmp_path / "old.db"}')
+
+    with old_engine.begin() as connection:
+        for statement in INITIAL_SCHEMA:
+            connection.execute(text(statement))
+
+    monkeypatch.setattr(database, 'engine', old_engine)
+
+    database.create_all_tables()
+    database.create_all_tables()  # does nothing on the up to date schema
+
+    inspector = inspect(old_engine)
+    users_columns_names = {column['name'] for column in inspector.get_columns('users')}
+
+    assert {'tokens_reserved', 'second_blocks_reserved', 'character_blocks_reserved'} <= users_columns_names
+    assert 'ix_user_messages_user_id_id' in {index['name'] for index in inspector.get_indexes('user_messages')}
+    assert inspector.has_table('quota_reservations')
+
+    with sessionmaker(bind=old_engine, expire_on_commit=False)() as session:
+
+        user = session.get(User, 1)
+
+        assert quota_engine.reserve(session, user, QuotaResource.TOKENS, 10) is not None
+        assert session.scalar(select(User.tokens_reserved)) == 10
+
+
+def test_create_all_tables_resets_reservations_without_records(tmp_path, monkeypatch):
+
+    old_engine = create_engine(f'sqlite:///{tmp_path / "old.db"}')
+
+    monkeypatch.setattr(database, 'engine', old_engine)
+
+    database.create_all_tables()
+
+    # the amount reserved by the version without the reservations records
+    with old_engine.begin() as connection:
+
+        connection.execute(text("INSERT INTO users (telegram_id, tokens_spent, second_blocks_spent, "
+                                "character_blocks_spent, tokens_reserved) VALUES (100, 5, 0, 0, 10)"))
+        connection.execute(text('DROP TABLE quota_reservations'))
+
+    database.create_all_tables()
+
+    with old_engine.connect() as connection:
+        assert connection.execute(text('SELECT tokens_spent, tokens_reserved FROM users')).one() == (5, 0)
+
+
+def _get_tokens(session, user: User) -> tuple[int, int]:
+    return tuple(session.execute(select(User.tokens_reserved, User.tokens_spent).where(User.id == user.id)).one())
+
+
+def test_expired_reservations_are_released_while_user_reserves(database):
+
+    with database() as session:
+
+        user = UserCrud(session).create(telegram_id=1)
+
+        leaked_reservation = quota_engine.reserve(session, user, QuotaResource.TOKENS, 10)
+
+        session.execute(
+            update(UserQuotaReservation)
+            .where(UserQuotaReservation.id == leaked_reservation.record_id)
+            .values(reserved_at=time() - quota_engine.timeout - 1)
+        )
+        session.commit()
+
+        # the user keeps using the bot, the fresh reservations do not keep the leaked one
+        fresh_reservation = quota_engine.reserve(session, user, QuotaResource.TOKENS, 20)
+
+        assert quota_engine.release_expired(session) == 1
+        assert quota_engine.release_expired(session) == 0
+        assert _get_tokens(session, user) == (20, 0)
+
+        fresh_reservation.settle(7)
+
+        assert _get_tokens(session, user) == (0, 7)
+
+        leaked_reservation.settle(3)  # the request has finished after its reservation was released
+
+        assert _get_tokens(session, user) == (0, 10)
+        assert session.scalar(select(func.count()).select_from(UserQuotaReservation)) == 0
+
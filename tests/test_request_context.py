@@ -0,0 +1,92 @@
+from threading import get_ident
+
+import pytest
+from sqlalchemy import event
+
+from sql.database import engine
+from sql.message_journal import message_journal
+
+
+# the user, the quota reservation and its record, the history, the record deletion and the settlement (the messages
+# are written by the journal later)
+MAX_TEXT_MESSAGE_STATEMENTS_AMOUNT = 6
+
+
+@pytest.fixture
+def statements():
+    """
+    The SQL statements executed meanwhile by this thread (the handlers run in it), the statements of the background
+    threads (the message journal flusher, the quota reservations sweeper) are not counted.
+    """
+
+    executed_statements = []
+    thread_id = get_ident()
+
+    def before_cursor_execute(_, __, statement, *___):
+        if get_ident() == thread_id:
+            executed_statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+
+    yield executed_statements
+
+    event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+@pytest.fixture
+def checked_out_connections(monkeypatch):
+    """
+    The pooled connections amount checked out at every GPT request.
+    """
+
+    from services.gpt import gpt
+
+    checked_out_amounts = []
+
+    def record(answer):
+
+        def _record(*_, **__):
+
+            checked_out_amounts.append(engine.pool.checkedout())
+
+            return answer
+
+        return _record
+
+    monkeypatch.setattr(gpt, 'ask', record(('Ответ', 10)))
+    monkeypatch.setattr(gpt, 'summarize', record('Краткое содержание'))
+    monkeypatch.setattr(gpt, 'get_prompt_tokens_amount', record(10))
+
+    return checked_out_amounts
+
+
+def test_text_message_statements_amount(bot, telegram, statements):
+
+    bot.process(10, '/start')
+    bot.process(10, 'Привет')  # the user is created
+
+    message_journal.flush()  # a full journal would be flushed by the handler
+    statements.clear()
+
+    bot.process(10, 'Как дела?')
+
+    assert telegram.get_texts(10)[-1] == 'Ответ на "Как дела?"'
+    assert 0 < len(statements) <= MAX_TEXT_MESSAGE_STATEMENTS_AMOUNT
+
+
+def test_connection_is_not_held_while_gpt_is_requested(bot, checked_out_connections, monkeypatch):
+
+    from services.gpt import gpt
+    from bot_support_modules.conversation_summarizer import conversation_summarizer
+
+    monkeypatch.setattr(conversation_summarizer, 'is_enabled', True)
+    monkeypatch.setattr(conversation_summarizer, 'tokens_budget', 1)  # every history is summarized
+    # the upper bound exceeds REQUEST_MAX_TOKENS, so the remote tokenizer is requested
+    monkeypatch.setattr(gpt, 'get_prompt_tokens_upper_bound', lambda _: 301)
+
+    for text in ('/start', 'Привет', 'Как дела?', 'Что нового?'):
+        bot.process(10, text)
+
+    # the tokenizer, the summarization and the answer requests
+    assert len(checked_out_connections) >= 5
+    assert set(checked_out_connections) == {0}
@@ -0,0 +1,27 @@
+from settings import Settings
+
+
+def test_pools_and_limits_are_sized_by_handler_threads():
+
+    settings = Settings(BOT_WORKERS_AMOUNT=64, DB_POOL_SIZE=5)
+
+    assert settings.DB_POOL_SIZE + settings.DB_MAX_OVERFLOW == 64 + 1  # and the message journal
+    assert settings.HTTP_CONCURRENCY_MAX_LIMIT == 64
+
+    settings = Settings(BOT_WORKERS_AMOUNT=8, VOICE_PIPELINE_ENABLED=True)
+
+    assert settings.HTTP_CONCURRENCY_MAX_LIMIT == 8 + settings.VOICE_PIPELINE_MAX_WORKERS
+
+
+def test_set_pools_and_limits_are_kept():
+
+    settings = Settings(BOT_WORKERS_AMOUNT=64, DB_MAX_OVERFLOW=3, HTTP_CONCURRENCY_MAX_LIMIT=7)
+
+    assert (settings.DB_MAX_OVERFLOW, settings.HTTP_CONCURRENCY_MAX_LIMIT) == (3, 7)
+
+
+def test_async_mode_services_limit_is_sized_by_in_flight_updates():
+
+    settings = Settings(BOT_RUNTIME_MODE='async', BOT_WORKERS_AMOUNT=8, ASYNC_RUNTIME_MAX_IN_FLIGHT_UPDATES=500)
+
+    assert settings.HTTP_CONCURRENCY_MAX_LIMIT == 500
@@ -0,0 +1,85 @@
+import sys
+import subprocess
+from pathlib import Path
+
+from sqlalchemy import event
+
+from sql.database import engine
+from bot_support_modules.states import DebugStates
+from bot_support_modules.state_storage import DatabaseStateStorage
+
+
+PROJECT_DIR = Path(__file__).resolve().parent.parent
+# another bot process, it reads the state of the user 10 and sets the state of the user 20
+OTHER_PROCESS_CODE = '''
+from bot_support_modules.state_storage import DatabaseStateStorage
+
+storage = DatabaseStateStorage(10)
+
+print(storage.get_state(10, 10), storage.get_data(10, 10))
+
+storage.set_state(20, 20, 'DebugStates:active')
+storage.set_data(20, 20, 'origin', 'other process')
+'''
+
+
+def test_states_survive_restart(database):
+
+    storage = DatabaseStateStorage(10)
+
+    storage.set_state(10, 10, DebugStates.active)
+    storage.set_data(10, 10, 'key', 'value')
+
+    restarted_storage = DatabaseStateStorage(10)
+
+    assert restarted_storage.get_state(10, 10) == DebugStates.active.name
+    assert restarted_storage.get_data(10, 10) == {'key': 'value'}
+
+    restarted_storage.delete_state(10, 10)
+
+    assert DatabaseStateStorage(10).get_state(10, 10) is None
+
+
+def test_states_are_shared_between_processes(database):
+
+    storage = DatabaseStateStorage(10)
+
+    storage.set_state(10, 10, DebugStates.inactive)
+    storage.set_data(10, 10, 'key', 'value')
+
+    other_process = subprocess.run(
+        [sys.executable, '-c', OTHER_PROCESS_CODE], cwd=PROJECT_DIR, capture_output=True, text=True, timeout=60
+    )
+
+    assert other_process.returncode == 0, other_process.stderr
+    assert other_process.stdout.strip() == f"{DebugStates.inactive.name} {{'key': 'value'}}"
+
+    assert storage.get_state(20, 20) == DebugStates.active.name
+    assert storage.get_data(20, 20) == {'origin': 'other process'}
+
+
+def test_cached_state_reads_do_not_query_database(database):
+
+    storage = DatabaseStateStorage(10)
+
+    storage.set_state(10, 10, DebugStates.active)
+    storage.get_state(30, 30)  # the absence of the record is cached too
+
+    statements = []
+
+    def before_cursor_execute(_, __, statement, *___):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+
+    try:
+        for _ in range(100):
+
+            assert storage.get_state(10, 10) == DebugStates.active.name
+            assert storage.get_data(10, 10) == {}
+            assert storage.get_state(30, 30) is None
+
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+    assert not statements
@@ -0,0 +1,106 @@
+import pytest
+from sqlalchemy import select
+
+import main
+from services.gpt import gpt
+from sql.models import User
+from sql.message_journal import message_journal
+
+
+USER_ID = 10
+# the time of every chunk and the answer generated so far, the last chunk is the final one with the spent tokens
+CHUNKS = (
+    (0.5, 'Привет', None),
+    (1.2, 'Привет, как', None),
+    (1.5, 'Привет, как дела', None),
+    (2.5, 'Привет, как дела? Я', None),
+    (2.6, 'Привет, как дела? Я бот', 10),
+)
+
+
+@pytest.fixture
+def streaming_bot(bot, monkeypatch):
+    """
+    The bot streaming the answers by the stubbed GPT (the chunks are read from streaming_bot.chunks) with the fake
+    clock, streaming_bot.observations are the user spent tokens and the history length seen at every chunk.
+    """
+
+    clock = [0.0]
+
+    monkeypatch.setattr(main, 'GPT_STREAMING_ENABLED', True)
+    monkeypatch.setattr(main, 'GPT_STREAMING_EDIT_INTERVAL', 1)
+    monkeypatch.setattr(main, 'monotonic', lambda: clock[0])
+
+    bot.chunks = CHUNKS
+    bot.observations = []
+
+    def ask_stream(*_, **__):
+        for chunk_number, (chunk_time, answer, tokens_spent) in enumerate(bot.chunks, 1):
+
+            bot.observations.append(get_saved_answer())
+
+            clock[0] = chunk_time
+
+            yield answer, tokens_spent, chunk_number == len(bot.chunks)
+
+    monkeypatch.setattr(gpt, 'ask_stream', ask_stream)
+
+    bot.process(USER_ID, '/start')
+
+    return bot
+
+
+def get_saved_answer() -> tuple[int, int]:
+    """
+    Return the user spent tokens and the user history length (with the messages pending in the journal).
+    """
+
+    with main.SessionLocal() as session:
+
+        user = session.scalar(select(User).where(User.telegram_id == USER_ID))
+
+        return user.tokens_spent, len(message_journal.get_history(session, user.id, 100))
+
+
+def get_edits(telegram) -> list[str]:
+    return [params['text'] for method_name, params in telegram.requests if method_name == 'editMessageText']
+
+
+def test_edits_are_throttled_and_final_answer_is_edited_once(streaming_bot, telegram):
+
+    streaming_bot.process(USER_ID, 'Как дела?')
+
+    assert [params['text'] for method_name, params in telegram.requests if method_name == 'sendMessage'][-1] == \
+        'Думаю...'
+    # the edits at 1.2 and 2.5 (a second after the previous edit), then the final answer
+    assert get_edits(telegram) == ['Привет, как', 'Привет, как дела? Я', 'Привет, как дела? Я бот']
+
+
+def test_final_answer_is_not_edited_again_if_shown(streaming_bot, telegram):
+
+    streaming_bot.chunks = ((0.5, 'Привет', None), (1.5, 'Привет, я бот', 10))
+
+    streaming_bot.process(USER_ID, 'Как дела?')
+
+    assert get_edits(telegram) == ['Привет, я бот']
+
+
+def test_answer_is_saved_only_after_final_chunk(streaming_bot):
+
+    streaming_bot.process(USER_ID, 'Как дела?')
+
+    assert set(streaming_bot.observations) == {(0, 0)}
+    assert get_saved_answer() == (10, 2)
+
+
+def test_failed_stream_is_not_saved(streaming_bot, telegram):
+
+    streaming_bot.chunks = ((0.5, 'Привет', None), (1.5, main.USER_FRIENDLY_REQUEST_ERROR_MESSAGE, None))
+
+    streaming_bot.process(USER_ID, 'Как дела?')
+
+    assert get_saved_answer() == (0, 0)
+    assert get_edits(telegram)[-1] == main.USER_FRIENDLY_REQUEST_ERROR_MESSAGE
+
+    with main.SessionLocal() as session:
+        assert session.scalar(select(User.tokens_reserved).where(User.telegram_id == USER_ID)) == 0
@@ -0,0 +1,197 @@
+from json import dumps
+from threading import Thread, Event
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+from sqlalchemy import select
+from telebot import apihelper
+from requests.exceptions import RequestException
+
+import main
+from services import stt as stt_module
+from services.stt import stt
+from sql.models import User
+from bot_support_modules.telegram_files import telegram_files_downloader
+from settings import USER_FRIENDLY_REQUEST_ERROR_MESSAGE
+
+
+USER_ID = 10
+CHUNK_SIZE = 1024
+VOICE = bytes(range(256)) * 40  # 10 chunks
+STT_TEXT = 'Распознанный текст'
+
+
+class FilesAndSTTStub(ThreadingHTTPServer):
+    """
+    Local Telegram files and STT services. The file is downloaded with the file_status_code, its first chunk is sent
+    at once, the rest only after the STT has received a chunk (so a buffered download never finishes, it is broken
+    in 5 seconds) or never if is_download_broken is set. The STT request bodies and headers are collected.
+    """
+
+    daemon_threads = True
+
+    def __init__(self) -> None:
+
+        super().__init__(('127.0.0.1', 0), FilesAndSTTStubRequestHandler)
+
+        self.file_status_code = 200
+        self.is_download_broken = False
+
+        self.stt_received_chunk = Event()
+        self.stt_requests: list[tuple[dict, bytes | None]] = []  # the body is None if the upload is broken
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+class FilesAndSTTStubRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+
+        if self.server.file_status_code != 200:
+
+            self.send_response(self.server.file_status_code)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(VOICE)))
+        self.end_headers()
+
+        self.wfile.write(VOICE[:CHUNK_SIZE])
+        self.wfile.flush()
+
+        if self.server.is_download_broken or not self.server.stt_received_chunk.wait(5):
+
+            self.close_connection = True
+
+            return
+
+        self.wfile.write(VOICE[CHUNK_SIZE:])
+
+    def do_POST(self):
+
+        body = b''
+
+        try:
+            while chunk_size := int(self.rfile.readline().strip(), 16):
+
+                body += self.rfile.read(chunk_size)
+
+                self.rfile.readline()
+                self.server.stt_received_chunk.set()
+
+        except ValueError:  # the upload is broken
+
+            self.server.stt_requests.append((dict(self.headers), None))
+            self.close_connection = True
+
+            return
+
+        self.rfile.readline()
+        self.server.stt_requests.append((dict(self.headers), body))
+
+        response_body = dumps({'result': STT_TEXT}).encode()
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+
+        self.wfile.write(response_body)
+
+    def log_message(self, *_) -> None:
+        pass
+
+
+@pytest.fixture
+def services(monkeypatch):
+
+    services_stub = FilesAndSTTStub()
+
+    Thread(target=services_stub.serve_forever, daemon=True).start()
+
+    monkeypatch.setattr(apihelper, 'FILE_URL', f'{services_stub.url}/file/bot{{0}}/{{1}}')
+    monkeypatch.setattr(stt_module, 'STT_URL', f'{services_stub.url}/stt')
+
+    yield services_stub
+
+    services_stub.shutdown()
+    services_stub.server_close()
+
+
+@pytest.fixture
+def streaming_bot(bot, services, monkeypatch):
+    """
+    The bot uploading the voice messages by the real STT client into the stub services.
+    """
+
+    monkeypatch.setattr(main, 'STT_STREAMING_UPLOAD_ENABLED', True)
+    monkeypatch.setattr(main, 'STT_STREAMING_UPLOAD_CHUNK_SIZE', CHUNK_SIZE)
+    monkeypatch.delattr(stt, 'ask')  # the stub of the bot fixture
+
+    bot.process(USER_ID, '/start')
+
+    return bot
+
+
+def get_user(session_factory) -> User:
+    with session_factory() as session:
+        return session.scalar(select(User).where(User.telegram_id == USER_ID))
+
+
+def test_download_is_uploaded_while_downloading(services):
+
+    with telegram_files_downloader.open('voice/file.oga', CHUNK_SIZE) as voice_chunks:
+        assert stt.ask(voice_chunks) == (True, STT_TEXT)
+
+    headers, body = services.stt_requests[0]
+
+    assert headers['Transfer-Encoding'] == 'chunked'
+    assert body == VOICE
+
+
+def test_broken_download_fails_stt_request(services):
+
+    services.is_download_broken = True
+
+    with telegram_files_downloader.open('voice/file.oga', CHUNK_SIZE) as voice_chunks:
+        assert stt.ask(voice_chunks) == (False, USER_FRIENDLY_REQUEST_ERROR_MESSAGE)
+
+    assert [body for _, body in services.stt_requests] in ([], [None])  # not recognized by the partial file
+
+
+@pytest.mark.parametrize('is_download_broken, file_status_code', [(False, 404), (True, 200)])
+def test_failed_download_is_answered_with_error(
+        streaming_bot, services, database, telegram, is_download_broken, file_status_code
+):
+
+    services.is_download_broken = is_download_broken
+    services.file_status_code = file_status_code
+
+    streaming_bot.process_voice(USER_ID, 3)
+
+    user = get_user(database)
+
+    assert telegram.get_texts(USER_ID)[-1] == USER_FRIENDLY_REQUEST_ERROR_MESSAGE
+    assert (user.second_blocks_spent, user.second_blocks_reserved) == (0, 0)
+
+
+def test_failed_buffered_download_is_answered_with_error(bot, database, telegram, monkeypatch):
+
+    def download_file(*_) -> bytes:
+        raise RequestException('Refused')
+
+    monkeypatch.setattr(apihelper, 'download_file', download_file)
+
+    bot.process(USER_ID, '/start')
+    bot.process_voice(USER_ID, 3)
+
+    user = get_user(database)
+
+    assert telegram.get_texts(USER_ID)[-1] == USER_FRIENDLY_REQUEST_ERROR_MESSAGE
+    assert (user.second_blocks_spent, user.second_blocks_reserved) == (0, 0)
@@ -0,0 +1,150 @@
+from json import dumps
+from datetime import timedelta
+
+import pytest
+from requests import Response
+
+from services import tokens_cache
+from services.gpt import gpt
+from services.tokens_cache import TokensCountCache
+from sql import crud
+from sql.crud import TokensCountCrud
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    The cache time (and the shared counts expiry time), it is moved by the tests.
+    """
+
+    clock = [1000.0]
+
+    monkeypatch.setattr(tokens_cache, 'time', lambda: clock[0])
+    monkeypatch.setattr(crud, 'time', lambda: clock[0])
+
+    return clock
+
+
+class TokenizedPrompts(list):
+    """
+    The prompts sent to the tokenizer and the next tokenizer responses: status codes or exceptions.
+    """
+
+    def __init__(self) -> None:
+
+        super().__init__()
+
+        self.responses = []
+
+
+@pytest.fixture
+def tokenizer(monkeypatch):
+    """
+    The GPT with a new cache and the stubbed tokenization requests, collect the tokenized prompts. The responses are
+    the tokenizer.responses items, then 200 ones with a token per character.
+    """
+
+    tokenized_prompts = TokenizedPrompts()
+
+    def post(_, json: dict, **__) -> Response:
+
+        tokenized_prompts.append(json['text'])
+
+        status_code = tokenized_prompts.responses.pop(0) if tokenized_prompts.responses else 200
+
+        if isinstance(status_code, Exception):
+            raise status_code
+
+        response = Response()
+
+        response.status_code = status_code
+        response.elapsed = timedelta(seconds=0.1)
+        response._content = dumps({'tokens': list(json['text'])}).encode()
+
+        return response
+
+    monkeypatch.setattr(gpt, 'tokens_cache', TokensCountCache(10, 60, False))
+    monkeypatch.setattr(gpt.http_client, 'post', post)
+
+    return tokenized_prompts
+
+
+def test_count_expires_after_ttl(clock):
+
+    cache = TokensCountCache(10, 60, False)
+
+    cache.set('Привет', 3)
+    clock[0] += 59
+
+    assert cache.get('Привет') == 3
+
+    clock[0] += 1
+
+    assert cache.get('Привет') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_least_recently_used_count_is_evicted():
+
+    cache = TokensCountCache(2, 60, False)
+
+    cache.set('first', 1)
+    cache.set('second', 2)
+    cache.get('first')
+    cache.set('third', 3)
+
+    assert cache.get('second') is None  # the least recently used one
+    assert (cache.get('first'), cache.get('third')) == (1, 3)
+    assert len(cache._items) == 2
+
+
+def test_successful_count_is_cached(tokenizer):
+
+    assert gpt.get_prompt_tokens_amount('Привет') == 6
+    assert gpt.get_prompt_tokens_amount('Привет') == 6
+    assert tokenizer == ['Привет']
+
+
+@pytest.mark.parametrize('failure', [500, 429, ConnectionError('Refused')])
+def test_failed_count_is_not_cached(tokenizer, failure):
+
+    tokenizer.responses = [failure]
+
+    assert gpt.get_prompt_tokens_amount('Привет') is None
+    assert gpt.get_prompt_tokens_amount('Привет') == 6  # requested again
+    assert tokenizer == ['Привет', 'Привет']
+
+
+def test_shared_count_is_read_by_other_replica(database):
+
+    TokensCountCache(10, 60, True).set('Привет', 3)
+
+    other_replica_cache = TokensCountCache(10, 60, True)
+
+    with database() as session:
+        tokens_count = TokensCountCrud(session).get_actual(other_replica_cache.get_key('Привет'))
+
+    assert tokens_count.tokens_amount == 3
+    assert other_replica_cache.get('Привет') == 3
+    assert other_replica_cache.hits == 1
+    assert other_replica_cache.get_key('Привет') in other_replica_cache._items  # remembered in the process
+
+
+def test_shared_count_expires_after_ttl(database, clock):
+
+    TokensCountCache(10, 60, True).set('Привет', 3)
+    clock[0] += 60
+
+    assert TokensCountCache(10, 60, True).get('Привет') is None
+
+
+def test_expired_shared_counts_are_deleted(database, clock):
+
+    cache = TokensCountCache(2, 60, True)
+
+    cache.set('first', 1)
+    clock[0] += 60
+    cache.set('second', 2)  # every max_items sets the expired counts are deleted
+
+    with database() as session:
+        assert [tokens_count.tokens_amount for tokens_count in TokensCountCrud(session).get_many()] == [2]
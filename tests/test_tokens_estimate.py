@@ -0,0 +1,62 @@
+import pytest
+
+from services.gpt import gpt
+
+
+TOKEN_DENSE_PROMPT = '1234 😀 ' * 98 + 'ok'  # ~690 characters, a token per character or two
+
+
+@pytest.fixture
+def tokenizer(monkeypatch):
+    """
+    Replace the remote tokenizer, collect the tokenized prompts. The tokens amount is a character per token.
+    """
+
+    tokenized_prompts = []
+
+    def get_prompt_tokens_amount(prompt: str) -> int | None:
+
+        tokenized_prompts.append(prompt)
+
+        return len(prompt)
+
+    monkeypatch.setattr(gpt, 'get_prompt_tokens_amount', get_prompt_tokens_amount)
+
+    return tokenized_prompts
+
+
+def test_upper_bound_counts_cyrillic_characters_and_other_utf8_bytes():
+
+    for prompt in ('', 'Hello', TOKEN_DENSE_PROMPT, '汉字'):
+        assert gpt.get_prompt_tokens_upper_bound(prompt) == len(prompt.encode()) + 2
+
+    assert gpt.get_prompt_tokens_upper_bound('Привет, 世界!') == len('Привет, ') + len('世界!'.encode()) + 2
+
+
+def test_cyrillic_prompt_is_not_tokenized(tokenizer):
+
+    prompt = 'Расскажи, пожалуйста, подробно, как приготовить борщ с пампушками и чесноком. ' * 3  # 234 characters
+
+    assert len(prompt.encode()) > 300
+    assert gpt.is_prompt_within_tokens_limit(prompt, 300)
+    assert not tokenizer
+
+
+def test_short_prompt_is_not_tokenized(tokenizer):
+
+    assert gpt.is_prompt_within_tokens_limit('Как дела?', 300)
+    assert not tokenizer
+
+
+def test_token_dense_prompt_is_tokenized(tokenizer):
+
+    assert not gpt.is_prompt_within_tokens_limit(TOKEN_DENSE_PROMPT, 300)
+    assert tokenizer == [TOKEN_DENSE_PROMPT]
+
+
+def test_prompt_is_rejected_if_tokenizer_is_unavailable(monkeypatch):
+
+    monkeypatch.setattr(gpt, 'get_prompt_tokens_amount', lambda _: None)
+
+    assert not gpt.is_prompt_within_tokens_limit('Привет ' * 50, 300)
+    assert gpt.is_prompt_within_tokens_limit('Привет', 300)
@@ -0,0 +1,129 @@
+from os import utime
+from datetime import timedelta
+
+import pytest
+from requests import Response
+
+from services.tts import tts
+from services.tts_cache import TTSCache
+
+
+class SynthesizedTexts(list):
+    """
+    The texts sent to the TTS and the next TTS responses: status codes or exceptions.
+    """
+
+    def __init__(self) -> None:
+
+        super().__init__()
+
+        self.responses = []
+
+
+@pytest.fixture
+def synthesizer(tmp_path, monkeypatch):
+    """
+    The TTS with a new cache and the stubbed synthesis requests, collect the synthesized texts. The responses are the
+    synthesizer.responses items (status codes or exceptions), then 200 ones with the text bytes as the audio.
+    """
+
+    synthesized_texts = SynthesizedTexts()
+
+    def post(_, data: dict, **__) -> Response:
+
+        synthesized_texts.append(data['text'])
+
+        status_code = synthesized_texts.responses.pop(0) if synthesized_texts.responses else 200
+
+        if isinstance(status_code, Exception):
+            raise status_code
+
+        response = Response()
+
+        response.status_code = status_code
+        response.elapsed = timedelta(seconds=0.1)
+        response._content = data['text'].encode()
+
+        return response
+
+    monkeypatch.setattr(tts, 'cache', TTSCache(tmp_path, 1024, 10))
+    monkeypatch.setattr(tts.http_client, 'post', post)
+
+    return synthesized_texts
+
+
+def set_modification_time(cache: TTSCache, text: str, modification_time: float) -> None:
+    utime(cache._get_path(cache.get_key(text)), (modification_time, modification_time))
+
+
+def test_audio_is_taken_from_memory_and_disk(tmp_path):
+
+    cache = TTSCache(tmp_path, 1024, 10)
+
+    assert cache.get('Привет') is None
+
+    cache.set('Привет', b'audio')
+
+    assert cache.get('Привет') == b'audio'
+    assert TTSCache(tmp_path, 1024, 10).get('Привет') == b'audio'  # after a restart
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_memory_tier_is_bounded(tmp_path):
+
+    cache = TTSCache(tmp_path, 1024, 1)
+
+    cache.set('first', b'first audio')
+    cache.set('second', b'second audio')
+
+    assert list(cache._memory) == [cache.get_key('second')]
+    assert cache.get('first') == b'first audio'  # from the disk tier
+    assert cache.hits == 1
+
+
+def test_least_recently_used_file_is_evicted(tmp_path):
+
+    cache = TTSCache(tmp_path, 10, 0)  # only the disk tier
+
+    cache.set('first', b'1111')
+    cache.set('second', b'2222')
+    set_modification_time(cache, 'first', 1)
+    set_modification_time(cache, 'second', 2)
+
+    assert cache.get('first') == b'1111'  # the hit makes the file the most recently used one
+
+    cache.set('third', b'3333')
+
+    assert cache.get('second') is None
+    assert (cache.get('first'), cache.get('third')) == (b'1111', b'3333')
+    assert cache._disk_size == 8
+
+
+def test_overwritten_audio_size_is_counted_once(tmp_path):
+
+    cache = TTSCache(tmp_path, 1024, 0)
+
+    cache.set('first', b'1111')
+    cache.set('first', b'111111')  # synthesized again by a concurrent request
+    cache.set('second', b'2222')
+
+    # the eviction scan is not started, so the size is counted by the sets only
+    assert cache._disk_size == TTSCache(tmp_path, 1024, 0)._disk_size == 10
+    assert cache.get('first') == b'111111'
+
+
+def test_synthesized_audio_is_cached(synthesizer):
+
+    assert tts.ask('Привет') == tts.ask('Привет') == 'Привет'.encode()
+    assert synthesizer == ['Привет']
+
+
+@pytest.mark.parametrize('failure', [500, 429, ConnectionError('Refused')])
+def test_failed_synthesis_is_not_cached(synthesizer, failure):
+
+    synthesizer.responses = [failure]
+
+    assert isinstance(tts.ask('Привет'), str)
+    assert not tts.cache.contains('Привет')
+    assert tts.ask('Привет') == 'Привет'.encode()  # requested again
+    assert synthesizer == ['Привет', 'Привет']
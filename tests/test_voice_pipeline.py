@@ -0,0 +1,111 @@
+from time import sleep
+from threading import Event
+
+import pytest
+from sqlalchemy import select
+
+import main
+from services.gpt import gpt
+from services.tts import tts
+from sql.models import User
+
+
+USER_ID = 10
+# the segments of 100 characters: one block each if charged separately, two blocks as the whole answer
+SENTENCES = [f'{number} {"а" * 97}.' for number in range(3)]
+ANSWER = ' '.join(SENTENCES)
+ERROR_MESSAGE = 'Произошла ошибка. Повторите попытку.'
+
+
+@pytest.fixture
+def pipelined_bot(bot, monkeypatch):
+    """
+    The bot answering the voice messages by the pipeline with the stubbed GPT stream (the items are read from
+    pipelined_bot.stream_items) and TTS (its answer is the segment bytes, the n-th segment is synthesized for
+    pipelined_bot.tts_durations[n] seconds after pipelined_bot.tts_allowed is set), the sent voice messages are
+    collected into pipelined_bot.sent_voices.
+    """
+
+    monkeypatch.setattr(main, 'VOICE_PIPELINE_ENABLED', True)
+    monkeypatch.setattr(main, 'VOICE_PIPELINE_MIN_SEGMENT_LENGTH', 10)
+
+    bot.stream_items = [(ANSWER[:120], None), (ANSWER[:220], None), (ANSWER[:290], None), (ANSWER, 10)]
+    bot.tts_durations = [0.3, 0.2, 0]  # the later segments are synthesized first
+    bot.tts_allowed = Event()
+    bot.tts_prompts = []
+    bot.sent_voices = []
+
+    bot.tts_allowed.set()
+
+    def ask_tts(text: str) -> bytes:
+
+        bot.tts_prompts.append(text)
+        bot.tts_allowed.wait(5)
+
+        sleep(bot.tts_durations[SENTENCES.index(text)] if text in SENTENCES else 0)
+
+        return text.encode()
+
+    def ask_stream(*_, **__):
+        for item_number, (answer, tokens_spent) in enumerate(bot.stream_items, 1):
+            yield answer, tokens_spent, item_number == len(bot.stream_items)
+
+    monkeypatch.setattr(gpt, 'ask_stream', ask_stream)
+    monkeypatch.setattr(tts, 'ask', ask_tts)
+    monkeypatch.setattr(bot, 'send_voice', lambda chat_id, voice, **_: bot.sent_voices.append(voice.decode()))
+
+    bot.process(USER_ID, '/start')
+
+    yield bot
+
+    bot.tts_allowed.set()
+
+
+def get_user(session_factory) -> User:
+    with session_factory() as session:
+        return session.scalar(select(User).where(User.telegram_id == USER_ID))
+
+
+def test_segments_are_sent_in_answer_order(pipelined_bot):
+
+    pipelined_bot.process_voice(USER_ID, 3)
+
+    assert pipelined_bot.sent_voices == SENTENCES
+
+
+def test_answer_is_charged_as_whole_text(pipelined_bot, database):
+
+    pipelined_bot.process_voice(USER_ID, 3)
+
+    user = get_user(database)
+
+    assert user.character_blocks_spent == tts.get_character_blocks(len(''.join(SENTENCES))) == 2
+    assert user.character_blocks_reserved == 0
+    assert user.tokens_spent == 10
+
+
+def test_error_message_is_not_synthesized(pipelined_bot, database, telegram):
+
+    pipelined_bot.stream_items = [(ERROR_MESSAGE, None)]
+
+    pipelined_bot.process_voice(USER_ID, 3)
+
+    assert pipelined_bot.tts_prompts == []
+    assert pipelined_bot.sent_voices == []
+    assert telegram.get_texts(USER_ID)[-1] == ERROR_MESSAGE
+
+
+def test_failed_answer_segments_are_not_sent_or_charged(pipelined_bot, database, telegram):
+
+    pipelined_bot.stream_items = [(ANSWER[:120], None), (ANSWER[:220], None), (ERROR_MESSAGE, None)]
+    pipelined_bot.tts_allowed.clear()  # the segments are still synthesized when the answer fails
+
+    pipelined_bot.process_voice(USER_ID, 3)
+
+    user = get_user(database)
+
+    assert set(pipelined_bot.tts_prompts) <= set(SENTENCES[:2])  # the segments not started yet are cancelled
+    assert pipelined_bot.sent_voices == []
+    assert telegram.get_texts(USER_ID)[-1] == ERROR_MESSAGE
+    assert (user.character_blocks_spent, user.character_blocks_reserved) == (0, 0)
+    assert (user.tokens_spent, user.tokens_reserved) == (0, 0)
@@ -0,0 +1,140 @@
+from json import dumps
+from time import sleep
+from random import Random
+from threading import Thread
+from http.client import HTTPConnection
+
+import pytest
+
+from bot_support_modules import webhook
+from bot_support_modules.webhook import WebhookServer, SECRET_TOKEN_HEADER
+
+
+UPDATE_DATA = dumps({'update_id': 1}).encode()
+
+
+@pytest.fixture
+def server(monkeypatch):
+
+    monkeypatch.setattr(webhook, 'WEBHOOK_HOST', '127.0.0.1')
+    monkeypatch.setattr(webhook, 'WEBHOOK_PORT', 0)
+    monkeypatch.setattr(webhook, 'WEBHOOK_SECRET_TOKEN', 'secret')
+
+    webhook_server = WebhookServer(bot=None)  # the workers are not started, the updates stay in the queue
+
+    Thread(target=webhook_server.serve_forever, daemon=True).start()
+
+    yield webhook_server
+
+    webhook_server.shutdown()
+    webhook_server.server_close()
+
+
+def post(connection: HTTPConnection, path: str, secret_token: str, body: bytes) -> int:
+
+    connection.request('POST', path, body, {SECRET_TOKEN_HEADER: secret_token})
+
+    response = connection.getresponse()
+
+    response.read()
+
+    return response.status
+
+
+@pytest.mark.parametrize('path, secret_token, status_code', [
+    ('/unknown', 'secret', 404),
+    (webhook.WEBHOOK_PATH, 'wrong', 403),
+])
+def test_rejected_request_body_is_not_parsed_as_next_request(server, path, secret_token, status_code):
+
+    connection = HTTPConnection(*server.server_address)
+
+    assert post(connection, path, secret_token, UPDATE_DATA) == status_code
+    assert post(connection, webhook.WEBHOOK_PATH, 'secret', UPDATE_DATA) == 200  # the same keep-alive connection
+    assert post(connection, webhook.WEBHOOK_PATH, 'secret', UPDATE_DATA) == 200
+
+    assert server.updates_queue.qsize() == 2
+
+
+def test_too_large_request_is_rejected(server, monkeypatch):
+
+    monkeypatch.setattr(webhook, 'WEBHOOK_MAX_BODY_SIZE', len(UPDATE_DATA) - 1)
+
+    connection = HTTPConnection(*server.server_address)
+
+    assert post(connection, webhook.WEBHOOK_PATH, 'secret', UPDATE_DATA) == 400
+    assert server.updates_queue.empty()
+
+
+def test_accepted_updates_are_processed_on_stop(bot, telegram, monkeypatch):
+
+    monkeypatch.setattr(webhook, 'WEBHOOK_HOST', '127.0.0.1')
+    monkeypatch.setattr(webhook, 'WEBHOOK_PORT', 0)
+    monkeypatch.setattr(webhook, 'WEBHOOK_SECRET_TOKEN', 'secret')
+
+    webhook_server = WebhookServer(bot)
+
+    webhook_server.start_dispatcher()
+
+    Thread(target=webhook_server.serve_forever, daemon=True).start()
+
+    connection = HTTPConnection(*webhook_server.server_address)
+
+    for update_id in range(1, 51):
+
+        user_id = update_id % 5 + 10
+        update_data = dumps({'update_id': update_id, 'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+            'text': '/start',
+        }}).encode()
+
+        assert post(connection, webhook.WEBHOOK_PATH, 'secret', update_data) == 200
+
+    webhook_server.shutdown()
+    webhook_server.server_close()
+
+    assert webhook_server.wait_for_updates(10)
+    assert sum(len(telegram.get_texts(user_id)) for user_id in range(10, 15)) == 50
+
+
+class RecordingBot:
+    """
+    Records the order of the passed updates, the updates take random time to be passed (like the parsing).
+    """
+
+    def __init__(self) -> None:
+
+        self.random = Random(0)
+        self.updates_ids = []
+
+    def process_new_updates(self, updates: list) -> None:
+
+        sleep(self.random.random() / 1000)
+
+        self.updates_ids.extend(update.update_id for update in updates)
+
+    def wait_for_shards(self, _: float) -> bool:
+        return True
+
+
+def test_updates_are_passed_to_bot_in_acceptance_order(monkeypatch):
+
+    monkeypatch.setattr(webhook, 'WEBHOOK_HOST', '127.0.0.1')
+    monkeypatch.setattr(webhook, 'WEBHOOK_PORT', 0)
+    monkeypatch.setattr(webhook, 'WEBHOOK_SECRET_TOKEN', 'secret')
+
+    bot = RecordingBot()
+    webhook_server = WebhookServer(bot)
+
+    for update_id in range(1, 201):
+        webhook_server.updates_queue.put((0, dumps({'update_id': update_id}).encode()))
+
+    webhook_server.start_dispatcher()
+
+    assert webhook_server.wait_for_updates(10)
+    assert bot.updates_ids == list(range(1, 201))
+
+    webhook_server.server_close()